@@ -18,10 +18,9 @@ import os
 import sys
 import traceback
 
-import sentry_sdk
 from flask import Flask, request
-from sentry_sdk.integrations.flask import FlaskIntegration
 
+import shared.cache
 import shared.globals
 import shared.sentry_config
 import shared.shared_sd as shared_sd
@@ -30,6 +29,10 @@ UNEXPECTED = "An unexpected error occurred in the automation:\n%s"
 
 # This must stay before the Flask initialisation.
 if shared.sentry_config.SENTRY_DSN is not None:
+    # Sentry is slow to import, so only do so when it is configured.
+    # pylint: disable=import-outside-toplevel
+    import sentry_sdk
+    from sentry_sdk.integrations.flask import FlaskIntegration
     sentry_sdk.init(
         dsn=shared.sentry_config.SENTRY_DSN,
         integrations=[FlaskIntegration()],
@@ -286,6 +289,7 @@ def initialise(action_is_comment: bool):
     """ Initialise code and variables for this event. """
     try:
         shared.globals.initialise_config()
+        shared.cache.load_configured_snapshot()
         shared.globals.initialise_ticket_data(request.json)
         shared.globals.initialise_sd_auth()
         shared.globals.initialise_shared_sd()
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+"""
+Profile how long it takes to import the framework, using Python's
+"-X importtime", so that cold starts (e.g. under Zappa/Lambda) stay fast.
+
+The import is run in a fresh interpreter. It fails if it takes longer than
+the budget or if it pulls in any of the optional integrations, which
+should only be imported when they are first used.
+
+Usage: python3 benchmarks/import_benchmark.py [--module NAME] [--budget MS]
+           [--top N]
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MODULE = "app"
+DEFAULT_BUDGET_MS = 1000
+DEFAULT_TOP = 15
+# Slow to import and not needed unless the integration is enabled.
+LAZY_MODULES = [
+    "ldap3", "unidecode", "googleapiclient", "google.oauth2", "boto3", "botocore", "hvac",
+    "sentry_sdk"
+]
+
+
+def parse_importtime(output):
+    """
+    Parse the "-X importtime" output into a list of (module, self us,
+    cumulative us) tuples, in the order the imports finished.
+    """
+    results = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # The header line
+            continue
+        results.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return results
+
+
+def profile(module=DEFAULT_MODULE):
+    """ Import the module in a fresh interpreter and return the parsed timings. """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BASEDIR,
+        capture_output=True,
+        text=True,
+        check=False)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Unable to import {module}:\n{completed.stderr}")
+    return parse_importtime(completed.stderr)
+
+
+def check(results, module=DEFAULT_MODULE, budget_ms=DEFAULT_BUDGET_MS):
+    """ Return a list of the ways in which the import breaks the budget. """
+    problems = []
+    imported = {name for name, _, _ in results}
+    for lazy in LAZY_MODULES:
+        if lazy in imported:
+            problems.append(f"{lazy} is imported when {module} is")
+    total = [cumulative for name, _, cumulative in results if name == module]
+    if total != [] and total[0] / 1000 > budget_ms:
+        problems.append(
+            f"Importing {module} took {total[0] / 1000:.0f}ms, over the {budget_ms}ms budget")
+    return problems
+
+
+def report(results, top=DEFAULT_TOP):
+    """ Print the slowest imports as a table. """
+    print(f"{'module':50} {'self ms':>10} {'cumulative ms':>14}")
+    slowest = sorted(results, key=lambda result: result[2], reverse=True)[:top]
+    for name, self_us, cumulative_us in slowest:
+        print(f"{name:50} {self_us / 1000:10.1f} {cumulative_us / 1000:14.1f}")
+
+
+def main():
+    """ Parse the arguments and profile the import. """
+    parser = argparse.ArgumentParser(
+        description="Check how long it takes to import the framework")
+    parser.add_argument("--module", default=DEFAULT_MODULE,
+                        help=f"module to import (default {DEFAULT_MODULE})")
+    parser.add_argument("--budget", type=int, default=DEFAULT_BUDGET_MS,
+                        help=f"maximum milliseconds allowed (default {DEFAULT_BUDGET_MS})")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP,
+                        help=f"number of imports to list (default {DEFAULT_TOP})")
+    args = parser.parse_args()
+    results = profile(args.module)
+    report(results, args.top)
+    problems = check(results, args.module, args.budget)
+    for problem in problems:
+        print(problem)
+    return 1 if problems != [] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
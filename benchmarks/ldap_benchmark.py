@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+"""
+Measure the shared_ldap operations against a synthetic directory held in
+ldap3's MOCK_SYNC server, so that their behaviour at production scale can
+be seen without a real LDAP server.
+
+The directory has the requested number of accounts, each managed by the
+account with a tenth of its number, and a chain of mailing groups nested
+to the requested depth, each with some accounts as members.
+
+Every operation is run once with cold caches and then again with warm
+ones. The time taken and the number of LDAP operations issued are
+reported for both.
+
+Usage: python3 benchmarks/ldap_benchmark.py [--accounts N] [--depth N]
+           [--members N]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from ldap3 import MOCK_SYNC, Connection, Server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+import shared.cache
+import shared.globals
+import shared.shared_ldap as shared_ldap
+
+BASE_DN = "dc=example,dc=org"
+ACCOUNTS_OU = f"ou=accounts,{BASE_DN}"
+MAILING_OU = f"ou=mailing,ou=groups,{BASE_DN}"
+ADMIN_DN = f"cn=admin,{BASE_DN}"
+ADMIN_PASSWORD = "benchmark"
+COUNTED = ["search", "add", "modify", "delete", "modify_dn"]
+# Accounts that make calculate_uid work for the uid it picks.
+NAMESAKES = 20
+
+
+class CountingConnection:
+    """ Wrap a connection to count the LDAP operations issued through it. """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.count = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.conn, name)
+        if name not in COUNTED:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self.count += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def account_dn(index):
+    """ Return the DN of the numbered account. """
+    return f"uid=user{index},{ACCOUNTS_OU}"
+
+
+def group_dn(level):
+    """ Return the DN of the mailing group at the given nesting level. """
+    return f"cn=group{level},{MAILING_OU}"
+
+
+def build_directory(accounts, depth, members):
+    """ Create the mock server, populated with the synthetic directory. """
+    conn = Connection(
+        Server("benchmark"),
+        user=ADMIN_DN,
+        password=ADMIN_PASSWORD,
+        client_strategy=MOCK_SYNC)
+    add = conn.strategy.add_entry
+    add(ADMIN_DN, {"objectClass": ["person"], "sn": "admin", "userPassword": ADMIN_PASSWORD})
+    stamp = "20230101000000Z"
+    for index in range(accounts):
+        attributes = {
+            "objectClass": ["posixAccount", "inetOrgPerson"],
+            "uid": f"user{index}",
+            "cn": f"user{index}",
+            "mail": f"user{index}@example.org",
+            "aRecord": f"alias{index}@example.org",
+            "uidNumber": str(10000 + index),
+            "modifyTimestamp": stamp
+        }
+        if index != 0:
+            attributes["manager"] = account_dn(index // 10)
+        add(account_dn(index), attributes)
+    for index in range(NAMESAKES):
+        suffix = "" if index == 0 else str(index)
+        add(f"uid=fred.flintstone{suffix},{ACCOUNTS_OU}", {
+            "objectClass": ["posixAccount"],
+            "uid": f"fred.flintstone{suffix}",
+            "mail": f"fred.flintstone{suffix}@example.org",
+            "uidNumber": str(10000 + accounts + index),
+            "modifyTimestamp": stamp
+        })
+    for level in range(depth):
+        first = (level * members) % max(accounts, 1)
+        unique_members = [
+            account_dn((first + index) % accounts) for index in range(min(members, accounts))]
+        if level + 1 < depth:
+            unique_members.append(group_dn(level + 1))
+        add(group_dn(level), {
+            "objectClass": ["groupOfUniqueNames"],
+            "cn": f"group{level}",
+            "mail": f"group{level}@example.org",
+            "uniqueMember": unique_members,
+            "owner": [group_dn(min(level + 1, depth - 1))],
+            "modifyTimestamp": stamp
+        })
+    conn.bind()
+    return conn
+
+
+def reset_caches():
+    """ Forget everything cached by earlier operations. """
+    shared.cache.BACKEND = None
+    shared_ldap.GROUP_GRAPH = None
+    shared_ldap.REPLICA = None
+    shared_ldap.MANAGER_GRAPH = None
+    shared_ldap.ID_HIGH_WATER = {}
+
+
+def install(conn):
+    """ Point shared_ldap at the mock directory. """
+    shared.globals.CONFIGURATION = {
+        "ldap_enabled": True,
+        "ldap_base_dn": BASE_DN,
+        "ldap_mailing_groups": "ou=mailing,ou=groups",
+        "ldap_security_groups": "ou=security,ou=groups"
+    }
+    shared_ldap.BASE_DN = BASE_DN
+    # The mock server isn't thread-safe, so only use one connection.
+    shared_ldap.POOL = shared_ldap.LdapConnectionPool(lambda: conn, size=1)
+    reset_caches()
+
+
+def operations(accounts, depth, members):
+    """ Return the (name, function) pairs to measure. """
+    # A member of the most deeply nested group only.
+    deepest = account_dn(((depth - 1) * members) % accounts)
+    return [
+        ("flatten_list", lambda: shared_ldap.flatten_list([group_dn(0)])),
+        ("is_dn_in_group (nested)",
+         lambda: shared_ldap.is_dn_in_group("group0", deepest, True)),
+        ("get_next_uid_number", shared_ldap.get_next_uid_number),
+        ("calculate_uid", lambda: shared_ldap.calculate_uid("Fred", "Flintstone")),
+        ("find_single_object_from_email (alias)",
+         lambda: shared_ldap.find_single_object_from_email(f"alias{accounts - 1}@example.org")),
+        ("find_single_object_from_email (unknown)",
+         lambda: shared_ldap.find_single_object_from_email("nobody@example.org")),
+        ("get_manager_from_dn", lambda: shared_ldap.get_manager_from_dn(account_dn(accounts - 1))),
+        ("get_manager_chain", lambda: shared_ldap.get_manager_chain(account_dn(accounts - 1))),
+        ("create_accounts (20)", lambda: shared_ldap.create_accounts([
+            ("Barney", f"Rubble{index}", f"barney{index}@example.org") for index in range(20)]))
+    ]
+
+
+def measure(conn, function):
+    """ Run the function, returning the seconds taken and LDAP operations issued. """
+    before = conn.count
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start, conn.count - before
+
+
+def run(accounts, depth, members):
+    """ Build the directory and measure every operation. Returns the results. """
+    conn = CountingConnection(build_directory(accounts, depth, members))
+    install(conn)
+    results = []
+    for name, function in operations(accounts, depth, members):
+        reset_caches()
+        cold = measure(conn, function)
+        warm = measure(conn, function)
+        results.append((name, cold, warm))
+    return results
+
+
+def report(results):
+    """ Print the results as a table. """
+    print(f"{'operation':42} {'cold ms':>10} {'cold ops':>9} {'warm ms':>10} {'warm ops':>9}")
+    for name, cold, warm in results:
+        print(f"{name:42} {cold[0] * 1000:10.1f} {cold[1]:9} "
+              f"{warm[0] * 1000:10.1f} {warm[1]:9}")
+
+
+def main():
+    """ Parse the arguments and run the benchmark. """
+    parser = argparse.ArgumentParser(
+        description="Benchmark shared_ldap against a synthetic directory")
+    parser.add_argument("--accounts", type=int, default=10000,
+                        help="number of accounts (default 10000)")
+    parser.add_argument("--depth", type=int, default=10,
+                        help="depth of the nested mailing groups (default 10)")
+    parser.add_argument("--members", type=int, default=50,
+                        help="accounts in each mailing group (default 50)")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    results = run(args.accounts, args.depth, args.members)
+    print(f"Directory of {args.accounts} accounts built and measured in "
+          f"{time.perf_counter() - start:.1f}s")
+    report(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
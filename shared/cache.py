@@ -0,0 +1,348 @@
+"""
+A cache shared by all of the framework's lookups.
+
+Each lookup uses its own namespace (e.g. "custom_fields" or "ldap") and each
+namespace has its own time-to-live, which can be overridden through the
+"cache_ttls" configuration entry. Values must be JSON-serialisable.
+
+Three backends are available, selected with "cache_backend":
+
+1. "memory" (the default) - an LRU cache private to each process.
+2. "sqlite" - a SQLite database file, shared by every process on the host.
+3. "redis" - a Redis server, shared by every process on every node. This
+   needs the redis package to be installed.
+"""
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import shared.globals
+
+# Returned by lookup() when there is nothing cached for the key. A separate
+# sentinel is needed so that None can be cached, e.g. for negative entries.
+MISSING = object()
+
+DEFAULT_TTL = 300
+DEFAULT_TTLS = {
+    "custom_fields": 86400,
+    "accounts": 3600,
+    "project_metadata": 3600,
+    "organizations": 300,
+    "ldap": 300,
+    "google_aliases": 3600
+}
+DEFAULT_MAX_ENTRIES = 10000
+KEY_PREFIX = "sdwf"
+
+BACKEND = None
+BACKEND_LOCK = threading.Lock()
+# When not None, everything put into the cache is also recorded here so
+# that it can be written out as a snapshot.
+RECORDING = None
+SNAPSHOT_LOADED = False
+
+
+class CacheError(Exception):
+    """ Base exception class for the library. """
+
+
+class InvalidCacheConfig(CacheError):
+    """ The cache configuration is invalid. """
+
+
+class MemoryBackend:
+    """ A thread-safe, in-process LRU cache. """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the value for the key or MISSING. """
+        with self.lock:
+            if key not in self.entries:
+                return MISSING
+            expires, value = self.entries[key]
+            if expires < time.time():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set_many(self, mapping, ttl):
+        """ Store all of the keys and values in the mapping. """
+        expires = time.time() + ttl
+        with self.lock:
+            for key, value in mapping.items():
+                self.entries[key] = (expires, value)
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        """ Remove the key if present. """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self, prefix):
+        """ Remove every key starting with the prefix. """
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                del self.entries[key]
+
+
+class SQLiteBackend:
+    """
+    A cache stored in a SQLite database so that it is shared between
+    processes on the same host, e.g. mod_wsgi daemons.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        self.connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+
+    def connection(self):
+        """ SQLite connections can't be shared between threads. """
+        if getattr(self.local, "conn", None) is None:
+            conn = sqlite3.connect(self.filename, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return self.local.conn
+
+    def get(self, key):
+        """ Return the value for the key or MISSING. """
+        row = self.connection().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires >= ?",
+            (key, time.time())).fetchone()
+        if row is None:
+            return MISSING
+        return json.loads(row[0])
+
+    def set_many(self, mapping, ttl):
+        """ Store all of the keys and values in the mapping in one transaction. """
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                [(key, json.dumps(value), now + ttl) for key, value in mapping.items()])
+            conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+
+    def delete(self, key):
+        """ Remove the key if present. """
+        self.connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self, prefix):
+        """ Remove every key starting with the prefix. """
+        self.connection().execute(
+            "DELETE FROM cache WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+
+class RedisBackend:
+    """
+    A cache stored in Redis so that it is shared between nodes. Redis
+    expires the keys itself.
+
+    A client can be passed in, which is mostly useful for testing against
+    a local stand-in; otherwise one is created from the URL.
+    """
+
+    def __init__(self, url=None, client=None):
+        if client is None:
+            import redis  # pylint: disable=import-outside-toplevel
+            client = redis.Redis.from_url(url)
+        self.client = client
+
+    def get(self, key):
+        """ Return the value for the key or MISSING. """
+        value = self.client.get(key)
+        if value is None:
+            return MISSING
+        return json.loads(value)
+
+    def set_many(self, mapping, ttl):
+        """ Store all of the keys and values in the mapping in one round-trip. """
+        pipe = self.client.pipeline()
+        for key, value in mapping.items():
+            pipe.set(key, json.dumps(value), ex=max(1, int(ttl)))
+        pipe.execute()
+
+    def delete(self, key):
+        """ Remove the key if present. """
+        self.client.delete(key)
+
+    def clear(self, prefix):
+        """ Remove every key starting with the prefix. """
+        keys = list(self.client.scan_iter(match=f"{prefix}*"))
+        if keys != []:
+            self.client.delete(*keys)
+
+
+def create_backend():
+    """ Create the backend selected by the configuration. """
+    backend = shared.globals.config("cache_backend")
+    if backend in (None, "memory"):
+        max_entries = shared.globals.config("cache_max_entries")
+        return MemoryBackend(max_entries or DEFAULT_MAX_ENTRIES)
+    if backend == "sqlite":
+        filename = shared.globals.config("cache_sqlite_file")
+        if filename is None:
+            basedir = os.path.dirname(os.path.dirname(__file__))
+            filename = f"{basedir}/cache.sqlite"
+        return SQLiteBackend(filename)
+    if backend == "redis":
+        url = shared.globals.config("cache_redis_url")
+        if url is None:
+            raise InvalidCacheConfig("'cache_redis_url' is needed for the redis cache")
+        return RedisBackend(url)
+    raise InvalidCacheConfig(f"Unknown cache backend '{backend}'")
+
+
+def get_backend():
+    """ Return the cache backend, creating it first if required. """
+    global BACKEND  # pylint: disable=global-statement
+    if BACKEND is None:
+        with BACKEND_LOCK:
+            if BACKEND is None:
+                BACKEND = create_backend()
+    return BACKEND
+
+
+def ttl_for(namespace):
+    """ Return the time-to-live, in seconds, for the namespace. """
+    ttls = shared.globals.config("cache_ttls")
+    if ttls is not None and namespace in ttls:
+        return ttls[namespace]
+    return DEFAULT_TTLS.get(namespace, DEFAULT_TTL)
+
+
+def full_key(namespace, key):
+    """ Build the key used in the backend. """
+    return f"{KEY_PREFIX}:{namespace}:{key}"
+
+
+def lookup(namespace, key):
+    """ Return the cached value or MISSING if there isn't one. """
+    return get_backend().get(full_key(namespace, key))
+
+
+def get(namespace, key, default=None):
+    """ Return the cached value or the default if there isn't one. """
+    value = lookup(namespace, key)
+    if value is MISSING:
+        return default
+    return value
+
+
+def put(namespace, key, value, ttl=None):
+    """ Cache the value, using the namespace's TTL unless one is given. """
+    put_many(namespace, {key: value}, ttl)
+
+
+def put_many(namespace, mapping, ttl=None):
+    """ Cache all of the keys and values in the mapping in one operation. """
+    if mapping == {}:
+        return
+    if ttl is None:
+        ttl = ttl_for(namespace)
+    if RECORDING is not None:
+        RECORDING.setdefault(namespace, {}).update(mapping)
+    get_backend().set_many(
+        {full_key(namespace, key): value for key, value in mapping.items()},
+        ttl)
+
+
+def delete(namespace, key):
+    """ Remove the key from the cache. """
+    get_backend().delete(full_key(namespace, key))
+
+
+def clear(namespace):
+    """ Remove everything cached in the namespace. """
+    get_backend().clear(f"{KEY_PREFIX}:{namespace}:")
+
+
+def cached(namespace, key, loader, cache_none=False):
+    """
+    Return the cached value for the key, calling loader() and caching the
+    result if there isn't one. None is only cached if cache_none is True.
+    """
+    value = lookup(namespace, key)
+    if value is not MISSING:
+        return value
+    value = loader()
+    if value is not None or cache_none:
+        put(namespace, key, value)
+    return value
+
+
+def start_recording():
+    """ Start recording everything put into the cache. """
+    global RECORDING  # pylint: disable=global-statement
+    RECORDING = {}
+
+
+def stop_recording():
+    """ Stop recording and return the recorded snapshot. """
+    global RECORDING  # pylint: disable=global-statement
+    snapshot = {
+        "created": time.time(),
+        "namespaces": RECORDING
+    }
+    RECORDING = None
+    return snapshot
+
+
+def write_snapshot(snapshot, filename):
+    """ Write a snapshot out as JSON. """
+    with open(filename, "w", encoding="utf-8") as handle:
+        json.dump(snapshot, handle)
+
+
+def load_snapshot(filename, max_age=None):
+    """
+    Put everything in the snapshot into the cache. Entries get their
+    namespace's full TTL from now, because the snapshot is usually loaded
+    long after warm_cache.py wrote it. A snapshot older than max_age
+    seconds is skipped.
+    """
+    with open(filename, encoding="utf-8") as handle:
+        snapshot = json.load(handle)
+    if max_age is not None and time.time() - snapshot["created"] > max_age:
+        print(f"Cache snapshot {filename} is more than {max_age}s old; ignoring it")
+        return 0
+    loaded = 0
+    for namespace, mapping in snapshot["namespaces"].items():
+        put_many(namespace, mapping)
+        loaded += len(mapping)
+    return loaded
+
+
+def load_configured_snapshot():
+    """
+    Load the snapshot named by "cache_snapshot_file", once per process.
+    A missing or unreadable snapshot just means starting with a cold cache.
+    """
+    global SNAPSHOT_LOADED  # pylint: disable=global-statement
+    if SNAPSHOT_LOADED:
+        return
+    SNAPSHOT_LOADED = True
+    filename = shared.globals.config("cache_snapshot_file")
+    if filename is None:
+        return
+    try:
+        loaded = load_snapshot(
+            filename, shared.globals.config("cache_snapshot_max_age"))
+    except (OSError, ValueError, KeyError) as exc:
+        print(f"Unable to load cache snapshot {filename}: {exc}")
+        return
+    print(f"Loaded {loaded} cache entries from {filename}")
@@ -9,33 +9,132 @@ Two approaches:
 2. Use the Server or Cloud REST API to find the custom field with the
    required name.
 
-For option 2, the cache file is updated since it avoids a round-trip to the
-server.
+For option 2, the whole field list is fetched in one request and every field
+is added to the cache file, so a cold cache only costs a single round-trip
+to the server.
 
 The configured Service Desk account must have sufficient permissions to use
 the REST APIs if they are enabled.
 """
 
+import collections
+import contextlib
+import fcntl
 import os
 import json
+import tempfile
+import threading
+import time
 import requests
+import shared.cache
 import shared.globals
 
 
 # Not in "globals" because only this module needs to reference it.
 CF_CACHE = None
+# Every field name known to the server, mapped to all of the IDs using that
+# name. Only populated once the catalogue has been fetched.
+CF_CATALOGUE = None
+# When (in time.monotonic() seconds) the catalogue was last fetched.
+CF_CATALOGUE_LOADED = None
+# The modification time and size of the cache file when it was last read or
+# written by this process. Used to spot when another process has updated it.
+CF_CACHE_STAMP = None
+# Names that the server doesn't know about, mapped to when that answer
+# expires (in time.monotonic() seconds).
+CF_MISSING = {}
+# How long to remember that a name couldn't be found, if not configured.
+DEFAULT_NEGATIVE_TTL = 300
+# A negative entry hit in the last part of its life triggers a background
+# refresh of the catalogue so that the next lookup after expiry doesn't
+# have to wait for it.
+REFRESH_AHEAD_FRACTION = 0.2
+REFRESH_LOCK = threading.Lock()
+REFRESH_THREAD = None
+# Held while the catalogue is loaded so that a webhook and the background
+# refresh don't both load it, and update the cache, at the same time.
+CATALOGUE_LOCK = threading.RLock()
+CF_METRICS = {
+    "catalogue_loads": 0,
+    "negative_hits": 0,
+    "refresh_ahead": 0,
+    "misses": collections.Counter()
+}
+
+
+def cf_cachefile_stamp():
+    """ Return a cheap "version" of the cache file, or None if there isn't one. """
+    try:
+        stat = os.stat(shared.globals.CONFIGURATION["cf_cachefile"])
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+@contextlib.contextmanager
+def cf_cachefile_lock(exclusive):
+    """
+    Hold an advisory lock on the cache file while it is read or rewritten.
+
+    A separate lock file is used because the cache file itself gets
+    replaced on every write. Only writers create the lock file. If it
+    doesn't exist or can't be created (e.g. under Lambda, where the file
+    system is read-only), carry on unlocked since nothing can have written
+    the cache file in that case anyway.
+    """
+    flags = os.O_RDWR | os.O_CREAT if exclusive else os.O_RDWR
+    try:
+        lock_fd = os.open(
+            shared.globals.CONFIGURATION["cf_cachefile"] + ".lock",
+            flags,
+            0o644)
+    except OSError:
+        yield
+        return
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        os.close(lock_fd)
+
+
+def read_cf_cachefile():
+    """ Read the cache file, returning an empty cache if it is missing or corrupt. """
+    if not os.path.isfile(shared.globals.CONFIGURATION["cf_cachefile"]):
+        return {}
+    try:
+        with open(shared.globals.CONFIGURATION["cf_cachefile"], "r") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        print("WARNING! Unable to read the custom field cache file")
+        return {}
 
 
 def initialise_cf_cache():
     """ Initialise the cache of field names to IDs. """
-    global CF_CACHE  # pylint: disable=global-statement
+    global CF_CACHE, CF_CACHE_STAMP  # pylint: disable=global-statement
     if CF_CACHE is None:
         # Load the cache from the file
-        if os.path.isfile(shared.globals.CONFIGURATION["cf_cachefile"]):
-            with open(shared.globals.CONFIGURATION["cf_cachefile"], "r") as handle:
-                CF_CACHE = json.load(handle)
-        else:
-            CF_CACHE = {}
+        with cf_cachefile_lock(False):
+            CF_CACHE = read_cf_cachefile()
+            CF_CACHE_STAMP = cf_cachefile_stamp()
+
+
+def reload_cf_cache_if_changed():
+    """
+    If another process has rewritten the cache file since we last looked
+    at it, merge its entries into ours. Returns True if the file changed.
+    """
+    global CF_CACHE_STAMP  # pylint: disable=global-statement
+    stamp = cf_cachefile_stamp()
+    if stamp is None or stamp == CF_CACHE_STAMP:
+        return False
+    with cf_cachefile_lock(False):
+        on_disk = read_cf_cachefile()
+        CF_CACHE_STAMP = cf_cachefile_stamp()
+    for name, value in on_disk.items():
+        CF_CACHE.setdefault(name, value)
+    return True
 
 
 def service_desk_request_get(url):
@@ -48,55 +147,262 @@ def service_desk_request_get(url):
     return requests.get(url, headers=headers)
 
 
-def get_customfield_id_from_server(field_name):
-    """ Use the Server REST API to find the ID for a given CF name. """
-    start_at = 1
+def get_customfield_catalogue_from_server():
+    """ Use the Server REST API to retrieve every custom field definition. """
+    fields = []
+    # startAt is the offset of the first field wanted, not a page number.
+    start_at = 0
     is_last = False
     while not is_last:
         result = service_desk_request_get(
             "%s/rest/api/2/customFields?startAt=%s" % (shared.globals.ROOT_URL, start_at))
         data = result.json()
-        for field in data["values"]:
-            if field["name"] == field_name:
-                return field["id"]
-        is_last = data["isLast"]
-        start_at += 1
-    return None
+        fields += data["values"]
+        # Stop if the server returns an empty page rather than loop forever.
+        is_last = data["isLast"] or data["values"] == []
+        start_at += len(data["values"])
+    return fields
 
 
-def get_customfield_id_from_cloud(field_name):
-    """ Use the Cloud REST API to find the ID for a given CF name. """
+def get_customfield_catalogue_from_cloud():
+    """ Use the Cloud REST API to retrieve every field definition. """
     result = service_desk_request_get(
         "%s/rest/api/3/field" % shared.globals.ROOT_URL)
     if result.status_code != 200:
-        print("Unable to retrieve %s from Cloud" % field_name)
+        print("Unable to retrieve the field list from Cloud")
         return None
-    data = result.json()
-    for field in data:
-        if field["name"] == field_name:
-            return field["id"]
-    print(f"WARNING! Unable to find custom field called {field_name}")
-    return None
+    return result.json()
 
 
-def fetch_cf_value(name):
-    """ If the specified name is not in the cache, look it up to get the ID. """
-    value = None
-    # Are we using the REST API?
+def index_catalogue(fields):
+    """
+    Build a mapping of field name to a list of matching field IDs.
+
+    Jira allows more than one field to have the same name so every ID is
+    kept, in the order the server returned them. The first ID is the one
+    that get() returns, which matches the behaviour of the old linear
+    scan. Cloud also returns the untranslated name and the JQL clause
+    names for each field; these are indexed as well so that a field can
+    be found by any of them, but they never take precedence over a field
+    whose actual name matches.
+    """
+    index = {}
+    variants = {}
+    for field in fields:
+        ids = index.setdefault(field["name"], [])
+        if field["id"] not in ids:
+            ids.append(field["id"])
+        aliases = field.get("clauseNames", [])
+        if "untranslatedName" in field:
+            aliases = [field["untranslatedName"]] + aliases
+        for alias in aliases:
+            ids = variants.setdefault(alias, [])
+            if alias != field["name"] and field["id"] not in ids:
+                ids.append(field["id"])
+    for name, ids in variants.items():
+        if ids != [] and name not in index:
+            index[name] = ids
+    return index
+
+
+def fetch_cf_catalogue():
+    """ Retrieve and index the full field list using the configured API. """
+    fields = None
     if shared.globals.CONFIGURATION["cf_use_server_api"]:
-        value = get_customfield_id_from_server(name)
+        fields = get_customfield_catalogue_from_server()
     elif shared.globals.CONFIGURATION["cf_use_cloud_api"]:
-        value = get_customfield_id_from_cloud(name)
-    # Only save it away if it is a value
+        fields = get_customfield_catalogue_from_cloud()
+    if fields is None:
+        return None
+    return index_catalogue(fields)
+
+
+def cf_cachefile_mode(filename):
+    """ Return the permissions to give the cache file: the existing ones or 0644. """
+    try:
+        return os.stat(filename).st_mode & 0o777
+    except OSError:
+        return 0o644
+
+
+def save_cf_cache():
+    """
+    Merge the cache with the cache file and write it back out.
+
+    Several processes (e.g. mod_wsgi daemons) can share the same cache file
+    so, while holding the lock, anything another process has added is merged
+    in before the file is written to a temporary file and renamed over the
+    original. Readers therefore only ever see a complete file.
+    """
+    global CF_CACHE_STAMP  # pylint: disable=global-statement
+    filename = shared.globals.CONFIGURATION["cf_cachefile"]
+    # Note that when running under Lambda, it is read-only, hence the
+    # try/catch
+    try:
+        with cf_cachefile_lock(True):
+            for name, value in read_cf_cachefile().items():
+                CF_CACHE.setdefault(name, value)
+            handle, temp_name = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(filename)),
+                prefix=".cf_cachefile.")
+            try:
+                # mkstemp makes the file private to us, which would stop
+                # processes running as other users from reading it.
+                os.fchmod(handle, cf_cachefile_mode(filename))
+                with os.fdopen(handle, "w") as temp_file:
+                    # Write a copy in case another thread adds to the cache.
+                    json.dump(dict(CF_CACHE), temp_file)
+                os.replace(temp_name, filename)
+            except BaseException:
+                os.unlink(temp_name)
+                raise
+            CF_CACHE_STAMP = cf_cachefile_stamp()
+    except OSError:
+        return
+
+
+def load_cf_catalogue():
+    """
+    Fetch the full field list in one request and add every field to the
+    cache, saving the cache file once rather than once per field.
+
+    Entries that are already in the cache are left alone so that any
+    hand-edited mappings in the cache file continue to take precedence.
+    """
+    global CF_CATALOGUE, CF_CATALOGUE_LOADED  # pylint: disable=global-statement
+    with CATALOGUE_LOCK:
+        initialise_cf_cache()
+        CF_METRICS["catalogue_loads"] += 1
+        index = fetch_cf_catalogue()
+        if index is None:
+            return False
+        CF_CATALOGUE = index
+        CF_CATALOGUE_LOADED = time.monotonic()
+        added = False
+        for name, ids in index.items():
+            if name not in CF_CACHE:
+                CF_CACHE[name] = ids[0]
+                added = True
+        if added:
+            save_cf_cache()
+        # Share the results with other processes and nodes, which is the only
+        # way to do so when the cache file can't be written.
+        shared.cache.put_many(
+            "custom_fields",
+            {shared_cache_key(name): CF_CACHE[name] for name in index})
+        return True
+
+
+def shared_cache_key(name):
+    """ Field IDs vary between Jira instances so include the instance in the key. """
+    return f"{shared.globals.ROOT_URL}|{name}"
+
+
+def load_from_shared_cache(name):
+    """ Copy the field's ID from the shared cache if it is there. """
+    value = shared.cache.get("custom_fields", shared_cache_key(name))
     if value is not None:
         CF_CACHE[name] = value
-        # And resave to file. Note that when running under Lambda, it is
-        # read-only, hence the try/catch
-        try:
-            with open(shared.globals.CONFIGURATION["cf_cachefile"], "w") as handle:
-                json.dump(CF_CACHE, handle)
-        except OSError:
+
+
+def negative_ttl():
+    """ How long, in seconds, to remember that a name couldn't be found. """
+    ttl = shared.globals.config("cf_negative_ttl")
+    if ttl is None:
+        return DEFAULT_NEGATIVE_TTL
+    return ttl
+
+
+def is_known_missing(name):
+    """
+    Check for an unexpired negative entry for the name. If the entry is
+    close to expiring, refresh the catalogue in the background.
+    """
+    expiry = CF_MISSING.get(name)
+    if expiry is None:
+        return False
+    remaining = expiry - time.monotonic()
+    if remaining <= 0:
+        CF_MISSING.pop(name, None)
+        return False
+    CF_METRICS["negative_hits"] += 1
+    if remaining < negative_ttl() * REFRESH_AHEAD_FRACTION:
+        start_refresh_ahead()
+    return True
+
+
+def start_refresh_ahead():
+    """ Start refreshing the catalogue in the background if not already doing so. """
+    global REFRESH_THREAD  # pylint: disable=global-statement
+    with REFRESH_LOCK:
+        if REFRESH_THREAD is not None and REFRESH_THREAD.is_alive():
             return
+        REFRESH_THREAD = threading.Thread(
+            target=refresh_missing, name="cf-refresh-ahead", daemon=True)
+        REFRESH_THREAD.start()
+
+
+def refresh_missing():
+    """
+    Reload the catalogue and either drop the negative entries for names
+    that now exist or give the rest a fresh lease.
+    """
+    CF_METRICS["refresh_ahead"] += 1
+    if not load_cf_catalogue():
+        return
+    expiry = time.monotonic() + negative_ttl()
+    for name in list(CF_MISSING):
+        if name in CF_CACHE:
+            CF_MISSING.pop(name, None)
+        else:
+            CF_MISSING[name] = expiry
+
+
+def catalogue_is_fresh():
+    """ Has the catalogue been fetched within the negative TTL? """
+    return (CF_CATALOGUE_LOADED is not None and
+            time.monotonic() - CF_CATALOGUE_LOADED < negative_ttl())
+
+
+def fetch_cf_value(name):
+    """ If the specified name is not in the cache, load the catalogue to get the ID. """
+    # The catalogue lists every field so, if it has been fetched recently,
+    # there is no point fetching it again just to find the name missing.
+    if not catalogue_is_fresh():
+        with CATALOGUE_LOCK:
+            # The background refresh may have loaded it while we waited.
+            if not catalogue_is_fresh() and load_cf_catalogue() and name not in CF_CACHE:
+                print(f"WARNING! Unable to find custom field called {name}")
+    # Only remember that the name is missing if the catalogue says so, not
+    # because Jira couldn't be asked.
+    if name not in CF_CACHE and catalogue_is_fresh():
+        CF_MISSING[name] = time.monotonic() + negative_ttl()
+
+
+def cf_metrics():
+    """ Return a snapshot of the lookup metrics, including misses per name. """
+    return {
+        "catalogue_loads": CF_METRICS["catalogue_loads"],
+        "negative_hits": CF_METRICS["negative_hits"],
+        "refresh_ahead": CF_METRICS["refresh_ahead"],
+        "negative_entries": len(CF_MISSING),
+        "misses": dict(CF_METRICS["misses"])
+    }
+
+
+def get_ids(name):
+    """
+    Get all of the IDs for fields with the given name. Jira does not
+    enforce unique field names, so this can return more than one ID.
+    """
+    if CF_CATALOGUE is None and not is_known_missing(name):
+        fetch_cf_value(name)
+    if CF_CATALOGUE is not None and name in CF_CATALOGUE:
+        return list(CF_CATALOGUE[name])
+    value = get(name)
+    if value is None:
+        return []
+    return [value]
 
 
 def get(name):
@@ -104,7 +410,13 @@ def get(name):
     global CF_CACHE  # pylint: disable=global-statement
     initialise_cf_cache()
     if name not in CF_CACHE:
+        # Another process may have looked it up already.
+        reload_cf_cache_if_changed()
+    if name not in CF_CACHE:
+        load_from_shared_cache(name)
+    if name not in CF_CACHE and not is_known_missing(name):
         fetch_cf_value(name)
     if name in CF_CACHE:
         return CF_CACHE[name]
+    CF_METRICS["misses"][name] += 1
     return None
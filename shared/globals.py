@@ -4,6 +4,8 @@ import base64
 import json
 import os
 import sys
+import threading
+import time
 
 from json_minify import json_minify
 
@@ -20,6 +22,19 @@ TICKET = None
 PROJECT = None
 REPORTER = None
 
+# The SD credentials are fetched at most once every "sd_credential_refresh"
+# seconds and refreshed in the background once most of that has passed, so
+# that webhooks don't wait for the secret store.
+DEFAULT_CREDENTIAL_REFRESH = 3600
+CREDENTIAL_REFRESH_AHEAD = 0.8
+SD_CREDENTIALS = None
+SD_CREDENTIALS_LOCK = threading.Lock()
+SD_REFRESH_THREAD = None
+SD_REFRESH_LOCK = threading.Lock()
+
+# The configuration entries naming secrets kept in AWS SSM.
+SSM_SECRETS = ["ssm_bot_name", "ssm_ldap_name", "ssm_mail_name", "ssm_google_name"]
+
 # pylint: disable=global-statement
 
 class SharedGlobalsError(Exception):
@@ -133,9 +148,30 @@ def get_ldap_credentials():
     return CONFIGURATION["ldap_user"], CONFIGURATION["ldap_password"]
 
 
+def prefetch_secrets():
+    """
+    Fetch all of the secrets kept in AWS SSM in one go, so that the other
+    credentials are already to hand when they are needed. This is only an
+    optimisation so failures are logged and ignored.
+    """
+    names = [CONFIGURATION[key] for key in SSM_SECRETS if key in CONFIGURATION]
+    if names == []:
+        return
+    # Only imported here because boto3 is slow to import.
+    # pylint: disable=import-outside-toplevel
+    from botocore.exceptions import BotoCoreError, ClientError
+    try:
+        shared_ssm.get_parameters(names)
+    except (BotoCoreError, ClientError, ValueError) as exc:
+        # e.g. the role can't read one of them. Each secret is fetched on
+        # its own when it is needed instead.
+        print(f"Unable to prefetch the secrets: {exc}", file=sys.stderr)
+
+
 def get_sd_credentials():
     """ Retrieve the credentials required by SD_AUTH """
     if "bot_password" not in CONFIGURATION:
+        prefetch_secrets()
         # Try API key first
         pwd = shared_ssm.get_secret(CONFIGURATION["ssm_bot_name"], "api-token")
         if pwd is None:
@@ -156,16 +192,89 @@ def get_email_credentials():
 
 
 
-def initialise_sd_auth():
-    """ Initialise the SD_AUTH global. """
-    global SD_AUTH
+def build_sd_auth():
+    """ Fetch the SD credentials and build the Basic auth token from them. """
     name, password = get_sd_credentials()
     # Construct a string of the form username:password
     combo = f"{name}:{password}"
     # Encode it to Base64
     combo_bytes = combo.encode('ascii')
     base64_bytes = base64.b64encode(combo_bytes)
-    SD_AUTH = base64_bytes.decode('ascii')
+    return base64_bytes.decode('ascii')
+
+
+def sd_credential_source():
+    """
+    The configuration that the credentials come from. A change to it (the
+    configuration is re-read for every event) means fetching them again.
+    """
+    return [config(key) for key in ("bot_name", "bot_password", "ssm_bot_name")]
+
+
+def store_sd_auth(source, auth):
+    """ Cache the Basic auth token. """
+    global SD_CREDENTIALS
+    SD_CREDENTIALS = {
+        "source": source,
+        "auth": auth,
+        "fetched": time.time()
+    }
+    return auth
+
+
+def load_sd_auth(source):
+    """ Fetch the credentials and cache them. """
+    return store_sd_auth(source, build_sd_auth())
+
+
+def refresh_sd_auth(source):
+    """ Fetch the credentials in the background, keeping the old ones on failure. """
+    # The fetch is done without holding the lock so that webhooks carry on
+    # using the cached credentials in the meantime.
+    try:
+        auth = build_sd_auth()
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"Unable to refresh the SD credentials: {exc}", file=sys.stderr)
+        return
+    with SD_CREDENTIALS_LOCK:
+        store_sd_auth(source, auth)
+
+
+def start_sd_auth_refresh(source):
+    """ Start refreshing the credentials if not already doing so. """
+    global SD_REFRESH_THREAD
+    with SD_REFRESH_LOCK:
+        if SD_REFRESH_THREAD is not None and SD_REFRESH_THREAD.is_alive():
+            return
+        SD_REFRESH_THREAD = threading.Thread(
+            target=refresh_sd_auth, args=(source,), name="sd-credential-refresh", daemon=True)
+        SD_REFRESH_THREAD.start()
+
+
+def get_sd_auth():
+    """
+    Return the Basic auth token for the SD credentials, fetching them if
+    they aren't cached or have expired.
+    """
+    refresh = config("sd_credential_refresh") or DEFAULT_CREDENTIAL_REFRESH
+    source = sd_credential_source()
+    cached = SD_CREDENTIALS
+    if cached is None or cached["source"] != source or \
+            time.time() - cached["fetched"] >= refresh:
+        with SD_CREDENTIALS_LOCK:
+            cached = SD_CREDENTIALS
+            if cached is None or cached["source"] != source or \
+                    time.time() - cached["fetched"] >= refresh:
+                return load_sd_auth(source)
+    elif time.time() - cached["fetched"] >= refresh * CREDENTIAL_REFRESH_AHEAD:
+        start_sd_auth_refresh(source)
+    return cached["auth"]
+
+
+def initialise_sd_auth():
+    """ Initialise the SD_AUTH global. """
+    global SD_AUTH
+    SD_AUTH = get_sd_auth()
 
 
 def config(key):
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+"""
+An optional, in-memory replica of the accounts and mailing groups in LDAP.
+
+When "ldap_replica_enabled" is set, the replica is loaded with a paged
+search the first time it is needed. After that, every
+"ldap_replica_refresh" seconds, a background thread fetches the entries
+whose modifyTimestamp is at or after the newest one seen. Deltas can't
+report deletions, so the whole replica is reloaded every
+"ldap_replica_full_reload" seconds. The framework's own changes are
+applied straight away.
+
+shared_ldap answers reads from the replica while the last successful sync
+is no older than "ldap_replica_max_staleness" seconds, and goes back to
+LDAP otherwise.
+"""
+
+import threading
+import time
+
+import shared.globals
+import shared.shared_ldap as shared_ldap
+
+DEFAULT_REFRESH = 60
+DEFAULT_FULL_RELOAD = 3600
+DEFAULT_MAX_STALENESS = 900
+REPLICA_FILTER = "(|(objectClass=posixAccount)(objectClass=groupOfUniqueNames))"
+# The attributes held for each entry. They cover the framework's own reads.
+ATTRIBUTES = [
+    "objectClass", "cn", "uid", "mail", "aRecord", "uniqueMember",
+    "memberUid", "owner", "manager", "displayName", "description",
+    "modifyTimestamp"
+]
+# The attributes that can be read from the replica.
+READABLE = {name.lower() for name in ATTRIBUTES} - {"modifytimestamp"}
+# Attributes that entries can be found by.
+INDEXED = ["cn", "uid", "mail", "arecord"]
+
+
+class DirectoryReplica:
+    """ The replicated entries, indexed by DN and by the INDEXED attributes. """
+
+    def __init__(
+            self,
+            base,
+            refresh_interval=DEFAULT_REFRESH,
+            full_reload_interval=DEFAULT_FULL_RELOAD,
+            max_staleness=DEFAULT_MAX_STALENESS):
+        self.base = base
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self.max_staleness = max_staleness
+        # DN (lower-cased) -> attribute name (lower-cased) -> list of values
+        self.entries = {}
+        self.dns = {}
+        # Attribute -> value (lower-cased) -> set of DNs (lower-cased)
+        self.index = {attribute: {} for attribute in INDEXED}
+        self.high_water = None
+        self.synced_at = None
+        self.full_loaded_at = None
+        self.sync_due = False
+        self.thread = None
+        self.lock = threading.RLock()
+        self.metrics = {
+            "full_loads": 0,
+            "delta_syncs": 0,
+            "sync_failures": 0,
+            "entries_changed": 0,
+            "hits": 0,
+            "misses": 0
+        }
+
+    def fetch(self, ldap_filter):
+        """ Return the entries matching the filter, a page at a time. """
+        return shared_ldap.paged_search(
+            f"(&{REPLICA_FILTER}{ldap_filter})", ATTRIBUTES, self.base)
+
+    def unindex(self, key):
+        """ Remove an entry from the indexes. """
+        attributes = self.entries.get(key, {})
+        for name in INDEXED:
+            for value in attributes.get(name, []):
+                dns = self.index[name].get(str(value).lower())
+                if dns is not None:
+                    dns.discard(key)
+                    if not dns:
+                        del self.index[name][str(value).lower()]
+
+    def store(self, entry_dn, attributes):
+        """ Add or replace an entry. """
+        key = entry_dn.lower()
+        self.unindex(key)
+        self.entries[key] = attributes
+        self.dns[key] = entry_dn
+        for name in INDEXED:
+            for value in attributes.get(name, []):
+                self.index[name].setdefault(str(value).lower(), set()).add(key)
+
+    def store_entries(self, entries):
+        """ Store entries from LDAP, tracking the newest modifyTimestamp. """
+        for entry in entries:
+            attributes = {name.lower(): [] for name in ATTRIBUTES}
+            for name, values in entry.entry_attributes_as_dict.items():
+                attributes[name.lower()] = list(values)
+            stamps = attributes.pop("modifytimestamp")
+            self.store(entry.entry_dn, attributes)
+            if stamps != []:
+                stamp = shared_ldap.generalized_time(stamps[0])
+                if self.high_water is None or stamp > self.high_water:
+                    self.high_water = stamp
+        self.metrics["entries_changed"] += len(entries)
+
+    def sync(self):
+        """ Fetch the changes, or everything if a full reload is due. """
+        now = time.time()
+        full = self.full_loaded_at is None or self.high_water is None or \
+            now - self.full_loaded_at >= self.full_reload_interval
+        try:
+            if full:
+                entries = self.fetch("")
+            else:
+                entries = self.fetch(f"(modifyTimestamp>={self.high_water})")
+        except Exception as exc:  # pylint: disable=broad-except
+            self.metrics["sync_failures"] += 1
+            print(f"Unable to sync the LDAP replica: {exc}")
+            return False
+        with self.lock:
+            if full:
+                self.entries = {}
+                self.dns = {}
+                self.index = {attribute: {} for attribute in INDEXED}
+                self.high_water = None
+                self.full_loaded_at = now
+                self.metrics["full_loads"] += 1
+            else:
+                self.metrics["delta_syncs"] += 1
+            self.store_entries(entries)
+            self.synced_at = now
+            self.sync_due = False
+        return True
+
+    def is_due(self):
+        """ Is it time to check for changes? """
+        return self.sync_due or self.synced_at is None or \
+            time.time() - self.synced_at >= self.refresh_interval
+
+    def start_sync(self):
+        """ Start syncing in the background if not already doing so. """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(
+                target=self.sync, name="ldap-replica-sync", daemon=True)
+            self.thread.start()
+
+    def is_usable(self):
+        """ Is the replica fresh enough to answer reads? """
+        return self.synced_at is not None and \
+            time.time() - self.synced_at <= self.max_staleness
+
+    def entry(self, key):
+        """ Return a copy of the entry as a CachedEntry. """
+        attributes = {name: list(values) for name, values in self.entries[key].items()}
+        return shared_ldap.CachedEntry(self.dns[key], attributes)
+
+    def get(self, object_dn, attributes):
+        """
+        Return the entry for the DN, or None if it isn't replicated or the
+        attributes asked for aren't all held by the replica.
+        """
+        if attributes is None or \
+                not {name.lower() for name in attributes}.issubset(READABLE):
+            return None
+        with self.lock:
+            key = object_dn.lower()
+            if key not in self.entries:
+                self.metrics["misses"] += 1
+                return None
+            self.metrics["hits"] += 1
+            return self.entry(key)
+
+    def find(self, attribute, value):
+        """ Return the entries where the (indexed) attribute has the value. """
+        with self.lock:
+            keys = self.index[attribute.lower()].get(value.lower(), set())
+            return [self.entry(key) for key in sorted(keys)]
+
+    def forget(self, object_dn):
+        """ Remove an entry that has been deleted or moved. """
+        with self.lock:
+            key = object_dn.lower()
+            if key in self.entries:
+                self.unindex(key)
+                del self.entries[key]
+                del self.dns[key]
+
+    def apply_change(self, object_dn, attribute, added=(), removed=(), replaced=None):
+        """ Reflect a change that this process has made to an entry. """
+        with self.lock:
+            key = object_dn.lower()
+            name = attribute.lower()
+            if key not in self.entries:
+                return
+            attributes = {item: list(values) for item, values in self.entries[key].items()}
+            if replaced is not None:
+                values = list(replaced)
+            else:
+                dropped = {str(value).lower() for value in removed}
+                values = [
+                    value for value in attributes.get(name, [])
+                    if str(value).lower() not in dropped]
+                present = {str(value).lower() for value in values}
+                values += [value for value in added if str(value).lower() not in present]
+            attributes[name] = values
+            self.store(self.dns[key], attributes)
+            # Pick up anything else the server changed, e.g. operational attributes.
+            self.sync_due = True
+
+    def get_metrics(self):
+        """ Return the metrics, including how stale the replica is. """
+        with self.lock:
+            now = time.time()
+            result = dict(self.metrics)
+            result["entries"] = len(self.entries)
+            result["high_water"] = self.high_water
+            result["seconds_since_sync"] = \
+                None if self.synced_at is None else now - self.synced_at
+            result["seconds_since_full_load"] = \
+                None if self.full_loaded_at is None else now - self.full_loaded_at
+            result["usable"] = self.is_usable()
+            return result
+
+
+def create_replica():
+    """ Create the replica from the configuration and load it. """
+    replica = DirectoryReplica(
+        shared_ldap.base_dn(),
+        shared.globals.config("ldap_replica_refresh") or DEFAULT_REFRESH,
+        shared.globals.config("ldap_replica_full_reload") or DEFAULT_FULL_RELOAD,
+        shared.globals.config("ldap_replica_max_staleness") or DEFAULT_MAX_STALENESS
+    )
+    replica.sync()
+    return replica
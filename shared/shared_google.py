@@ -8,10 +8,13 @@ account must be used.
 https://developers.google.com/identity/protocols/oauth2/service-account
 """
 
+import threading
+
 from google.oauth2 import service_account
 import googleapiclient
 from googleapiclient.discovery import build
 
+import shared.cache
 import shared.globals
 
 SCOPES = [
@@ -22,6 +25,11 @@ SCOPES = [
     'https://www.googleapis.com/auth/admin.datatransfer',
     'https://www.googleapis.com/auth/spreadsheets'
 ]
+# Directory API clients, one per thread.
+SERVICES = threading.local()
+# How long, in seconds, to remember that an address isn't a group alias if
+# "ldap_negative_ttl" isn't configured. The same as for LDAP lookups.
+DEFAULT_NEGATIVE_TTL = 60
 
 def get_credentials():
     """ Build the Google credentials. """
@@ -29,26 +37,84 @@ def get_credentials():
     return service_account.Credentials.from_service_account_info(
         json_blob, scopes=SCOPES)
 
+def get_directory_service():
+    """
+    Return a Directory API client, building it the first time it is needed
+    in each thread. Building one means creating delegated credentials and
+    a discovery client, so it is reused. The underlying HTTP connection
+    isn't thread-safe, which is why each thread gets its own.
+    """
+    service = getattr(SERVICES, "directory", None)
+    if service is None:
+        delegated_creds = get_credentials().with_subject(
+            shared.globals.CONFIGURATION["google_admin"])
+        # We don't cache the discovery because it generates warnings.
+        # https://stackoverflow.com/a/44518587/1233830
+        service = build(
+            'admin',
+            'directory_v1',
+            credentials=delegated_creds,
+            cache_discovery=False)
+        SERVICES.directory = service
+    return service
+
 def check_group_alias(email):
-    """ See if we can find a group on Google with the specified email address. """
+    """
+    See if we can find a group on Google with the specified email address.
+    Answers are cached. Not finding one is only cached for
+    "ldap_negative_ttl" seconds and errors from Google aren't cached.
+    """
     if shared.globals.config("google_enabled") in (None, False):
         return None
+    key = email.lower()
+    value = shared.cache.lookup("google_aliases", key)
+    if value is not shared.cache.MISSING:
+        return value
+    try:
+        value = lookup_group_alias(email)
+    except googleapiclient.errors.HttpError as exc:
+        print(f"Unable to look up {email} on Google: {exc}")
+        return None
+    if value is None:
+        ttl = shared.globals.config("ldap_negative_ttl") or DEFAULT_NEGATIVE_TTL
+        shared.cache.put("google_aliases", key, None, ttl)
+    else:
+        shared.cache.put("google_aliases", key, value)
+    return value
 
-    delegated_creds = get_credentials().with_subject(shared.globals.CONFIGURATION["google_admin"])
+def lookup_group_alias(email):
+    """
+    Ask Google for the group with the specified email address. Returns
+    None if there isn't one; other errors are raised.
+    """
     try:
-        # We don't cache the discovery because it generates warnings.
-        # https://stackoverflow.com/a/44518587/1233830
-        with build(
-                'admin',
-                'directory_v1',
-                credentials=delegated_creds,
-                cache_discovery=False) as service:
-            response = service.groups().get(groupKey=email).execute()
-            if "aliases" in response:
-                # There are aliases on this group. We only care if there are
-                # aliases because the caller will already have checked LDAP,
-                # so groups without aliases will match on the LDAP test.
-                return response["email"]
-    except googleapiclient.errors.HttpError:
-        pass
+        response = get_directory_service().groups().get(groupKey=email).execute()
+    except googleapiclient.errors.HttpError as exc:
+        if exc.resp.status == 404:
+            return None
+        raise
+    if "aliases" in response:
+        # There are aliases on this group. We only care if there are
+        # aliases because the caller will already have checked LDAP,
+        # so groups without aliases will match on the LDAP test.
+        return response["email"]
     return None
+
+def list_group_aliases():
+    """
+    Return a dict of alias -> group email address for every group on
+    Google that has aliases, and cache them for check_group_alias.
+    """
+    if shared.globals.config("google_enabled") in (None, False):
+        return {}
+    aliases = {}
+    groups = get_directory_service().groups()
+    request = groups.list(customer="my_customer", maxResults=200)
+    while request is not None:
+        response = request.execute()
+        for group in response.get("groups", []):
+            for alias in group.get("aliases", []):
+                aliases[alias.lower()] = group["email"]
+        request = groups.list_next(request, response)
+    shared.cache.put_many("google_aliases", aliases)
+    return aliases
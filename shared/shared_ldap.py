@@ -8,44 +8,270 @@ the functions required, e.g. creating accounts.
 
 # pylint: disable=no-member, broad-except
 
+import atexit
+import collections
+import contextlib
+import datetime
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from ldap3 import (BASE, DSA, LEVEL, MODIFY_ADD, MODIFY_DELETE, MODIFY_REPLACE,
-                   SUBTREE, Connection, Server)
+                   RESTARTABLE, SUBTREE, Connection, Server)
+from ldap3.core.exceptions import LDAPCommunicationError
+from ldap3.utils.conv import escape_filter_chars
 from unidecode import unidecode
 
+import shared.cache
 import shared.globals
-from shared import shared_google
 
 MAILING_OU = ",ou=mailing,"
 CN_PATH = "cn=%s,%s"
 
+DEFAULT_POOL_SIZE = 4
+DEFAULT_POOL_TIMEOUT = 30
+# Idle connections are checked before being handed out if they haven't
+# been used for this many seconds.
+POOL_CHECK_INTERVAL = 60
+
 
 class NotEnabledError(Exception):
     """ LDAP not enabled exception. """
 
 
-CONNECTION = None
+class PoolExhaustedError(Exception):
+    """ No LDAP connection became free in time. """
+
+
+POOL = None
+POOL_LOCK = threading.Lock()
 BASE_DN = None
+# The highest uidNumber/gidNumber known to be in use or reserved by this
+# process, keyed by attribute name.
+ID_HIGH_WATER = {}
+ID_LOCK = threading.Lock()
+ID_COUNTER_RETRIES = 10
+UID_CREATE_ATTEMPTS = 5
+# LDAP result codes
+NO_SUCH_ATTRIBUTE = 16
+ATTRIBUTE_OR_VALUE_EXISTS = 20
+ENTRY_ALREADY_EXISTS = 68
+# Per-member outcomes of group changes
+MEMBER_ADDED = "added"
+MEMBER_REMOVED = "removed"
+MEMBER_PRESENT = "already present"
+MEMBER_ABSENT = "already absent"
+MEMBER_FAILED = "failed"
+# How often, in seconds, the mailing group graph is checked for changes.
+DEFAULT_GROUP_REFRESH = 300
+GROUP_GRAPH = None
+GROUP_GRAPH_LOCK = threading.Lock()
+MANAGER_GRAPH = None
+MANAGER_GRAPH_LOCK = threading.Lock()
+# How long, in seconds, to remember that an email address has no object.
+DEFAULT_NEGATIVE_TTL = 60
+# Attributes whose values are the keys of cached lookups (see
+# find_from_email, find_single_object_from_email and resolve_group).
+LOOKUP_ATTRIBUTES = ["mail", "aRecord", "cn"]
+# Runs batches of lookups concurrently, one pooled connection per worker.
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+DEFAULT_PAGE_SIZE = 500
+PAGED_RESULTS_OID = "1.2.840.113556.1.4.319"
+# The directory replica (see ldap_replica), if enabled.
+REPLICA = None
+REPLICA_LOCK = threading.Lock()
+
+
+class LdapConnectionPool:
+    """
+    A bounded pool of bound LDAP connections.
 
+    Each connection is only used by one thread at a time, so concurrent
+    requests no longer share a socket or a result buffer (conn.entries).
+    A thread that already holds a connection gets the same one back if it
+    asks again, so helpers that call other helpers while holding a
+    connection can't deadlock the pool.
+    """
 
-def get_ldap_connection():
-    """ Return the shared LDAP connection, initialising first if required. """
-    global CONNECTION  # pylint: disable=global-statement
-    if CONNECTION is None:
+    def __init__(self, factory, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT):
+        self.factory = factory
+        self.size = size
+        self.timeout = timeout
+        self.idle = collections.deque()
+        self.created = 0
+        self.condition = threading.Condition()
+        self.local = threading.local()
+
+    @staticmethod
+    def is_healthy(conn):
+        """ Cheap check (no network traffic) that the connection is still usable. """
+        return not getattr(conn, "closed", False) and getattr(conn, "bound", True)
+
+    def rebind(self, conn):
+        """ Replace a connection that has failed with a new one. """
+        try:
+            conn.unbind()
+        except Exception:
+            pass
+        return self.factory()
+
+    def acquire(self):
+        """ Borrow a connection, waiting for one to become free if necessary. """
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while True:
+                if self.idle:
+                    last_used, conn = self.idle.pop()
+                    break
+                if self.created < self.size:
+                    self.created += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    raise PoolExhaustedError(
+                        f"No LDAP connection became free within {self.timeout}s")
+        try:
+            if conn is None:
+                conn = self.factory()
+            elif (time.monotonic() - last_used > POOL_CHECK_INTERVAL and
+                  not self.is_healthy(conn)):
+                conn = self.rebind(conn)
+        except Exception:
+            self.discard()
+            raise
+        return conn
+
+    def release(self, conn, broken=False):
+        """ Return a connection to the pool. Broken connections are rebound first. """
+        if broken:
+            try:
+                conn = self.rebind(conn)
+            except Exception:
+                self.discard()
+                return
+        with self.condition:
+            self.idle.append((time.monotonic(), conn))
+            self.condition.notify()
+
+    def discard(self):
+        """ Forget about a connection that couldn't be (re)created. """
+        with self.condition:
+            self.created -= 1
+            self.condition.notify()
+
+    def holds_connection(self):
+        """ Has the current thread borrowed a connection? """
+        return getattr(self.local, "conn", None) is not None
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Context manager that borrows a connection for the current thread. """
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            self.local.depth += 1
+            try:
+                yield conn
+            finally:
+                self.local.depth -= 1
+            return
+        conn = self.acquire()
+        self.local.conn = conn
+        self.local.depth = 1
+        broken = False
+        try:
+            yield conn
+        except LDAPCommunicationError:
+            broken = True
+            raise
+        finally:
+            self.local.conn = None
+            self.release(conn, broken)
+
+    def close(self):
+        """ Unbind all of the idle connections. """
+        with self.condition:
+            while self.idle:
+                _, conn = self.idle.pop()
+                self.created -= 1
+                try:
+                    conn.unbind()
+                except Exception:
+                    pass
+
+
+def create_ldap_connection():
+    """ Create and bind a new connection to the configured server. """
+    user, password = shared.globals.get_ldap_credentials()
+    server = Server(
+        shared.globals.config("ldap_server"),
+        get_info=DSA
+    )
+    # The restartable strategy transparently reopens and rebinds the
+    # connection if the server has dropped it while it was idle.
+    return Connection(
+        server,
+        user=user,
+        password=password,
+        auto_bind=True,
+        client_strategy=RESTARTABLE
+    )
+
+
+def get_ldap_pool():
+    """ Return the shared LDAP connection pool, initialising first if required. """
+    global POOL  # pylint: disable=global-statement
+    if POOL is None:
         enabled = shared.globals.config("ldap_enabled")
         if enabled is None or not enabled:
             raise NotEnabledError()
-        user, password = shared.globals.get_ldap_credentials()
-        server = Server(
-            shared.globals.config("ldap_server"),
-            get_info=DSA
-        )
-        CONNECTION = Connection(
-            server,
-            user=user,
-            password=password,
-            auto_bind=True
-        )
-    return CONNECTION
+        with POOL_LOCK:
+            if POOL is None:
+                POOL = LdapConnectionPool(
+                    create_ldap_connection,
+                    shared.globals.config("ldap_pool_size") or DEFAULT_POOL_SIZE,
+                    shared.globals.config("ldap_pool_timeout") or DEFAULT_POOL_TIMEOUT
+                )
+                atexit.register(POOL.close)
+    return POOL
+
+
+def get_ldap_connection():
+    """
+    Borrow a connection from the pool. This must be used as a context
+    manager, i.e. "with get_ldap_connection() as conn:".
+    """
+    return get_ldap_pool().connection()
+
+
+def get_executor():
+    """ Return the executor for batched lookups, creating it first if required. """
+    global EXECUTOR  # pylint: disable=global-statement
+    if EXECUTOR is None:
+        pool = get_ldap_pool()
+        with EXECUTOR_LOCK:
+            if EXECUTOR is None:
+                EXECUTOR = ThreadPoolExecutor(
+                    max_workers=pool.size, thread_name_prefix="ldap")
+                atexit.register(EXECUTOR.shutdown, wait=False)
+    return EXECUTOR
+
+
+def run_batch(function, items):
+    """
+    Call function(item) for every item, concurrently, and return a dict
+    of item -> result. Duplicate items are only looked up once.
+    """
+    items = list(dict.fromkeys(items))
+    # A thread holding a connection could leave the workers waiting for
+    # it, so run the batch in that thread instead.
+    if len(items) < 2 or get_ldap_pool().holds_connection():
+        return {item: function(item) for item in items}
+    # Make sure the base DN is known before the workers need it.
+    base_dn()
+    return dict(zip(items, get_executor().map(function, items)))
 
 
 def base_dn():
@@ -103,15 +329,40 @@ def search_filter(ldap_conn, ldap_filter, filter_param):
 
 def delete_object(entry_dn):
     """ Delete the specified object from LDAP """
+    values = lookup_values(entry_dn)
     with get_ldap_connection() as conn:
-        conn.delete(entry_dn)
+        deleted = conn.delete(entry_dn)
+    if deleted:
+        forget_entry(entry_dn)
+        forget_lookups(values)
+    # Only forget the entry if it has gone, as nothing would fetch it again.
+    if deleted and GROUP_GRAPH is not None:
+        GROUP_GRAPH.forget(entry_dn)
+    if deleted and REPLICA is not None:
+        REPLICA.forget(entry_dn)
+    if deleted and MANAGER_GRAPH is not None:
+        MANAGER_GRAPH.forget(entry_dn)
 
 
 def find_from_attribute(attribute, value):
     """
     Try to find a LDAP object where the specified attribute has the
-    specified value.
+    specified value. Only successful lookups are cached.
     """
+    return shared.cache.cached(
+        "ldap",
+        f"{attribute}={value}",
+        lambda: search_from_attribute(attribute, value)
+    )
+
+
+def search_from_attribute(attribute, value):
+    """ Search LDAP for an object where the attribute has the value. """
+    replica = get_replica()
+    if replica is not None and attribute.lower() in replica.index:
+        result = replica.find(attribute, value)
+        if result != []:
+            return result[0].entry_dn
     with get_ldap_connection() as conn:
         if search_filter(conn, attribute, value):
             return conn.entries[0].entry_dn
@@ -125,18 +376,23 @@ def find_from_email(email_address):
     return find_from_attribute("mail", email_address)
 
 
-def calculate_uid(firstname, lastname):
-    """
-    For a given firstname and lastname, work out a UID that doesn't already
-    exist in LDAP.
-    """
+def base_uid(firstname, lastname):
+    """ Build the uid for a name, before any numerical suffix is added. """
     uid = string_combo(firstname, lastname, ".").lower()
 
     # Remove bad characters
     uid = unidecode(uid)
     uid = uid.replace("'", "")
     uid = uid.replace(" ", "")
+    return uid
 
+
+def calculate_uid(firstname, lastname):
+    """
+    For a given firstname and lastname, work out a UID that doesn't already
+    exist in LDAP.
+    """
+    uid = base_uid(firstname, lastname)
     with get_ldap_connection() as conn:
         return get_best_uid(conn, uid)
 
@@ -145,22 +401,53 @@ def get_best_uid(connection, uid):
     """
     Search existing accounts to see if we need to bump the uid with
     an increasing numerical suffix.
+
+    A single search finds every uid starting with the desired one so
+    that the lowest free suffix can be worked out locally.
     """
-    got_uid = False
-    index = 0
-    while not got_uid:
-        search_uid = uid
-        if index != 0:
-            search_uid += str(index)
-        if connection.search(
-                base_dn(),
-                search_filter=f"(uid={search_uid})",
-                search_scope=SUBTREE):
-            index += 1
-        else:
-            uid = search_uid
-            got_uid = True
-    return uid
+    return lowest_free_uid(uid, find_uids_with_prefix(connection, [uid]))
+
+
+def find_uids_with_prefix(connection, prefixes):
+    """ Return the set of (lower-cased) uids in use that start with any of the prefixes. """
+    prefix_filter = "".join(
+        f"(uid={escape_filter_chars(prefix)}*)" for prefix in prefixes)
+    if len(prefixes) > 1:
+        prefix_filter = f"(|{prefix_filter})"
+    taken = set()
+    # A short prefix can match more entries than the server's size limit,
+    # so page through them rather than risk missing a taken uid.
+    for entry in iter_matching_objects(prefix_filter, ["uid"], connection=connection):
+        for value in entry.uid.values:
+            taken.add(value.lower())
+    return taken
+
+
+def calculate_uids(names):
+    """
+    Work out a uid for each (firstname, lastname) with a single search,
+    making sure that the uids are different from each other as well as
+    from those already in LDAP.
+    """
+    bases = [base_uid(firstname, lastname) for firstname, lastname in names]
+    with get_ldap_connection() as conn:
+        taken = find_uids_with_prefix(conn, list(dict.fromkeys(bases)))
+    uids = []
+    for uid in bases:
+        uid = lowest_free_uid(uid, taken)
+        taken.add(uid)
+        uids.append(uid)
+    return uids
+
+
+def lowest_free_uid(uid, taken):
+    """ Return uid, or uid with the lowest numerical suffix, that isn't taken. """
+    if uid not in taken:
+        return uid
+    index = 1
+    while f"{uid}{index}" in taken:
+        index += 1
+    return f"{uid}{index}"
 
 
 def find_best_ou_for_email(email_address):
@@ -184,47 +471,276 @@ def find_best_ou_for_email(email_address):
     )
 
 
+def find_best_ous_for_emails(email_addresses):
+    """
+    The bulk version of find_best_ou_for_email, making one search for all
+    of the domains. Returns a dict of email address -> OU.
+    """
+    domains = list(dict.fromkeys(
+        email_address.split("@")[1].lower() for email_address in email_addresses))
+    found = {}
+    domain_filter = "".join(f"(mail={escape_filter_chars(domain)})" for domain in domains)
+    with get_ldap_connection() as conn:
+        if conn.search(
+                f"ou=accounts,{base_dn()}",
+                search_filter=f"(|{domain_filter})",
+                search_scope=LEVEL,
+                attributes=["mail"]):
+            for entry in conn.entries:
+                for value in entry.mail.values:
+                    found.setdefault(value.lower(), entry.entry_dn)
+    default_ou = string_combo(
+        shared.globals.config("ldap_default_account_ou"),
+        base_dn(),
+        ","
+    )
+    return {
+        email_address: found.get(email_address.split("@")[1].lower(), default_ou)
+        for email_address in email_addresses
+    }
+
+
 def get_result_cookie(result):
     """ Safely retrieve the paging cookie from the search results. """
-    if ('controls' in result and
-            '1.2.840.113556.1.4.319' in result['controls'] and
-            'value' in result['controls']['1.2.840.113556.1.4.319'] and
-            'cookie' in result['controls']['1.2.840.113556.1.4.319']['value']['cookie']):
-        return result['controls']['1.2.840.113556.1.4.319']['value']['cookie']
-    return None
+    try:
+        cookie = result['controls'][PAGED_RESULTS_OID]['value']['cookie']
+    except (KeyError, TypeError):
+        return None
+    # The server sends an empty cookie with the last page.
+    return cookie or None
 
 
-def get_next_id_number(obj_class, id_attr):
-    """ Searches the specified class to find the highest ID in use. """
-    id_number = 0
-    with get_ldap_connection() as conn:
-        search_parameters = {
-            'search_base': base_dn(),
-            'search_filter': f'(objectclass={obj_class})',
-            'attributes': [id_attr]
-        }
+def paged_search(ldap_filter, attributes, base=None, page_size=None):
+    """ Return a list of all of the objects matching the search filter. """
+    return list(iter_matching_objects(ldap_filter, attributes, base, page_size))
+
+
+def iter_matching_objects(
+        ldap_filter, attributes, base=None, page_size=None, connection=None):
+    """
+    Yield the objects matching the search filter, fetching them a page at
+    a time (with the paged results control) so that the server's size
+    limit isn't hit and only one page is held in memory.
+
+    The paging cookie belongs to the connection, so one connection is
+    kept until the generator finishes: the one passed, or one borrowed
+    from the pool. If the caller stops early, the server is told to
+    discard the rest of the results.
+    """
+    if base is None:
+        base = base_dn()
+    search_parameters = {
+        'search_base': base,
+        'search_filter': ldap_filter,
+        'search_scope': SUBTREE,
+        'attributes': attributes,
+        'paged_size': page_size or
+                      shared.globals.config("ldap_page_size") or DEFAULT_PAGE_SIZE
+    }
+    pool = None
+    if connection is not None:
+        shared_conn = True
+        conn = connection
+    else:
+        pool = get_ldap_pool()
+        # Reuse the connection this thread already holds, if any, so that a
+        # small pool can't be exhausted by a nested search.
+        shared_conn = pool.holds_connection()
+        conn = pool.local.conn if shared_conn else pool.acquire()
+    cookie = None
+    broken = False
+    try:
         while True:
             conn.search(**search_parameters)
-            for entry in conn.entries:
-                this_id = int(entry[id_attr].value)
-                if this_id > id_number:
-                    id_number = this_id
+            # Copy the page and cookie before yielding: the caller may use
+            # the same connection for other searches in the meantime.
+            page = list(conn.entries)
             cookie = get_result_cookie(conn.result)
-            if cookie:
-                search_parameters['paged_cookie'] = cookie
-            else:
+            yield from page
+            if not cookie:
                 break
+            search_parameters['paged_cookie'] = cookie
+        cookie = None
+    except LDAPCommunicationError:
+        broken = True
+        raise
+    finally:
+        if cookie and not broken:
+            # Stopped early, so abandon the rest of the results.
+            search_parameters['paged_size'] = 0
+            search_parameters['paged_cookie'] = cookie
+            try:
+                conn.search(**search_parameters)
+            except Exception:
+                pass
+        if not shared_conn:
+            pool.release(conn, broken)
+
+
+def get_next_id_number(obj_class, id_attr):
+    """ Searches the specified class to find the highest ID in use. """
+    id_number = 0
+    for entry in iter_matching_objects(f'(objectclass={obj_class})', [id_attr]):
+        this_id = int(entry[id_attr].value)
+        if this_id > id_number:
+            id_number = this_id
     return id_number+1
 
 
+def find_ids_in_use(obj_class, id_attr, lowest, highest=None):
+    """
+    Return the IDs in use that are at least "lowest" (and, optionally, no
+    more than "highest"). Normally there are none, so this is a single,
+    cheap search rather than a scan of every entry.
+    """
+    id_filter = f"({id_attr}>={lowest})"
+    if highest is not None:
+        id_filter = f"(&{id_filter}({id_attr}<={highest}))"
+    with get_ldap_connection() as conn:
+        if not conn.search(
+                base_dn(),
+                search_filter=f"(&(objectclass={obj_class}){id_filter})",
+                search_scope=SUBTREE,
+                attributes=[id_attr]):
+            return []
+        return [int(entry[id_attr].value) for entry in conn.entries]
+
+
+def reserve_from_counter(counter_dn, id_attr, count):
+    """
+    Atomically take "count" IDs from a counter entry, whose id_attr holds
+    the next free ID. The modify deletes the value we read and adds the new
+    one, so it fails if another process has changed the counter in the
+    meantime, in which case we try again. Returns None if the counter can't
+    be used.
+    """
+    for _ in range(ID_COUNTER_RETRIES):
+        with get_ldap_connection() as conn:
+            if not conn.search(
+                    counter_dn,
+                    search_filter="(objectClass=*)",
+                    search_scope=BASE,
+                    attributes=[id_attr]):
+                print(f"Unable to read ID counter {counter_dn}")
+                return None
+            current = int(conn.entries[0][id_attr].value)
+            change = {
+                id_attr: [
+                    (MODIFY_DELETE, [str(current)]),
+                    (MODIFY_ADD, [str(current + count)])
+                ]
+            }
+            if conn.modify(counter_dn, change):
+                return current
+    print(f"Gave up trying to update ID counter {counter_dn}")
+    return None
+
+
+def set_counter(counter_dn, id_attr, next_id):
+    """ Move a counter that has fallen behind the IDs actually in use. """
+    print(f"Resetting ID counter {counter_dn} to {next_id}")
+    with get_ldap_connection() as conn:
+        conn.modify(counter_dn, {id_attr: [(MODIFY_REPLACE, [str(next_id)])]})
+
+
+def reconcile_id_numbers(obj_class, id_attr):
+    """
+    Do a full scan to find the highest ID in use and raise the cached
+    high-water mark to it.
+    """
+    next_id = get_next_id_number(obj_class, id_attr)
+    with ID_LOCK:
+        ID_HIGH_WATER[id_attr] = max(ID_HIGH_WATER.get(id_attr, 0), next_id - 1)
+    return next_id
+
+
+def reserve_id_numbers(obj_class, id_attr, count=1):
+    """
+    Reserve "count" consecutive, unused IDs and return the first one.
+
+    If a counter entry is configured for the attribute (see
+    "ldap_id_counters"), the IDs are taken from that with an atomic
+    compare-and-swap. Otherwise, a high-water mark is kept in memory and
+    only IDs above it are searched for, so the full scan of every entry is
+    only needed the first time and when reconciling. ID_LOCK is only held
+    while the high-water mark is updated, not during the searches.
+
+    Without a counter, the reservation is NOT atomic across processes:
+    two processes (e.g. mod_wsgi daemons) can hand out the same ID. Call
+    settle_id_number once the entry has been added to detect that and
+    move to a new ID. Multi-process deployments should configure the
+    counters.
+    """
+    counters = shared.globals.config("ldap_id_counters")
+    counter_dn = None if counters is None else counters.get(id_attr)
+    if counter_dn is not None:
+        first = reserve_from_counter(counter_dn, id_attr, count)
+        if first is not None:
+            clashes = find_ids_in_use(obj_class, id_attr, first, first + count - 1)
+            if clashes == []:
+                return first
+            # The counter is behind the directory so fix it and take
+            # the IDs from the new position.
+            next_id = max(reconcile_id_numbers(obj_class, id_attr), first + count)
+            set_counter(counter_dn, id_attr, next_id)
+            first = reserve_from_counter(counter_dn, id_attr, count)
+            if first is not None:
+                return first
+    if id_attr not in ID_HIGH_WATER:
+        reconcile_id_numbers(obj_class, id_attr)
+    # Pick up anything created by other processes since we last looked.
+    # Other threads may reserve IDs meanwhile, which is why the mark is
+    # read again under the lock.
+    in_use = find_ids_in_use(obj_class, id_attr, ID_HIGH_WATER[id_attr] + 1)
+    with ID_LOCK:
+        high_water = max([ID_HIGH_WATER[id_attr]] + in_use)
+        ID_HIGH_WATER[id_attr] = high_water + count
+    return high_water + 1
+
+
+def find_id_holders(obj_class, id_attr, id_number):
+    """ Return the DNs of the entries that have the ID. """
+    with get_ldap_connection() as conn:
+        if not conn.search(
+                base_dn(),
+                search_filter=f"(&(objectclass={obj_class})({id_attr}={id_number}))",
+                search_scope=SUBTREE,
+                attributes=[id_attr]):
+            return []
+        return [entry.entry_dn for entry in conn.entries]
+
+
+def settle_id_number(entry_dn, obj_class, id_attr, id_number):
+    """
+    Check that the newly added entry is the only one with its ID. That can
+    only go wrong without a counter entry, when another process has handed
+    out the same ID. The entry with the lowest DN keeps the ID and the
+    others move to new ones. Returns the entry's ID.
+    """
+    counters = shared.globals.config("ldap_id_counters")
+    if counters is not None and id_attr in counters:
+        return id_number
+    for _ in range(ID_COUNTER_RETRIES):
+        holders = sorted(holder.lower() for holder in find_id_holders(
+            obj_class, id_attr, id_number))
+        if len(holders) < 2 or holders[0] == entry_dn.lower():
+            return id_number
+        print(f"{id_attr} {id_number} was also given to {holders[0]}; moving {entry_dn}")
+        id_number = reserve_id_numbers(obj_class, id_attr)
+        with get_ldap_connection() as conn:
+            conn.modify(entry_dn, {id_attr: [(MODIFY_REPLACE, [str(id_number)])]})
+        forget_entry(entry_dn)
+    return id_number
+
+
 def get_next_uid_number():
-    """ Searches the accounts to find the highest one in use. """
-    return get_next_id_number("posixAccount", "uidNumber")
+    """ Reserve the next free uidNumber for an account. """
+    return reserve_id_numbers("posixAccount", "uidNumber")
 
 
 def get_next_gid_number():
-    """ Searches the security groups to find the highest one in use. """
-    return get_next_id_number("posixGroup", "gidNumber")
+    """ Reserve the next free gidNumber for a security group. """
+    return reserve_id_numbers("posixGroup", "gidNumber")
 
 
 def create_account(first_name, family_name, email_address, password=None):
@@ -234,7 +750,78 @@ def create_account(first_name, family_name, email_address, password=None):
     ... Linaro specific because of the object classes used.
     """
     org_unit = find_best_ou_for_email(email_address)
+    uid_number = str(get_next_uid_number())
     uid = calculate_uid(first_name, family_name)
+    _, result, _ = add_account_with_retries(
+        uid, org_unit, uid_number, first_name, family_name, email_address, password)
+    return result
+
+
+def add_account_with_retries(
+        uid, org_unit, uid_number, first_name, family_name, email_address, password):
+    """
+    Add the account, picking a new uid if someone else takes this one
+    between us searching and adding. Returns the uid, the DN (or None if
+    the account couldn't be created) and the uidNumber, which changes if
+    another process handed out the same one.
+    """
+    for _ in range(UID_CREATE_ATTEMPTS):
+        result = add_account(
+            uid, org_unit, uid_number, first_name, family_name, email_address, password)
+        if result != ENTRY_ALREADY_EXISTS:
+            if result is not None:
+                uid_number = str(settle_id_number(
+                    result, "posixAccount", "uidNumber", int(uid_number)))
+            return (uid, result, uid_number)
+        # Someone else created an account with the same uid between us
+        # searching and adding, so search again.
+        print(f"uid={uid} was created concurrently; trying again")
+        uid = calculate_uid(first_name, family_name)
+    return (uid, None, uid_number)
+
+
+def create_accounts(people):
+    """
+    Create accounts for many people at once. Each person is a tuple of
+    (first name, family name, email address), optionally with a password
+    as a fourth item.
+
+    The OUs and uids are worked out with one search each, a contiguous
+    block of uidNumbers is reserved and the accounts are added in
+    parallel. Returns a list, in the same order as "people", of dicts
+    with "email", "uid", "uidNumber" and "dn" (None if the account
+    couldn't be created).
+    """
+    people = [tuple(person) + (None,) * (4 - len(person)) for person in people]
+    if people == []:
+        return []
+    org_units = find_best_ous_for_emails([person[2] for person in people])
+    uids = calculate_uids([(person[0], person[1]) for person in people])
+    first_number = reserve_id_numbers("posixAccount", "uidNumber", len(people))
+
+    def create(index):
+        first_name, family_name, email_address, password = people[index]
+        return add_account_with_retries(
+            uids[index], org_units[email_address], str(first_number + index),
+            first_name, family_name, email_address, password)
+
+    created = run_batch(create, range(len(people)))
+    return [
+        {
+            "email": people[index][2],
+            "uid": created[index][0],
+            "uidNumber": int(created[index][2]),
+            "dn": created[index][1]
+        }
+        for index in range(len(people))
+    ]
+
+
+def add_account(uid, org_unit, uid_number, first_name, family_name, email_address, password):
+    """
+    Add the account record. Returns the DN, None on failure or
+    ENTRY_ALREADY_EXISTS if the uid has been taken.
+    """
     add_record = {
         "objectClass": [
             'person',
@@ -250,7 +837,7 @@ def create_account(first_name, family_name, email_address, password=None):
         "sn": family_name.encode("utf-8"),
         "mail": email_address,
         "loginShell": "/bin/bash",
-        "uidNumber": str(get_next_uid_number())
+        "uidNumber": uid_number
     }
     if first_name is not None:
         add_record["givenName"] = first_name.encode('utf-8')
@@ -260,11 +847,26 @@ def create_account(first_name, family_name, email_address, password=None):
         if conn.add(
                 f"uid={uid},{org_unit}",
                 attributes=add_record):
+            # Forget that the address had no object.
+            forget_lookups([email_address])
+            if REPLICA is not None:
+                REPLICA.sync_due = True
+            if MANAGER_GRAPH is not None:
+                MANAGER_GRAPH.expire()
             return f"uid={uid},{org_unit}"
+        if result_code(conn) == ENTRY_ALREADY_EXISTS:
+            return ENTRY_ALREADY_EXISTS
     # Failed to create the account
     return None
 
 
+def result_code(conn):
+    """ Return the result code of the last operation on the connection. """
+    if isinstance(conn.result, dict):
+        return conn.result.get("result")
+    return None
+
+
 def create_group(name, description, display_name, address, owners):
     """
     Create security & mailing groups in LDAP. This is somewhat
@@ -292,6 +894,8 @@ def create_group(name, description, display_name, address, owners):
                 CN_PATH % (name, path),
                 attributes=add_record):
                 return add_record
+        add_record['gidNumber'] = str(settle_id_number(
+            CN_PATH % (name, path), "posixGroup", "gidNumber", int(add_record['gidNumber'])))
 
     # Now create the mailing group
     add_record.pop('gidNumber')
@@ -307,9 +911,276 @@ def create_group(name, description, display_name, address, owners):
                 CN_PATH % (name, path),
                 attributes=add_record):
                 return add_record
+        note_group_change(CN_PATH % (name, path))
+        forget_lookups([name, address])
+        if REPLICA is not None:
+            REPLICA.sync_due = True
+
+    return None
 
+def generalized_time(value):
+    """ Return a modifyTimestamp value in LDAP's GeneralizedTime format. """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        return value.strftime("%Y%m%d%H%M%SZ")
+    return str(value)
+
+
+class IncrementalIndex:
+    """
+    The base for in-process copies of part of the directory.
+
+    Everything matching OBJECT_FILTER is loaded with one paged search and
+    then, at most every refresh_interval seconds, only the entries whose
+    modifyTimestamp has changed since the newest one seen are fetched
+    again. Timestamps come from the server so clock skew doesn't matter.
+
+    Subclasses say what to fetch and implement store_entry().
+    """
+
+    OBJECT_FILTER = "(objectClass=*)"
+    ATTRIBUTES = ["modifyTimestamp"]
+
+    def __init__(self, base, refresh_interval):
+        self.base = base
+        self.refresh_interval = refresh_interval
+        self.loaded_at = None
+        self.high_water = None
+        self.lock = threading.RLock()
+
+    def fetch(self, ldap_filter):
+        """ Return the entries matching the filter. """
+        return paged_search(
+            f"(&{self.OBJECT_FILTER}{ldap_filter})",
+            self.ATTRIBUTES,
+            self.base)
+
+    def store_entry(self, entry):
+        """ Record an entry. """
+        raise NotImplementedError
+
+    def changed(self):
+        """ Called after entries have been stored. """
+
+    def store(self, entries):
+        """ Record the entries and the newest modifyTimestamp. """
+        for entry in entries:
+            self.store_entry(entry)
+            stamp = entry.modifyTimestamp.value
+            if stamp is not None:
+                stamp = generalized_time(stamp)
+                if self.high_water is None or stamp > self.high_water:
+                    self.high_water = stamp
+        if entries != []:
+            self.changed()
+
+    def refresh(self, force=False):
+        """ Load everything or fetch the entries that have changed, if due. """
+        with self.lock:
+            now = time.time()
+            if self.loaded_at is None:
+                self.store(self.fetch(""))
+            elif force or now - self.loaded_at >= self.refresh_interval:
+                if self.high_water is None:
+                    self.store(self.fetch(""))
+                else:
+                    self.store(self.fetch(f"(modifyTimestamp>={self.high_water})"))
+            else:
+                return
+            self.loaded_at = now
+
+    def expire(self):
+        """ Fetch the changes on the next read, e.g. after adding an entry. """
+        with self.lock:
+            if self.loaded_at is not None:
+                self.loaded_at = 0
+
+
+class MailingGroupGraph(IncrementalIndex):
+    """
+    An in-process copy of the members of every mailing group, so that
+    nested membership can be checked without walking the groups in LDAP.
+
+    DNs are compared case-insensitively, as LDAP does.
+    """
+
+    OBJECT_FILTER = "(objectClass=groupOfUniqueNames)"
+    ATTRIBUTES = ["cn", "uniqueMember", "modifyTimestamp"]
+
+    def __init__(self, base, refresh_interval=DEFAULT_GROUP_REFRESH):
+        super().__init__(base, refresh_interval)
+        # Group DN (lower-cased) -> list of member DNs
+        self.members = {}
+        # Group cn (lower-cased) -> group DN (lower-cased)
+        self.names = {}
+        # Group DN (lower-cased) -> group DN as LDAP gave it
+        self.dns = {}
+        # Memoised transitive closures, cleared whenever a group changes.
+        self.closures = {}
+
+    def store_entry(self, entry):
+        """ Record the members of a group. """
+        group_dn = entry.entry_dn.lower()
+        self.dns[group_dn] = entry.entry_dn
+        self.members[group_dn] = [
+            member for member in entry.uniqueMember.values if member != ""]
+        for name in entry.cn.values:
+            self.names[name.lower()] = group_dn
+
+    def changed(self):
+        """ Forget the closures, which may no longer be right. """
+        self.closures = {}
+
+    def group_dn(self, group):
+        """ Return the graph's key for a group given by name or DN. """
+        group = group.lower()
+        if "=" in group:
+            return group
+        return self.names.get(group)
+
+    def closure(self, group):
+        """
+        Return the set of (lower-cased) DNs that are members of the group,
+        directly or through nested groups. Cycles are only followed once.
+        """
+        self.refresh()
+        with self.lock:
+            root = self.group_dn(group)
+            if root is None:
+                return frozenset()
+            if root in self.closures:
+                return self.closures[root]
+            reached = set()
+            seen = {root}
+            pending = [root]
+            while pending:
+                current = pending.pop()
+                if current != root and current in self.closures:
+                    reached |= self.closures[current]
+                    continue
+                for member in self.members.get(current, []):
+                    member = member.lower()
+                    reached.add(member)
+                    if member in self.members and member not in seen:
+                        seen.add(member)
+                        pending.append(member)
+            self.closures[root] = frozenset(reached)
+            return self.closures[root]
+
+    def path(self, group, member_dn):
+        """
+        Return the shortest chain of DNs from the group to the member,
+        e.g. [group, nested group, member], or None if it isn't a member.
+        """
+        self.refresh()
+        with self.lock:
+            root = self.group_dn(group)
+            if root is None:
+                return None
+            target = member_dn.lower()
+            # Breadth-first, remembering how each group was reached.
+            parents = {root: None}
+            pending = collections.deque([root])
+            while pending:
+                current = pending.popleft()
+                for member in self.members.get(current, []):
+                    lowered = member.lower()
+                    if lowered == target:
+                        chain = [member]
+                        while current is not None:
+                            chain.append(self.dns.get(current, current))
+                            current = parents[current]
+                        chain.reverse()
+                        return chain
+                    if lowered in self.members and lowered not in parents:
+                        parents[lowered] = current
+                        pending.append(lowered)
+            return None
+
+    def members_of(self, group):
+        """ Return the direct members of the group. """
+        self.refresh()
+        with self.lock:
+            group_dn = self.group_dn(group)
+            return list(self.members.get(group_dn, []))
+
+    def contains(self, group, member_dn):
+        """ Is the DN a member of the group, directly or through nesting? """
+        return member_dn is not None and member_dn.lower() in self.closure(group)
+
+    def update(self, group_dn, added=(), removed=()):
+        """ Reflect a change that this process has made to a group. """
+        with self.lock:
+            key = group_dn.lower()
+            if key not in self.members:
+                # Not loaded yet or created since, so fetch it next time.
+                self.expire()
+                return
+            dropped = {member.lower() for member in removed}
+            members = [
+                member for member in self.members[key]
+                if member.lower() not in dropped]
+            present = {member.lower() for member in members}
+            for member in added:
+                if member.lower() not in present:
+                    members.append(member)
+                    present.add(member.lower())
+            self.members[key] = members
+            self.closures = {}
+
+    def forget(self, group_dn):
+        """ Remove a deleted group from the graph. """
+        with self.lock:
+            key = group_dn.lower()
+            if self.members.pop(key, None) is not None:
+                self.names = {
+                    name: value for name, value in self.names.items() if value != key}
+                self.closures = {}
+
+
+def get_replica():
+    """
+    Return the directory replica if it is enabled and fresh enough to
+    answer reads, otherwise None. Changes are fetched in the background
+    when due.
+    """
+    global REPLICA  # pylint: disable=global-statement
+    if not shared.globals.config("ldap_replica_enabled"):
+        return None
+    if REPLICA is None:
+        with REPLICA_LOCK:
+            if REPLICA is None:
+                from shared import ldap_replica  # pylint: disable=import-outside-toplevel
+                REPLICA = ldap_replica.create_replica()
+    elif REPLICA.is_due():
+        REPLICA.start_sync()
+    if REPLICA.is_usable():
+        return REPLICA
     return None
 
+
+def get_group_graph():
+    """ Return the mailing group graph, creating it first if required. """
+    global GROUP_GRAPH  # pylint: disable=global-statement
+    if GROUP_GRAPH is None:
+        with GROUP_GRAPH_LOCK:
+            if GROUP_GRAPH is None:
+                GROUP_GRAPH = MailingGroupGraph(
+                    string_combo(
+                        shared.globals.config("ldap_mailing_groups"),
+                        base_dn(),
+                        ","),
+                    shared.globals.config("ldap_group_refresh") or DEFAULT_GROUP_REFRESH)
+    return GROUP_GRAPH
+
+
+def note_group_change(group_dn, added=(), removed=()):
+    """ Keep the group graph, if there is one, in step with our own changes. """
+    if GROUP_GRAPH is not None:
+        GROUP_GRAPH.update(group_dn, added, removed)
+
+
 def is_user_in_group(group_name, user_email, recurse=False):
     """ Is the user in the group? """
     user_dn = find_from_email(user_email)
@@ -324,30 +1195,17 @@ def is_dn_in_group(group_name, user_dn, recurse=False):
     We only do this for DNs because that is what handlers get back
     from find_from_email.
 
-    We optionally recurse through nested groups.
+    We optionally recurse through nested groups, in which case both
+    direct and nested membership are answered from the group graph
+    without searching LDAP.
     """
-    result = parameterised_member_of_group(
+    if recurse:
+        return get_group_graph().contains(group_name, user_dn)
+    return parameterised_member_of_group(
         group_name,
         "ldap_mailing_groups",
         "uniqueMember",
         user_dn)
-    if result or not recurse:
-        return result
-    #
-    # See if there are any groups nested in this group. The use of
-    # the uniqueMember filter ensures we only get the mailing list.
-    group_details = find_matching_objects(
-        f"(&(cn={group_name})(uniqueMember=*))",
-        ["uniqueMember"])
-    if group_details is None:
-        # Shouldn't happen as we know the group exists
-        return False
-    for member in group_details[0].uniqueMember.values:
-        if member[:3] == "cn=":
-            group_cn = extract_id_from_dn(member)
-            if is_dn_in_group(group_cn, user_dn):
-                return True
-    return False
 
 
 def parameterised_member_of_group(
@@ -387,28 +1245,128 @@ def parameterised_add_to_group(
     """
     A generalised "add to group" function that can be used for both
     security and mailing groups by adjusting the parameters passed.
+    Being in the group already counts as success.
+    """
+    outcomes = parameterised_change_members(
+        group_name, group_location_tag, member_attribute, [member_value], MODIFY_ADD)
+    return outcomes[member_value] != MEMBER_FAILED
+
+
+def parameterised_change_members(
+        group_name,
+        group_location_tag,
+        member_attribute,
+        member_values,
+        operation):
+    """
+    Add (MODIFY_ADD) or remove (MODIFY_DELETE) all of the values with a
+    single modify, without checking the group first. Returns a dict of
+    value -> MEMBER_* outcome.
+
+    LDAP applies a modify as a whole, so if some of the values were
+    already present (or absent), the modify is rejected. In that case the
+    group is read once and only the values that need changing are sent.
     """
+    values = list(dict.fromkeys(member_values))
+    if values == []:
+        return {}
+    adding = operation == MODIFY_ADD
+    if adding:
+        done, unchanged, benign = MEMBER_ADDED, MEMBER_PRESENT, ATTRIBUTE_OR_VALUE_EXISTS
+    else:
+        done, unchanged, benign = MEMBER_REMOVED, MEMBER_ABSENT, NO_SUCH_ATTRIBUTE
+    grp_dn = parameterised_build_group_dn(group_name, group_location_tag)
     with get_ldap_connection() as conn:
-        # In the group already?
-        if parameterised_member_of_group(
-                group_name,
-                group_location_tag,
-                member_attribute,
-                member_value):
-            return True
-
-        # No, so add them.
-        change = {
-            member_attribute: [(MODIFY_ADD, [member_value])]
-        }
-        # Calculate the DN.
-        grp_dn = parameterised_build_group_dn(group_name, group_location_tag)
-        print(f"Adding {member_value} as a {member_attribute} attribute to {grp_dn}")
-        result = conn.modify(grp_dn, change)
-        if not result:
+        print(f"{'Adding' if adding else 'Removing'} {', '.join(values)} as "
+              f"{member_attribute} attributes {'to' if adding else 'from'} {grp_dn}")
+        if conn.modify(grp_dn, {member_attribute: [(operation, values)]}):
+            outcomes = {value: done for value in values}
+        elif result_code(conn) != benign:
             print("Group modification failed")
             print(conn.result)
-        return result
+            return {value: MEMBER_FAILED for value in values}
+        elif len(values) == 1:
+            outcomes = {values[0]: unchanged}
+        else:
+            outcomes = retry_member_change(
+                conn, grp_dn, member_attribute, values, operation)
+    changed = [value for value, outcome in outcomes.items() if outcome == done]
+    if changed != []:
+        note_member_change(grp_dn, member_attribute, changed, adding)
+    return outcomes
+
+
+def retry_member_change(conn, grp_dn, member_attribute, values, operation):
+    """
+    Find out which values are in the group already and apply the change
+    to just the ones that need it.
+    """
+    adding = operation == MODIFY_ADD
+    current = set()
+    if conn.search(
+            grp_dn,
+            search_filter="(objectClass=*)",
+            search_scope=BASE,
+            attributes=[member_attribute]):
+        current = {
+            str(value).lower()
+            for value in attribute_values(conn.entries[0], member_attribute)}
+    pending = [value for value in values if (value.lower() in current) != adding]
+    outcomes = {
+        value: MEMBER_PRESENT if adding else MEMBER_ABSENT
+        for value in values if value not in pending}
+    if pending != []:
+        if conn.modify(grp_dn, {member_attribute: [(operation, pending)]}):
+            outcome = MEMBER_ADDED if adding else MEMBER_REMOVED
+        else:
+            print("Group modification failed")
+            print(conn.result)
+            outcome = MEMBER_FAILED
+        outcomes.update({value: outcome for value in pending})
+    return outcomes
+
+
+def note_member_change(grp_dn, member_attribute, values, adding):
+    """ Update what we hold about the group after changing its members. """
+    forget_entry(grp_dn)
+    added = values if adding else []
+    removed = [] if adding else values
+    if member_attribute == "uniqueMember":
+        note_group_change(grp_dn, added=added, removed=removed)
+    if REPLICA is not None:
+        REPLICA.apply_change(grp_dn, member_attribute, added=added, removed=removed)
+
+
+def add_members_to_group(group_name, member_dns):
+    """
+    Add all of the DNs to the group, with one modify for the security
+    group and one for the mailing group. Only accounts (uid=) are added to
+    the security group. Returns a dict of DN -> MEMBER_* outcome, which is
+    the mailing group's outcome unless the security group change failed.
+    """
+    return change_group_members(group_name, member_dns, MODIFY_ADD)
+
+
+def remove_members_from_group(group_name, member_dns):
+    """ The opposite of add_members_to_group. """
+    return change_group_members(group_name, member_dns, MODIFY_DELETE)
+
+
+def change_group_members(group_name, member_dns, operation):
+    """ Apply the change to both the security and mailing groups. """
+    uids = {
+        member_dn: extract_id_from_dn(member_dn)
+        for member_dn in member_dns if member_dn.split("=", 1)[0] == "uid"}
+    security = parameterised_change_members(
+        group_name, "ldap_security_groups", "memberUid", list(uids.values()), operation)
+    mailing = parameterised_change_members(
+        group_name, "ldap_mailing_groups", "uniqueMember", member_dns, operation)
+    return {
+        member_dn: MEMBER_FAILED
+        if member_dn in uids and security[uids[member_dn]] == MEMBER_FAILED
+        else mailing[member_dn]
+        for member_dn in mailing
+    }
 
 
 def extract_id_from_dn(distinguished_name):
@@ -496,28 +1454,11 @@ def parameterised_remove_from_group(
     """
     A generalised "remove from group" function that can be used for both
     security and mailing groups by adjusting the parameters passed.
+    Not being in the group already counts as success.
     """
-    with get_ldap_connection() as conn:
-        # Not in the group already?
-        if not parameterised_member_of_group(
-                group_name,
-                group_location_tag,
-                member_attribute,
-                member_value):
-            return True
-
-        # Yes so remove them
-        change = {
-            member_attribute: [(MODIFY_DELETE, [member_value])]
-        }
-        # Calculate the DN.
-        grp_dn = parameterised_build_group_dn(group_name, group_location_tag)
-        print(f"Removing {member_value} as a {member_attribute} attribute from {grp_dn}")
-        result = conn.modify(grp_dn, change)
-        if not result:
-            print("Group modification failed")
-            print(conn.result)
-        return result
+    outcomes = parameterised_change_members(
+        group_name, group_location_tag, member_attribute, [member_value], MODIFY_DELETE)
+    return outcomes[member_value] != MEMBER_FAILED
 
 
 def remove_from_security_group(group_name, object_dn):
@@ -589,8 +1530,203 @@ def remove_owner_from_group(group_name, object_dn):
     return part_1 and part_2
 
 
+class CachedAttribute:
+    """
+    The values of an attribute held by a CachedEntry. Like an ldap3
+    Attribute, it can be converted to a string, iterated over, indexed
+    and measured.
+    """
+
+    def __init__(self, values):
+        self.values = values
+        if values == []:
+            self.value = None
+        elif len(values) == 1:
+            self.value = values[0]
+        else:
+            self.value = values
+
+    def __str__(self):
+        if len(self.values) == 1:
+            return str(self.values[0])
+        return str(self.values)
+
+    def __repr__(self):
+        return f"CachedAttribute({self.values!r})"
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __eq__(self, other):
+        if isinstance(other, CachedAttribute):
+            return self.values == other.values
+        return self.value == other
+
+    def __hash__(self):
+        return hash(tuple(self.values))
+
+
+class CachedEntry:
+    """
+    A copy of an LDAP entry that can be cached. It is used in the same way
+    as an ldap3 Entry, e.g. entry.mail.values, entry["mail"].value,
+    "mail" in entry or entry.entry_to_json(). Attribute names are held in
+    lower case. Only the attributes that were fetched are present; use
+    search_object to get the ldap3 Entry itself.
+    """
+
+    def __init__(self, entry_dn, attributes):
+        self.entry_dn = entry_dn
+        # Attribute name (lower-cased) -> list of values
+        self.attributes = attributes
+
+    @property
+    def entry_attributes_as_dict(self):
+        """ Return the attributes, as ldap3 does. """
+        return dict(self.attributes)
+
+    def __getattr__(self, name):
+        attributes = self.__dict__.get("attributes", {})
+        if name.lower() not in attributes:
+            raise AttributeError(name)
+        return CachedAttribute(attributes[name.lower()])
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __contains__(self, name):
+        return name.lower() in self.attributes
+
+    def __iter__(self):
+        return iter([CachedAttribute(values) for values in self.attributes.values()])
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def __str__(self):
+        lines = [f"DN: {self.entry_dn}"]
+        for name, values in sorted(self.attributes.items()):
+            lines.append(f"    {name}: {', '.join(str(value) for value in values)}")
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return f"CachedEntry({self.entry_dn!r})"
+
+    @property
+    def entry_attributes(self):
+        """ Return the names of the attributes, as ldap3 does. """
+        return list(self.attributes)
+
+    def entry_to_json(self):
+        """ Return the entry as JSON, in the same layout as ldap3. """
+        return json.dumps(
+            {"dn": self.entry_dn, "attributes": self.attributes},
+            indent=4,
+            sort_keys=True,
+            default=str)
+
+
+def is_cacheable(value):
+    """ Can the value be stored in the shared cache as it is? """
+    return isinstance(value, (str, int, float, bool)) or value is None
+
+
+def entry_cache_key(object_dn):
+    """ Return the cache key for the entry with the DN. """
+    return f"dn:{object_dn.lower()}"
+
+
+def forget_entry(object_dn):
+    """ Remove the entry with the DN from the cache. """
+    shared.cache.delete("ldap", entry_cache_key(object_dn))
+
+
+def lookup_values(object_dn, attributes=None):
+    """
+    Return the entry's values for the attributes (by default, the
+    LOOKUP_ATTRIBUTES) so that the lookups keyed by them can be forgotten
+    once the entry has changed.
+    """
+    attributes = attributes or LOOKUP_ATTRIBUTES
+    entry = get_object(object_dn, attributes)
+    if entry is None:
+        return []
+    wanted = {attribute.lower() for attribute in attributes}
+    return [
+        value
+        for name, values in entry.entry_attributes_as_dict.items()
+        if name.lower() in wanted
+        for value in values
+    ]
+
+
+def forget_lookups(values):
+    """
+    Remove the cached lookups, including the ones that found nothing,
+    that are keyed by any of the values.
+    """
+    for value in values:
+        if not isinstance(value, str):
+            continue
+        lowered = value.lower()
+        for key in dict.fromkeys([
+                f"mail={value}", f"mail={lowered}",
+                f"single:{lowered}", f"group:{lowered}"]):
+            shared.cache.delete("ldap", key)
+
+
 def get_object(object_dn, attributes):
-    """ Retrieve the specified object from LDAP. """
+    """
+    Retrieve the specified object from LDAP.
+
+    Entries are cached by DN. If an entry has been cached with some
+    attributes and more are asked for, all of them are fetched so that
+    the cached entry keeps growing to cover what callers use.
+    """
+    if attributes is None or "*" in attributes or "+" in attributes:
+        return search_object(object_dn, attributes)
+    replica = get_replica()
+    if replica is not None:
+        entry = replica.get(object_dn, attributes)
+        if entry is not None:
+            return entry
+    key = entry_cache_key(object_dn)
+    cached = shared.cache.get("ldap", key)
+    wanted = {attribute.lower() for attribute in attributes}
+    if cached is not None:
+        if wanted.issubset(cached["attributes"]):
+            return CachedEntry(cached["dn"], cached["attributes"])
+        wanted |= set(cached["attributes"])
+    entry = search_object(object_dn, sorted(wanted))
+    if entry is None:
+        return None
+    return cache_entry(entry, wanted)
+
+
+def cache_entry(entry, attributes):
+    """
+    Cache an entry fetched with the attributes, returning a CachedEntry
+    for it. Entries that can't be cached are returned as they are.
+    """
+    values = {attribute.lower(): [] for attribute in attributes}
+    for name, item in entry.entry_attributes_as_dict.items():
+        values[name.lower()] = list(item)
+    if not all(is_cacheable(item) for items in values.values() for item in items):
+        # e.g. binary values; return what LDAP gave us without caching it.
+        return entry
+    shared.cache.put(
+        "ldap", entry_cache_key(entry.entry_dn), {"dn": entry.entry_dn, "attributes": values})
+    return CachedEntry(entry.entry_dn, values)
+
+
+def search_object(object_dn, attributes):
+    """ Search LDAP for the specified object. """
     with get_ldap_connection() as conn:
         if conn.search(
                 object_dn,
@@ -627,21 +1763,50 @@ def replace_attribute_value(object_dn, attribute_name, new_value):
         change = {
             attribute_name: [(MODIFY_REPLACE, [new_value])]
         }
+    values = []
+    if attribute_name.lower() in {attribute.lower() for attribute in LOOKUP_ATTRIBUTES}:
+        # The lookups keyed by the old values have to be forgotten too.
+        values = lookup_values(object_dn, [attribute_name])
     with get_ldap_connection() as conn:
-        conn.modify(
+        modified = conn.modify(
             object_dn,
             change
         )
+    if modified:
+        forget_entry(object_dn)
+        forget_lookups(values + ([] if new_value is None else [new_value]))
+    if modified and REPLICA is not None:
+        REPLICA.apply_change(
+            object_dn, attribute_name, replaced=[] if new_value is None else [new_value])
+    if modified and MANAGER_GRAPH is not None:
+        MANAGER_GRAPH.update(
+            object_dn, attribute_name, [] if new_value is None else [new_value])
 
 
 def move_object(current_dn, new_ou):
     """ Move the specified object into the new OU. """
+    values = lookup_values(current_dn)
     with get_ldap_connection() as conn:
-        if not conn.modify_dn(
-                current_dn,
-                current_dn.split(",", 1)[0],
-                new_superior=new_ou):
-            return conn.result
+        moved = conn.modify_dn(
+            current_dn,
+            current_dn.split(",", 1)[0],
+            new_superior=new_ou)
+        result = conn.result
+    if not moved:
+        return result
+    # Forgotten afterwards so that a lookup made during the move can't
+    # cache the old DN again.
+    forget_entry(current_dn)
+    forget_lookups(values)
+    if GROUP_GRAPH is not None:
+        # A moved group is picked up again by its new modifyTimestamp.
+        GROUP_GRAPH.forget(current_dn)
+    if REPLICA is not None:
+        REPLICA.forget(current_dn)
+        REPLICA.sync_due = True
+    if MANAGER_GRAPH is not None:
+        MANAGER_GRAPH.forget(current_dn)
+        MANAGER_GRAPH.expire()
     return None
 
 
@@ -650,6 +1815,37 @@ def find_group(name, attributes):
     Try to find a group with the given email address or, failing that, the name.
     Returns the canonical email address for the found group and the requested attributes.
     """
+    resolved = resolve_group(name, attributes)
+    if len(resolved["dns"]) == 1:
+        result = [get_object(resolved["dns"][0], attributes)]
+    else:
+        result = list(get_objects(resolved["dns"], attributes).values())
+    return (resolved["mail"], [entry for entry in result if entry is not None])
+
+
+def resolve_group(name, attributes=None):
+    """
+    Return {"mail": canonical email address, "dns": [group DNs]} for a
+    group name, email address or Google alias. Answers are cached; not
+    finding the group is only cached for "ldap_negative_ttl" seconds.
+
+    If the group has to be searched for, the entries found are cached
+    with the attributes so that reading them doesn't need another search.
+    """
+    key = f"group:{name.lower()}"
+    resolved = shared.cache.lookup("ldap", key)
+    if resolved is not shared.cache.MISSING:
+        return resolved
+    resolved = search_group(name, attributes or [])
+    ttl = None
+    if resolved["dns"] == []:
+        ttl = shared.globals.config("ldap_negative_ttl") or DEFAULT_NEGATIVE_TTL
+    shared.cache.put("ldap", key, resolved, ttl)
+    return resolved
+
+
+def search_group(name, attributes):
+    """ Search LDAP, and Google for aliases, for the group. """
     if "@" not in name:
         # We don't have an email address so try to get one
         result = find_matching_objects(
@@ -659,7 +1855,7 @@ def find_group(name, attributes):
         if result is None:
             result = []
         if len(result) != 1:
-            return (name, result)
+            return {"mail": name, "dns": [entry.entry_dn for entry in result]}
         # A group may have more than one email address. Using "values"
         # always ensures we get a list back, making [0] safe.
         mail_entry = result[0].mail.values
@@ -668,20 +1864,50 @@ def find_group(name, attributes):
 
     # Now get the values for the specified attributes for
     # this group.
+    wanted = sorted({attribute.lower() for attribute in attributes} | {"cn"})
     result = find_matching_objects(
         f"(&(objectClass=groupOfUniqueNames)(mail={name}))",
-        attributes
+        wanted
     )
     if result is None:
         result = []
+    for entry in result:
+        cache_entry(entry, wanted)
 
     # Let's try and be super smart and see if this is an alias for a group :)
-    if result == [] and shared.globals.CONFIGURATION["google_enabled"]:
+    if result == [] and shared.globals.config("google_enabled"):
+        from shared import shared_google  # pylint: disable=import-outside-toplevel
         google = shared_google.check_group_alias(name)
-        if google is not None:
-            return find_group(google, attributes)
+        if google is not None and google.lower() != name.lower():
+            return resolve_group(google, attributes)
 
-    return (name, result)
+    return {"mail": name, "dns": [entry.entry_dn for entry in result]}
+
+
+def prefetch_groups():
+    """
+    Resolve every mailing group by name and email address, plus any Google
+    aliases, with one paged search (and one Google listing) so that
+    find_group doesn't need to search. Returns the number of names cached.
+    """
+    resolved = {}
+    for entry in iter_matching_objects(
+            "(objectClass=groupOfUniqueNames)", ["cn", "mail"]):
+        mails = entry.mail.values
+        value = {
+            "mail": mails[0] if mails != [] else entry.cn.value,
+            "dns": [entry.entry_dn]
+        }
+        for name in list(entry.cn.values) + list(mails):
+            resolved[f"group:{name.lower()}"] = value
+    if shared.globals.config("google_enabled"):
+        from shared import shared_google  # pylint: disable=import-outside-toplevel
+        for alias, group_mail in shared_google.list_group_aliases().items():
+            key = f"group:{alias}"
+            if key not in resolved and f"group:{group_mail.lower()}" in resolved:
+                resolved[key] = resolved[f"group:{group_mail.lower()}"]
+    shared.cache.put_many("ldap", resolved)
+    return len(resolved)
 
 
 def reporter_is_group_owner(owner_list):
@@ -691,98 +1917,295 @@ def reporter_is_group_owner(owner_list):
     if reporter_dn is None:
         # Shouldn't happen ...
         return False
+    return find_owner_path(reporter_dn, owner_list) is not None
+
 
-    is_owner = False
+def find_owner_path(user_dn, owner_list):
+    """
+    Check the DN against a whole owner list in one pass. Returns the path
+    that makes the DN an owner - [owner] if it is listed directly, or
+    [owner group, nested group, ..., user_dn] if it is a member of an
+    owning mailing group - or None if it isn't an owner.
+
+    Direct owners are checked first, then the owning groups using the
+    group graph's membership closures.
+    """
+    key = user_dn.lower()
     for owner in owner_list:
-        if MAILING_OU in owner:
-            grp_name = owner.split(',', 1)[0].split('=')[1]
-            if is_dn_in_group(grp_name, reporter_dn, True):
-                is_owner = True
-        elif owner == reporter_dn:
-            is_owner = True
-    return is_owner
+        if MAILING_OU not in owner and owner.lower() == key:
+            return [owner]
+    graph = get_group_graph()
+    for owner in owner_list:
+        if MAILING_OU in owner and graph.contains(owner, user_dn):
+            return graph.path(owner, user_dn)
+    return None
 
 
 def flatten_list(starting_list):
-    """ Expand groups to individuals to end up with a single list of names. """
+    """
+    Expand groups to individuals to end up with a single list of names.
+    The order of first appearance is kept and each name is only listed
+    once, however many groups it is reached through.
+    """
     enabled = shared.globals.config("ldap_enabled")
     if enabled is None or not enabled:
         return starting_list
 
-    result = []
-    for item in starting_list:
-        if item != "":
-            process_list_member(item, result)
-    return result
+    return expand_members(starting_list, [], set(), set())
 
 
-def process_list_member(item, result):
-    """ Process an individual list member when flattening. """
-    if MAILING_OU in item:
-        name = extract_id_from_dn(item)
-        recurse = get_group_membership(name)
-        for member in recurse:
-            if member not in result:
-                result.append(member)
-    elif item not in result:
-        result.append(item)
+def expand_members(members, result, seen, expanded):
+    """
+    Append the members to result, expanding mailing groups in place.
+    "seen" holds the (lower-cased) names already in result and "expanded"
+    the groups already expanded, so each group is only walked once per
+    call and cycles between groups end.
+    """
+    graph = get_group_graph()
+    pending = list(reversed(members))
+    while pending:
+        item = pending.pop()
+        if item == "":
+            continue
+        key = item.lower()
+        if MAILING_OU in key:
+            if key not in expanded:
+                expanded.add(key)
+                pending.extend(reversed(graph.members_of(key)))
+        elif key not in seen:
+            seen.add(key)
+            result.append(item)
+    return result
 
 
 def get_group_membership(group_name):
-    """ Recursively build list of everyone in the specified group. """
-    _, result = find_group(group_name, ["uniqueMember"])
-    members = []
-    for member in result[0].uniqueMember.values:
-        if MAILING_OU in member:
-            members += get_group_membership(member)
-        else:
-            members.append(member)
-    return members
+    """
+    Build list of everyone in the specified group, which can be given by
+    name, email address or DN, including the members of nested groups.
+    """
+    if "@" in group_name:
+        _, result = find_group(group_name, ["cn"])
+        if result == []:
+            return []
+        group_dn = result[0].entry_dn
+    else:
+        graph = get_group_graph()
+        graph.refresh()
+        group_dn = graph.group_dn(group_name)
+        if group_dn is None:
+            return []
+    return expand_members([group_dn], [], set(), set())
 
 
 def find_single_object_from_email(email_address):
     """
     Try to find a single object in LDAP that matches the provided
     email address. Return None if no match or more than 1 match.
+
+    Answers, including no match, are cached. No match is only cached for
+    "ldap_negative_ttl" seconds so that newly created objects are found.
     """
-    result = find_matching_objects(
-        f"(&(objectClass=groupOfUniqueNames)(mail={email_address}))",
-        ["cn"])
-    if result is not None and len(result) == 1:
-        return result[0].entry_dn
+    key = f"single:{email_address.lower()}"
+    result = shared.cache.lookup("ldap", key)
+    if result is not shared.cache.MISSING:
+        return result
+    result = search_single_object_from_email(email_address)
+    ttl = None
+    if result is None:
+        ttl = shared.globals.config("ldap_negative_ttl") or DEFAULT_NEGATIVE_TTL
+    shared.cache.put("ldap", key, result, ttl)
+    return result
 
-    result = find_matching_objects(
-        f"(&(objectClass=posixAccount)(mail={cleanup_if_gmail(email_address)}))",
-        ["cn"])
-    if result is not None and len(result) == 1:
-        return result[0].entry_dn
 
-    # Linaro uses the aRecord attribute to record email aliases so look
-    # there as well ...
-    result = find_matching_objects(
-        f"(&(objectClass=posixAccount)(aRecord={cleanup_if_gmail(email_address)}))",
-        ["cn"])
-    if result is not None and len(result) == 1:
-        return result[0].entry_dn
+def search_single_object_from_email(email_address):
+    """
+    Search for every candidate with one search and then apply the rules in
+    order of precedence:
 
-    # If still no match, try again without the GMail cleanup just in case
-    # a GMail account was added without the cleanup.
-    result = find_matching_objects(
-        f"(&(objectClass=posixAccount)(mail={email_address}))",
-        ["cn"])
-    if result is not None and len(result) == 1:
-        return result[0].entry_dn
+    1. a mailing group with the address
+    2. an account with the address, after GMail cleanup
+    3. an account with the address as an alias (aRecord), after GMail cleanup
+    4. an account with the address as given, in case a GMail account was
+       added without the cleanup
 
+    The first rule with exactly one match wins.
+    """
+    cleaned = cleanup_if_gmail(email_address)
+    replica = get_replica()
+    if replica is not None:
+        # The replica holds every account and mailing group so it has
+        # all of the candidates.
+        result = replica.find("mail", email_address) + \
+            replica.find("mail", cleaned) + replica.find("aRecord", cleaned)
+    else:
+        raw_value = escape_filter_chars(email_address)
+        clean_value = escape_filter_chars(cleaned)
+        result = find_matching_objects(
+            f"(|(&(objectClass=groupOfUniqueNames)(mail={raw_value}))"
+            f"(&(objectClass=posixAccount)"
+            f"(|(mail={clean_value})(aRecord={clean_value})(mail={raw_value}))))",
+            ["objectClass", "mail", "aRecord"])
+    if result is None:
+        return None
+    rules = [
+        ("groupofuniquenames", "mail", email_address),
+        ("posixaccount", "mail", cleaned),
+        ("posixaccount", "arecord", cleaned),
+        ("posixaccount", "mail", email_address)
+    ]
+    for obj_class, attribute, value in rules:
+        matches = {
+            entry.entry_dn.lower(): entry.entry_dn for entry in result
+            if has_value(entry, "objectClass", obj_class) and
+            has_value(entry, attribute, value)
+        }
+        if len(matches) == 1:
+            return list(matches.values())[0]
     return None
 
 
+def attribute_values(entry, name):
+    """ Return the values of the attribute, or [] if the entry doesn't have it. """
+    name = name.lower()
+    for key, values in entry.entry_attributes_as_dict.items():
+        if key.lower() == name:
+            return values
+    return []
+
+
+def has_value(entry, name, value):
+    """ Does the attribute have the value? Compared without regard to case. """
+    value = value.lower()
+    return any(str(item).lower() == value for item in attribute_values(entry, name))
+
+
 def get_manager_from_dn(distinguished_name):
-    """ Get the manager DN from the staff DN """
-    result = get_object(distinguished_name, ["manager"])
-    if result is not None and result.manager.value is not None:
-        mgr_email = get_object(result.manager.value, ["mail"])
-        if mgr_email is not None and mgr_email.mail.values != []:
-            return mgr_email.mail.values[0]
+    """
+    Get the manager's email address from the staff DN. This is answered
+    from the manager graph, only going to LDAP if the DN isn't in it.
+    """
+    graph = get_manager_graph()
+    if graph.knows(distinguished_name):
+        manager = graph.manager(distinguished_name)
+        mail = None if manager is None else graph.mail(manager)
+        if manager is None or mail is not None:
+            return mail
+    else:
+        # Also fetch the mail attribute, which is usually wanted as well.
+        result = get_object(distinguished_name, ["manager", "mail"])
+        if result is None or result.manager.value is None:
+            return None
+        manager = result.manager.value
+    mgr_email = get_object(manager, ["mail"])
+    if mgr_email is not None and mgr_email.mail.values != []:
+        return mgr_email.mail.values[0]
+    return None
+
+
+class ManagerGraph(IncrementalIndex):
+    """
+    An in-process copy of every account's manager and email address, so
+    that management chains can be followed without searching LDAP.
+    """
+
+    OBJECT_FILTER = "(objectClass=posixAccount)"
+    ATTRIBUTES = ["manager", "mail", "modifyTimestamp"]
+
+    def __init__(self, base, refresh_interval=DEFAULT_GROUP_REFRESH):
+        super().__init__(base, refresh_interval)
+        # Account DN (lower-cased) -> manager DN or None
+        self.managers = {}
+        # Account DN (lower-cased) -> first email address or None
+        self.mails = {}
+
+    def store_entry(self, entry):
+        """ Record an account's manager and email address. """
+        key = entry.entry_dn.lower()
+        self.managers[key] = entry.manager.value
+        mails = entry.mail.values
+        self.mails[key] = mails[0] if mails != [] else None
+
+    def chain(self, user_dn):
+        """
+        Return the DNs of the account's manager, their manager and so on.
+        A loop in the management chain ends the chain.
+        """
+        self.refresh()
+        with self.lock:
+            result = []
+            seen = {user_dn.lower()}
+            manager = self.managers.get(user_dn.lower())
+            while manager is not None and manager.lower() not in seen:
+                result.append(manager)
+                seen.add(manager.lower())
+                manager = self.managers.get(manager.lower())
+            return result
+
+    def knows(self, user_dn):
+        """ Is the account in the graph? """
+        self.refresh()
+        with self.lock:
+            return user_dn.lower() in self.managers
+
+    def manager(self, user_dn):
+        """ Return the DN of the account's manager. """
+        self.refresh()
+        with self.lock:
+            return self.managers.get(user_dn.lower())
+
+    def mail(self, user_dn):
+        """ Return the account's email address. """
+        self.refresh()
+        with self.lock:
+            return self.mails.get(user_dn.lower())
+
+    def update(self, user_dn, attribute, values):
+        """ Reflect a change that this process has made to an account. """
+        with self.lock:
+            key = user_dn.lower()
+            if key not in self.managers:
+                self.expire()
+            elif attribute.lower() == "manager":
+                self.managers[key] = values[0] if values != [] else None
+            elif attribute.lower() == "mail":
+                self.mails[key] = values[0] if values != [] else None
+
+    def forget(self, user_dn):
+        """ Remove a deleted account. """
+        with self.lock:
+            self.managers.pop(user_dn.lower(), None)
+            self.mails.pop(user_dn.lower(), None)
+
+
+def get_manager_graph():
+    """ Return the manager graph, creating it first if required. """
+    global MANAGER_GRAPH  # pylint: disable=global-statement
+    if MANAGER_GRAPH is None:
+        with MANAGER_GRAPH_LOCK:
+            if MANAGER_GRAPH is None:
+                MANAGER_GRAPH = ManagerGraph(
+                    base_dn(),
+                    shared.globals.config("ldap_manager_refresh") or DEFAULT_GROUP_REFRESH)
+    return MANAGER_GRAPH
+
+
+def get_manager_chain(user_dn):
+    """
+    Return the management chain above the DN as a list of
+    (manager DN, email address) pairs, nearest manager first.
+    """
+    graph = get_manager_graph()
+    return [(manager, graph.mail(manager)) for manager in graph.chain(user_dn)]
+
+
+def find_manager(user_dn, predicate):
+    """
+    Return the (DN, email address) of the nearest manager above the DN
+    for which predicate(manager_dn, email_address) is true, or None.
+    """
+    for manager, mail in get_manager_chain(user_dn):
+        if predicate(manager, mail):
+            return (manager, mail)
     return None
 
 
@@ -804,3 +2227,22 @@ def add_member_to_group(group_cn, member_dn):
         add_to_security_group(group_cn, member_dn)
     print("Adding to mail group")
     add_to_mailing_group(group_cn, member_dn)
+
+
+def get_objects(object_dns, attributes):
+    """ Retrieve several objects at once. Returns a dict of DN -> entry or None. """
+    return run_batch(lambda object_dn: get_object(object_dn, attributes), object_dns)
+
+
+def find_from_emails(email_addresses):
+    """ Look up several email addresses at once. Returns a dict of address -> DN or None. """
+    return run_batch(find_from_email, email_addresses)
+
+
+def is_dn_in_groups(group_names, user_dn, recurse=False):
+    """ Check the DN against several groups at once. Returns a dict of group -> bool. """
+    if recurse:
+        # Load the group graph once rather than in every worker.
+        get_group_graph().refresh()
+    return run_batch(
+        lambda group_name: is_dn_in_group(group_name, user_dn, recurse), group_names)
@@ -18,9 +18,9 @@ from typing import Union
 
 import requests
 
+import shared.cache
 import shared.custom_fields as custom_fields
 import shared.globals
-import shared.shared_ldap as shared_ldap
 
 GDPR_ERROR = (
     "'accountId' must be the only user identifying query parameter in GDPR strict mode."
@@ -42,6 +42,15 @@ class CustomFieldLookupFailure(SharedSDError):
 
 def get_servicedesk_projects():
     """Return all Service Desk projects."""
+    return shared.cache.cached(
+        "project_metadata",
+        f"{shared.globals.ROOT_URL}|servicedesks",
+        fetch_servicedesk_projects
+    )
+
+
+def fetch_servicedesk_projects():
+    """Retrieve all Service Desk projects from the server."""
     result = service_desk_request_get(
         f"{shared.globals.ROOT_URL}/rest/servicedeskapi/servicedesk"
     )
@@ -63,6 +72,15 @@ def get_servicedesk_id(sd_project_key):
 
 def get_servicedesk_request_types(project_id):
     """Return all of the request types for a given Service Desk project."""
+    return shared.cache.cached(
+        "project_metadata",
+        f"{shared.globals.ROOT_URL}|requesttypes|{project_id}",
+        lambda: fetch_servicedesk_request_types(project_id)
+    )
+
+
+def fetch_servicedesk_request_types(project_id):
+    """Retrieve the request types for a given Service Desk project from the server."""
     result = service_desk_request_get(
         f"{shared.globals.ROOT_URL}/rest/servicedeskapi/servicedesk/{project_id}/requesttype"
     )
@@ -357,16 +375,38 @@ def sd_orgs():
     organization custom field.
     """
     sd_id = get_servicedesk_id(shared.globals.PROJECT)
+    if sd_id == -1:
+        return {}
+    return get_servicedesk_orgs(sd_id)
+
+
+def get_servicedesk_orgs(sd_id):
+    """Return the organisations for the specified Service Desk ID."""
+    orgs = shared.cache.cached(
+        "organizations",
+        f"{shared.globals.ROOT_URL}|orgs|{sd_id}",
+        lambda: fetch_sd_orgs(sd_id)
+    )
+    if orgs is None:
+        return {}
+    return orgs
+
+
+def fetch_sd_orgs(sd_id):
+    """
+    Retrieve the organisations for the specified Service Desk from the
+    server or None if that fails.
+    """
+    result = service_desk_request_get(
+        f"{shared.globals.ROOT_URL}/rest/servicedeskapi/servicedesk/{sd_id}/organization"
+    )
+    if result.status_code != 200:
+        return None
     orgs = {}
-    if sd_id != -1:
-        result = service_desk_request_get(
-            f"{shared.globals.ROOT_URL}/rest/servicedeskapi/servicedesk/{sd_id}/organization"
-        )
-        if result.status_code == 200:
-            unpack = result.json()
-            org_list = unpack["values"]
-            for org in org_list:
-                orgs[org["name"]] = int(org["id"])
+    unpack = result.json()
+    org_list = unpack["values"]
+    for org in org_list:
+        orgs[org["name"]] = int(org["id"])
     return orgs
 
 
@@ -684,7 +724,12 @@ def assign_approvers(approver_list, custom_field, add_to_request_participants=Tr
     """
     updating_via_webhook = "jsm_customfield_webhook" in shared.globals.CONFIGURATION and \
         custom_field in shared.globals.CONFIGURATION["jsm_customfield_webhook"]
+    # LDAP is only loaded when needed so that it doesn't slow down cold starts.
+    import shared.shared_ldap as shared_ldap  # pylint: disable=import-outside-toplevel
     flat_list = shared_ldap.flatten_list(approver_list)
+    # Fetch the email addresses for all of the DNs at once.
+    objects = shared_ldap.get_objects(
+        [item for item in flat_list if item != "" and "@" not in item], ["mail"])
     if updating_via_webhook:
         approvers = {
             "id": []
@@ -702,7 +747,7 @@ def assign_approvers(approver_list, custom_field, add_to_request_participants=Tr
             if "@" in item:
                 item_email = item
             else:
-                obj = shared_ldap.get_object(item, ["mail"])
+                obj = objects[item]
                 if obj is not None:
                     item_email = obj.mail.value
             if item_email is not None:
@@ -778,6 +823,15 @@ def set_customfield(custom_field, value):
 
 def find_account_id(email_address: str) -> Union[str, None]:
     """Look up the email address and return the corresponding account ID or None if not found"""
+    return shared.cache.cached(
+        "accounts",
+        f"{shared.globals.ROOT_URL}|email|{email_address}",
+        lambda: fetch_account_id(email_address)
+    )
+
+
+def fetch_account_id(email_address: str) -> Union[str, None]:
+    """Ask the server for the account ID matching the email address"""
     result = service_desk_request_get(
         f"{shared.globals.ROOT_URL}/rest/api/2/user/search?query={email_address}"
     )
@@ -791,6 +845,15 @@ def find_account_id(email_address: str) -> Union[str, None]:
 
 def find_account_from_id(account_id: str):
     """Look up the specified account ID and return the corresponding user or None if not found"""
+    return shared.cache.cached(
+        "accounts",
+        f"{shared.globals.ROOT_URL}|id|{account_id}",
+        lambda: fetch_account_from_id(account_id)
+    )
+
+
+def fetch_account_from_id(account_id: str):
+    """Ask the server for the user with the specified account ID"""
     result = service_desk_request_get(
         f"{shared.globals.ROOT_URL}/rest/api/2/user?accountId={account_id}"
     )
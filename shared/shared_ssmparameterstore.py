@@ -1,11 +1,28 @@
 """ Script to retrieve parameter value from AWS Systems Manager Parameter Store"""
 import json
-import boto3
+import threading
+import time
 
 import shared.globals
 
+# The assumed role is renewed this many seconds before its credentials expire.
+CREDENTIAL_MARGIN = 300
+# GetParameters accepts at most this many names per call.
+MAX_PARAMETERS = 10
+# How long, in seconds, fetched parameters are kept in memory.
+PARAMETER_TTL = 300
+
+CREDENTIALS = None
+SSM_CLIENT = None
+CLIENT_LOCK = threading.Lock()
+# Parameter name -> (time fetched, decoded JSON value)
+PARAMETERS = {}
+
+# pylint: disable=global-statement
+
 def assume_role(session_name="CrossAccountSession"):
     """Assume the role and return temporary credentials"""
+    import boto3  # pylint: disable=import-outside-toplevel
     role_arn = shared.globals.CONFIGURATION["ssm_secret_iam_role"]
     print(f"[SSM] Assuming role: {role_arn}")
     sts_client = boto3.client("sts")
@@ -16,29 +33,102 @@ def assume_role(session_name="CrossAccountSession"):
     return assumed_role["Credentials"]
 
 
-def get_secret(parameter_name, key=None, with_decryption=True):
-    """Retrieve a parameter value from AWS Systems Manager Parameter Store"""
-    print(f"[SSM] Fetching parameter: {parameter_name}")
-    credentials = assume_role()
-    ssm_client = boto3.client(
-        "ssm",
-        region_name=shared.globals.CONFIGURATION["ssm_region_name"],
-        aws_access_key_id=credentials["AccessKeyId"],
-        aws_secret_access_key=credentials["SecretAccessKey"],
-        aws_session_token=credentials["SessionToken"]
-    )
+def credentials_valid(credentials):
+    """ Are the credentials far enough from expiring to keep using? """
+    return credentials is not None and \
+        credentials["Expiration"].timestamp() - time.time() > CREDENTIAL_MARGIN
 
-    # Get the parameter
-    response = ssm_client.get_parameter(
-        Name=parameter_name,
-        WithDecryption=with_decryption
-    )
-    print(f"[SSM] Successfully retrieved parameter: {parameter_name}")
-    parameter_value = response["Parameter"]["Value"]
-    data = json.loads(parameter_value)
 
-    # Return the "key" if passed, otherwise return "pw"
+def get_ssm_client():
+    """
+    Return the SSM client, assuming the role and creating the client again
+    if the credentials are about to expire.
+    """
+    global CREDENTIALS, SSM_CLIENT
+    with CLIENT_LOCK:
+        if SSM_CLIENT is None or not credentials_valid(CREDENTIALS):
+            # boto3 is slow to import, so only do so when SSM is used.
+            import boto3  # pylint: disable=import-outside-toplevel
+            credentials = assume_role()
+            SSM_CLIENT = boto3.client(
+                "ssm",
+                region_name=shared.globals.CONFIGURATION["ssm_region_name"],
+                aws_access_key_id=credentials["AccessKeyId"],
+                aws_secret_access_key=credentials["SecretAccessKey"],
+                aws_session_token=credentials["SessionToken"]
+            )
+            CREDENTIALS = credentials
+        return SSM_CLIENT
+
+
+def cached_parameter(parameter_name):
+    """ Return the decoded parameter if fetched recently, otherwise None. """
+    cached = PARAMETERS.get(parameter_name)
+    if cached is None or time.time() - cached[0] >= PARAMETER_TTL:
+        return None
+    return cached[1]
+
+
+def secret_value(data, key=None):
+    """ Return the "key" if passed, otherwise return "pw" """
     if key:
         return data.get(key, None)
-    else:
-        return data.get("pw", None)
+    return data.get("pw", None)
+
+
+def get_secret(parameter_name, key=None, with_decryption=True):
+    """Retrieve a parameter value from AWS Systems Manager Parameter Store"""
+    data = cached_parameter(parameter_name)
+    if data is None:
+        print(f"[SSM] Fetching parameter: {parameter_name}")
+        # Get the parameter
+        response = get_ssm_client().get_parameter(
+            Name=parameter_name,
+            WithDecryption=with_decryption
+        )
+        print(f"[SSM] Successfully retrieved parameter: {parameter_name}")
+        data = json.loads(response["Parameter"]["Value"])
+        PARAMETERS[parameter_name] = (time.time(), data)
+    return secret_value(data, key)
+
+
+def get_parameters(parameter_names, with_decryption=True):
+    """
+    Retrieve several parameters, MAX_PARAMETERS to a GetParameters call.
+    Returns a dict of name -> decoded value, leaving out any that don't
+    exist.
+    """
+    result = {}
+    wanted = []
+    for name in dict.fromkeys(parameter_names):
+        data = cached_parameter(name)
+        if data is None:
+            wanted.append(name)
+        else:
+            result[name] = data
+    for start in range(0, len(wanted), MAX_PARAMETERS):
+        names = wanted[start:start + MAX_PARAMETERS]
+        print(f"[SSM] Fetching parameters: {', '.join(names)}")
+        response = get_ssm_client().get_parameters(
+            Names=names,
+            WithDecryption=with_decryption
+        )
+        now = time.time()
+        for parameter in response["Parameters"]:
+            data = json.loads(parameter["Value"])
+            PARAMETERS[parameter["Name"]] = (now, data)
+            result[parameter["Name"]] = data
+        for name in response.get("InvalidParameters", []):
+            print(f"[SSM] Parameter not found: {name}")
+    return result
+
+
+def get_secrets(parameter_names, key=None, with_decryption=True):
+    """
+    Retrieve the values of several parameters, as get_secret does, in as
+    few calls as possible. Returns a dict of name -> value.
+    """
+    return {
+        name: secret_value(data, key)
+        for name, data in get_parameters(parameter_names, with_decryption).items()
+    }
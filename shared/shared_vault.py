@@ -1,50 +1,188 @@
 """ Shared code to retrieve secrets from Hashicorp Vault. """
-import boto3
-import hvac
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
 import shared.globals
 
+# The token is renewed once this fraction of its TTL has passed.
+RENEW_AT = 0.75
+# Secrets that don't have a lease duration are kept for this many seconds.
+DEFAULT_SECRET_TTL = 300
+# Secrets are never kept for longer than this, or "vault_max_secret_ttl",
+# because KV v1 reports a refresh hint of 768h as the lease duration.
+DEFAULT_MAX_SECRET_TTL = 3600
+# How many paths are read at the same time by get_secrets.
+MAX_READERS = 4
+
+# (url, iam_role) -> VaultClient
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
+
+
+class VaultClient:
+    """
+    A Vault login that is kept for the life of the process. The token is
+    renewed before it expires (or replaced by logging in again if it
+    can't be) and secrets are kept for their lease duration, up to a
+    maximum.
+    """
+
+    def __init__(self, url, iam_role):
+        self.url = url
+        self.iam_role = iam_role
+        self.session = requests.Session()
+        self.token = None
+        self.obtained = None
+        self.ttl = 0
+        self.renewable = False
+        # path -> (time it expires, data)
+        self.secrets = {}
+        self.lock = threading.Lock()
+
+    def store_auth(self, auth):
+        """ Remember the token from a login or renewal. """
+        self.token = auth["client_token"]
+        self.ttl = auth.get("lease_duration", 0)
+        self.renewable = auth.get("renewable", False)
+        self.obtained = time.time()
+
+    def login(self):
+        """ Assume the IAM role and log into Vault with it. """
+        # boto3 and hvac are slow to import, so only do so when Vault is used.
+        import boto3  # pylint: disable=import-outside-toplevel
+        import hvac  # pylint: disable=import-outside-toplevel
+        sts_client = boto3.client('sts')
+        print(f"get_vault_secret: assuming role {self.iam_role}")
+        assumed_role_object = sts_client.assume_role(
+            RoleArn=self.iam_role,
+            RoleSessionName="AssumeRoleSession1"
+        )
+        assumed_credentials = assumed_role_object['Credentials']
+        # Authenticate to Vault and get a Vault token back
+        client = hvac.Client(url=self.url)
+        response = client.auth.aws.iam_login(
+            assumed_credentials['AccessKeyId'],
+            assumed_credentials['SecretAccessKey'],
+            assumed_credentials['SessionToken'])
+        self.store_auth(response["auth"])
+
+    def renew(self):
+        """ Renew the token, returning False if Vault refuses. """
+        response = self.session.post(
+            f"{self.url}/v1/auth/token/renew-self",
+            headers={"X-Vault-Token": self.token},
+            timeout=60)
+        if not response.ok:
+            print(f"Unable to renew the Vault token: {response.status_code}")
+            return False
+        self.store_auth(response.json()["auth"])
+        return True
+
+    def headers(self, stale_token=None):
+        """
+        Return the headers for a request, logging in or renewing first if
+        needed. If Vault has rejected stale_token, log in again unless
+        another thread already has.
+        """
+        with self.lock:
+            age = None if self.token is None else time.time() - self.obtained
+            # A TTL of 0 means that the token doesn't expire.
+            if age is None or self.token == stale_token or \
+                    (self.ttl != 0 and age >= self.ttl):
+                self.login()
+            elif self.ttl != 0 and age >= self.ttl * RENEW_AT:
+                if not self.renewable or not self.renew():
+                    self.login()
+            return {"X-Vault-Token": self.token}
+
+    def read(self, secret_path):
+        """ Return the data for the secret, from memory if its lease hasn't expired. """
+        cached = self.secrets.get(secret_path)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+        headers = self.headers()
+        response = self.session.get(
+            f"{self.url}/v1/{secret_path}",
+            headers=headers,
+            timeout=60)
+        if response.status_code == 403:
+            # The token has been revoked or has expired early.
+            print("Vault rejected the token; logging in again")
+            response = self.session.get(
+                f"{self.url}/v1/{secret_path}",
+                headers=self.headers(stale_token=headers["X-Vault-Token"]),
+                timeout=60)
+        response.raise_for_status()
+        secret = response.json()
+        lease = min(
+            secret.get("lease_duration") or DEFAULT_SECRET_TTL,
+            shared.globals.config("vault_max_secret_ttl") or DEFAULT_MAX_SECRET_TTL)
+        self.secrets[secret_path] = (time.time() + lease, secret["data"])
+        return secret["data"]
+
+    def read_many(self, secret_paths):
+        """ Read several secrets concurrently. Returns a dict of path -> data. """
+        secret_paths = list(dict.fromkeys(secret_paths))
+        # Log in (if needed) once, rather than in every thread.
+        self.headers()
+        with ThreadPoolExecutor(
+                max_workers=max(1, min(MAX_READERS, len(secret_paths))),
+                thread_name_prefix="vault") as executor:
+            return dict(zip(secret_paths, executor.map(self.read, secret_paths)))
+
+    def revoke(self):
+        """ Revoke the token, e.g. when the process is exiting. """
+        with self.lock:
+            if self.token is None:
+                return
+            try:
+                self.session.post(
+                    f"{self.url}/v1/auth/token/revoke-self",
+                    headers={"X-Vault-Token": self.token},
+                    timeout=60)
+            except requests.RequestException as exc:
+                print(f"Unable to revoke the Vault token: {exc}")
+            self.token = None
+            self.secrets = {}
+
+
+def get_client(iam_role: str, url: str) -> VaultClient:
+    """ Return the client for the server and role, creating it if required. """
+    with CLIENTS_LOCK:
+        client = CLIENTS.get((url, iam_role))
+        if client is None:
+            client = VaultClient(url, iam_role)
+            CLIENTS[(url, iam_role)] = client
+            atexit.register(client.revoke)
+        return client
+
+
 def get_vault_secret(secret_path: str, iam_role: str, url: str) -> str:
     """ Retrieve a secret from Hashicorp Vault """
-    # Assume the desired IAM role
-    sts_client = boto3.client('sts')
-    print(f"get_vault_secret: assuming role {iam_role}")
-    assumed_role_object = sts_client.assume_role(
-        RoleArn=iam_role,
-        RoleSessionName="AssumeRoleSession1"
-    )
-    assumed_credentials = assumed_role_object['Credentials']
-    # Authenticate to Vault and get a Vault token back
-    client = hvac.Client(url=url)
-    token = client.auth.aws.iam_login(
-        assumed_credentials['AccessKeyId'],
-        assumed_credentials['SecretAccessKey'],
-        assumed_credentials['SessionToken'])
-    # Now request the secret with that token
-    header = {
-        "X-Vault-Token": token["auth"]["client_token"]
-    }
-    response = requests.get(
-        f"{url}/v1/{secret_path}",
-        headers=header,
-        timeout=60)
-    secret = response.json()
-    # Revoke the Vault token now that we're done with it.
-    requests.post(
-        f"{url}/v1/auth/token/revoke-self",
-        headers=header,
-        timeout=60)
-    response.raise_for_status()
-    return secret["data"]
+    return get_client(iam_role, url).read(secret_path)
 
-def get_secret(secret_path, key="pw"):
-    """ Retrieve a secret from Hashicorp Vault service """
-    secret = get_vault_secret(
-        secret_path,
+
+def configured_client():
+    """ Return the client for the configured server and role. """
+    return get_client(
         iam_role=shared.globals.CONFIGURATION["vault_iam_role"],
         url=shared.globals.CONFIGURATION["vault_server_url"]
     )
+
+
+def get_secret(secret_path, key="pw"):
+    """ Retrieve a secret from Hashicorp Vault service """
+    secret = configured_client().read(secret_path)
     if key in secret:
         return secret[key]
     return None
+
+
+def get_secrets(secret_paths, key="pw"):
+    """ Retrieve several secrets at once. Returns a dict of path -> value. """
+    secrets = configured_client().read_many(secret_paths)
+    return {path: secret.get(key) for path, secret in secrets.items()}
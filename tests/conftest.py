@@ -0,0 +1,23 @@
+""" Shared test fixtures. """
+
+import pytest
+
+import shared.cache
+import shared.globals
+import shared.shared_ldap
+
+
+@pytest.fixture(autouse=True)
+def reset_shared_cache():
+    """ Make sure that nothing cached by one test leaks into another. """
+    shared.cache.BACKEND = None
+    shared.shared_ldap.GROUP_GRAPH = None
+    shared.shared_ldap.REPLICA = None
+    shared.shared_ldap.MANAGER_GRAPH = None
+    shared.globals.SD_CREDENTIALS = None
+    yield
+    shared.cache.BACKEND = None
+    shared.shared_ldap.GROUP_GRAPH = None
+    shared.shared_ldap.REPLICA = None
+    shared.shared_ldap.MANAGER_GRAPH = None
+    shared.globals.SD_CREDENTIALS = None
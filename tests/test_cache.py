@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+""" Test shared/cache. """
+
+import fnmatch
+
+import pytest
+
+import shared.cache
+import shared.globals
+
+
+class MockRedisPipeline:
+    """ Mock up the Redis pipeline. """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, key, value, ex=None):
+        """ Queue a set. """
+        self.commands.append((key, value, ex))
+
+    def execute(self):
+        """ Apply the queued sets. """
+        for key, value, ex in self.commands:
+            self.client.set(key, value, ex)
+        self.client.round_trips += 1
+
+
+class MockRedis:
+    """ A local stand-in for a Redis server shared by several nodes. """
+
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+
+    def get(self, key):
+        """ Mock get. """
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        """ Mock set. """
+        assert ex is not None and ex > 0
+        self.data[key] = value.encode("utf-8")
+
+    def delete(self, *keys):
+        """ Mock delete. """
+        for key in keys:
+            self.data.pop(key, None)
+
+    def pipeline(self):
+        """ Mock pipeline. """
+        return MockRedisPipeline(self)
+
+    def scan_iter(self, match):
+        """ Mock scan_iter. """
+        return [key for key in list(self.data) if fnmatch.fnmatch(key, match)]
+
+
+def test_memory_backend():
+    """ Test the default in-memory backend. """
+    shared.globals.CONFIGURATION = {}
+    shared.cache.put("ldap", "mail=fred", "uid=fred")
+    shared.cache.put("ldap", "mail=none", None)
+    assert shared.cache.get("ldap", "mail=fred") == "uid=fred"
+    assert shared.cache.lookup("ldap", "mail=none") is None
+    assert shared.cache.lookup("ldap", "mail=wilma") is shared.cache.MISSING
+    shared.cache.clear("ldap")
+    assert shared.cache.get("ldap", "mail=fred") is None
+
+
+def test_memory_backend_lru_and_expiry():
+    """ The memory backend evicts the least recently used and expired entries. """
+    backend = shared.cache.MemoryBackend(max_entries=2)
+    backend.set_many({"a": 1, "b": 2}, 60)
+    assert backend.get("a") == 1
+    backend.set_many({"c": 3}, 60)
+    assert backend.get("b") is shared.cache.MISSING
+    assert backend.get("a") == 1
+    backend.set_many({"d": 4}, -1)
+    assert backend.get("d") is shared.cache.MISSING
+
+
+def test_sqlite_backend_is_shared(tmp_path):
+    """ Two SQLite backends on the same file see each other's entries. """
+    shared.globals.CONFIGURATION = {
+        "cache_backend": "sqlite",
+        "cache_sqlite_file": str(tmp_path / "cache.sqlite"),
+        "cache_ttls": {"accounts": 60}
+    }
+    shared.cache.put("accounts", "fred@widget.org", {"accountId": "123"})
+    other = shared.cache.SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    assert other.get(shared.cache.full_key("accounts", "fred@widget.org")) == \
+        {"accountId": "123"}
+    other.set_many({shared.cache.full_key("accounts", "old"): 1}, -1)
+    assert shared.cache.lookup("accounts", "old") is shared.cache.MISSING
+    shared.cache.delete("accounts", "fred@widget.org")
+    assert other.get(shared.cache.full_key("accounts", "fred@widget.org")) is \
+        shared.cache.MISSING
+
+
+def test_redis_backend():
+    """ Test the Redis backend against a local stand-in. """
+    server = MockRedis()
+    shared.cache.BACKEND = shared.cache.RedisBackend(client=server)
+    shared.cache.put_many("custom_fields", {"a": "cf_1", "b": "cf_2"})
+    assert server.round_trips == 1
+    # A second node using the same server sees the entries.
+    node_2 = shared.cache.RedisBackend(client=server)
+    assert node_2.get(shared.cache.full_key("custom_fields", "a")) == "cf_1"
+    shared.cache.put("ldap", "mail=fred", "uid=fred")
+    shared.cache.clear("custom_fields")
+    assert shared.cache.lookup("custom_fields", "b") is shared.cache.MISSING
+    assert shared.cache.get("ldap", "mail=fred") == "uid=fred"
+
+
+def test_invalid_backend():
+    """ Test an unknown or incomplete backend configuration. """
+    shared.globals.CONFIGURATION = {"cache_backend": "wibble"}
+    with pytest.raises(shared.cache.InvalidCacheConfig):
+        shared.cache.get_backend()
+    shared.globals.CONFIGURATION = {"cache_backend": "redis"}
+    with pytest.raises(shared.cache.InvalidCacheConfig):
+        shared.cache.get_backend()
+
+
+def test_ttl_for():
+    """ Test per-namespace TTLs. """
+    shared.globals.CONFIGURATION = {"cache_ttls": {"ldap": 10}}
+    assert shared.cache.ttl_for("ldap") == 10
+    assert shared.cache.ttl_for("accounts") == shared.cache.DEFAULT_TTLS["accounts"]
+    assert shared.cache.ttl_for("wibble") == shared.cache.DEFAULT_TTL
+
+
+def test_cached():
+    """ Only non-None values are cached unless asked otherwise. """
+    shared.globals.CONFIGURATION = {}
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return None
+
+    assert shared.cache.cached("accounts", "fred", loader) is None
+    assert shared.cache.cached("accounts", "fred", loader) is None
+    assert len(calls) == 2
+    assert shared.cache.cached("accounts", "wilma", loader, True) is None
+    assert shared.cache.cached("accounts", "wilma", loader, True) is None
+    assert len(calls) == 3
@@ -2,6 +2,7 @@
 """ Test shared/custom_fields. """
 
 import json
+import threading
 from requests.auth import HTTPBasicAuth
 
 import mock
@@ -170,3 +171,334 @@ def test_cloud_exception():
     }
     with pytest.raises(NotImplementedError):
         custom_fields.fetch_cf_value("blah")
+
+
+MOCK_CLOUD_FIELDS = [
+    {
+        "id": "customfield_10100",
+        "name": "Customer Request Type",
+        "clauseNames": ["cf[10100]", "Customer Request Type"]
+    },
+    {
+        "id": "customfield_10200",
+        "name": "Approvers",
+        "untranslatedName": "Approvers"
+    },
+    {
+        "id": "customfield_10300",
+        "name": "Approvers"
+    },
+    {
+        "id": "customfield_10400",
+        "name": "Genehmigende",
+        "untranslatedName": "Approver list"
+    }
+]
+
+
+@mock.patch(
+    'shared.custom_fields.os.path.isfile',
+    return_value=False,
+    autospec=True
+)
+@responses.activate
+def test_load_cf_catalogue_from_server(mock_os_path_isfile):
+    """ The Server API is paged by field offset. """
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": True,
+        "cf_use_cloud_api": False,
+        "cf_cachefile": "/tmp/cf_cachefile"
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.CF_CATALOGUE = None
+    custom_fields.CF_CATALOGUE_LOADED = None
+    shared.globals.ROOT_URL = "https://mock-server"
+    pages = [MOCK_CLOUD_FIELDS[:2], MOCK_CLOUD_FIELDS[2:]]
+    for start_at, page in ((0, pages[0]), (2, pages[1])):
+        responses.add(
+            responses.GET,
+            "https://mock-server/rest/api/2/customFields",
+            json={"values": page, "isLast": start_at == 2},
+            status=200,
+            match=[responses.matchers.query_param_matcher({"startAt": str(start_at)})]
+        )
+    with patch('shared.custom_fields.save_cf_cache'):
+        assert custom_fields.get_ids("Approvers") == [
+            "customfield_10200", "customfield_10300"]
+        assert custom_fields.get("Genehmigende") == "customfield_10400"
+    assert len(responses.calls) == 2
+    assert mock_os_path_isfile.called is True
+
+
+def test_index_catalogue():
+    """ Test that duplicate names and variants are indexed. """
+    index = custom_fields.index_catalogue(MOCK_CLOUD_FIELDS)
+    assert index["Customer Request Type"] == ["customfield_10100"]
+    assert index["cf[10100]"] == ["customfield_10100"]
+    assert index["Approvers"] == ["customfield_10200", "customfield_10300"]
+    assert index["Approver list"] == ["customfield_10400"]
+    assert index["Genehmigende"] == ["customfield_10400"]
+    # Overlapping pages mustn't produce repeated IDs.
+    index = custom_fields.index_catalogue(MOCK_CLOUD_FIELDS + MOCK_CLOUD_FIELDS[1:3])
+    assert index["Approvers"] == ["customfield_10200", "customfield_10300"]
+
+
+@mock.patch(
+    'shared.custom_fields.os.path.isfile',
+    return_value=False,
+    autospec=True
+)
+@responses.activate
+def test_load_cf_catalogue(mock_os_path_isfile):
+    """ Check that one request populates every field and saves once. """
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": True,
+        "cf_cachefile": "/tmp/cf_cachefile"
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.CF_CATALOGUE = None
+    custom_fields.CF_CATALOGUE_LOADED = None
+    shared.globals.ROOT_URL = "https://mock-server"
+    responses.add(
+        responses.GET,
+        "https://mock-server/rest/api/3/field",
+        json=MOCK_CLOUD_FIELDS,
+        status=200
+    )
+    with patch('shared.custom_fields.save_cf_cache') as m_save:
+        assert custom_fields.get("Customer Request Type") == "customfield_10100"
+        assert custom_fields.get("Approvers") == "customfield_10200"
+        assert custom_fields.get_ids("Approvers") == [
+            "customfield_10200", "customfield_10300"]
+        assert len(responses.calls) == 1
+        assert m_save.call_count == 1
+    assert mock_os_path_isfile.called is True
+
+
+def test_save_cf_cache_merges(tmp_path):
+    """ Check that saving merges in entries written by another process. """
+    cachefile = tmp_path / "cf_cachefile"
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": False,
+        "cf_cachefile": str(cachefile)
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.initialise_cf_cache()
+    assert custom_fields.CF_CACHE == {}
+    # Simulate another process saving its own entry.
+    cachefile.write_text(json.dumps({"Approvers": 10800}))
+    custom_fields.CF_CACHE["Request Type"] = 10100
+    custom_fields.save_cf_cache()
+    assert json.loads(cachefile.read_text()) == {
+        "Approvers": 10800,
+        "Request Type": 10100
+    }
+    # No temporary files should be left behind.
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "cf_cachefile", "cf_cachefile.lock"]
+
+
+def test_save_cf_cache_permissions(tmp_path):
+    """ Rewriting the cache file keeps its permissions, or makes it readable by all. """
+    cachefile = tmp_path / "cf_cachefile"
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": False,
+        "cf_cachefile": str(cachefile)
+    }
+    custom_fields.CF_CACHE = {"Request Type": 10100}
+    custom_fields.save_cf_cache()
+    assert cachefile.stat().st_mode & 0o777 == 0o644
+    cachefile.chmod(0o664)
+    custom_fields.save_cf_cache()
+    assert cachefile.stat().st_mode & 0o777 == 0o664
+
+
+def test_reload_cf_cache_if_changed(tmp_path):
+    """ Check that a newer cache file is picked up without a Jira lookup. """
+    cachefile = tmp_path / "cf_cachefile"
+    cachefile.write_text(json.dumps({}))
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": False,
+        "cf_cachefile": str(cachefile)
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.initialise_cf_cache()
+    assert custom_fields.reload_cf_cache_if_changed() is False
+    cachefile.write_text(json.dumps({"Approvers": 10800}))
+    with patch('shared.custom_fields.fetch_cf_value') as m_fetch:
+        assert custom_fields.get("Approvers") == 10800
+        assert m_fetch.called is False
+
+
+def test_corrupt_cf_cachefile(tmp_path):
+    """ A corrupt cache file is treated as empty. """
+    cachefile = tmp_path / "cf_cachefile"
+    cachefile.write_text("{\"Appro")
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": False,
+        "cf_cachefile": str(cachefile)
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.initialise_cf_cache()
+    assert custom_fields.CF_CACHE == {}
+
+
+@mock.patch(
+    'shared.custom_fields.os.path.isfile',
+    return_value=False,
+    autospec=True
+)
+@responses.activate
+def test_negative_cache(mock_os_path_isfile):
+    """ Unknown names are remembered until the negative TTL expires. """
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": True,
+        "cf_cachefile": "/tmp/cf_cachefile",
+        "cf_negative_ttl": 60
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.CF_CATALOGUE_LOADED = None
+    custom_fields.CF_MISSING = {}
+    custom_fields.CF_METRICS["misses"].clear()
+    shared.globals.ROOT_URL = "https://mock-server"
+    responses.add(
+        responses.GET,
+        "https://mock-server/rest/api/3/field",
+        json=MOCK_CLOUD_FIELDS,
+        status=200
+    )
+    with patch('shared.custom_fields.save_cf_cache'):
+        assert custom_fields.get("Customer Request Type") == "customfield_10100"
+        assert custom_fields.get("Request Type") is None
+        assert custom_fields.get("Request Type") is None
+        assert len(responses.calls) == 1
+        assert custom_fields.cf_metrics()["misses"] == {"Request Type": 2}
+        assert custom_fields.cf_metrics()["negative_hits"] >= 1
+        # Once the negative entry and the catalogue have expired, the
+        # catalogue is fetched again.
+        custom_fields.CF_MISSING["Request Type"] = 0
+        custom_fields.CF_CATALOGUE_LOADED -= 60
+        assert custom_fields.get("Request Type") is None
+        assert len(responses.calls) == 2
+    assert mock_os_path_isfile.called is True
+
+
+@mock.patch(
+    'shared.custom_fields.os.path.isfile',
+    return_value=False,
+    autospec=True
+)
+def test_refresh_ahead(mock_os_path_isfile):
+    """ A negative entry close to expiry is refreshed in the background. """
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": True,
+        "cf_cachefile": "/tmp/cf_cachefile",
+        "cf_negative_ttl": 100
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.initialise_cf_cache()
+    custom_fields.CF_MISSING = {
+        "New Field": custom_fields.time.monotonic() + 5
+    }
+
+    def mock_load():
+        custom_fields.CF_CACHE["New Field"] = "customfield_10500"
+        return True
+
+    with patch(
+            'shared.custom_fields.load_cf_catalogue',
+            side_effect=mock_load) as m_load:
+        # The lookup returns straight away and kicks off the refresh ...
+        custom_fields.get("New Field")
+        custom_fields.REFRESH_THREAD.join()
+        assert m_load.call_count == 1
+    # ... so the field is found afterwards without another lookup.
+    assert "New Field" not in custom_fields.CF_MISSING
+    assert custom_fields.get("New Field") == "customfield_10500"
+    assert mock_os_path_isfile.called is True
+
+
+@mock.patch(
+    'shared.custom_fields.os.path.isfile',
+    return_value=False,
+    autospec=True
+)
+def test_catalogue_loads_serialised(mock_os_path_isfile):
+    """ A webhook waits for an in-flight refresh rather than loading the catalogue too. """
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": True,
+        "cf_cachefile": "/tmp/cf_cachefile",
+        "cf_negative_ttl": 100
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.CF_CATALOGUE_LOADED = None
+    custom_fields.CF_MISSING = {}
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def slow_fetch():
+        fetching.set()
+        release.wait(5)
+        return {"New Field": ["customfield_10500"]}
+
+    with patch('shared.custom_fields.fetch_cf_catalogue', side_effect=slow_fetch) as m_fetch, \
+            patch('shared.custom_fields.save_cf_cache'):
+        custom_fields.start_refresh_ahead()
+        assert fetching.wait(5)
+        webhook = threading.Thread(target=custom_fields.fetch_cf_value, args=("Other",))
+        webhook.start()
+        webhook.join(0.2)
+        assert webhook.is_alive()
+        release.set()
+        custom_fields.REFRESH_THREAD.join(5)
+        webhook.join(5)
+        assert m_fetch.call_count == 1
+    assert custom_fields.CF_CACHE["New Field"] == "customfield_10500"
+    assert "Other" in custom_fields.CF_MISSING
+    assert mock_os_path_isfile.called is True
+
+
+@mock.patch(
+    'shared.custom_fields.os.path.isfile',
+    return_value=False,
+    autospec=True
+)
+@responses.activate
+def test_failed_catalogue_not_cached(mock_os_path_isfile):
+    """ If Jira can't be asked, the name isn't remembered as missing. """
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": True,
+        "cf_cachefile": "/tmp/cf_cachefile",
+        "cf_negative_ttl": 60
+    }
+    custom_fields.CF_CACHE = None
+    custom_fields.CF_CATALOGUE_LOADED = None
+    custom_fields.CF_MISSING = {}
+    shared.globals.ROOT_URL = "https://mock-server"
+    responses.add(
+        responses.GET,
+        "https://mock-server/rest/api/3/field",
+        status=503
+    )
+    responses.add(
+        responses.GET,
+        "https://mock-server/rest/api/3/field",
+        json=MOCK_CLOUD_FIELDS,
+        status=200
+    )
+    with patch('shared.custom_fields.save_cf_cache'):
+        assert custom_fields.get("Customer Request Type") is None
+        assert "Customer Request Type" not in custom_fields.CF_MISSING
+        # The next lookup tries again rather than trusting the failure.
+        assert custom_fields.get("Customer Request Type") == "customfield_10100"
+        assert len(responses.calls) == 2
+    assert mock_os_path_isfile.called is True
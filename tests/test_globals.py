@@ -2,6 +2,8 @@
 """ Test shared/globals functionality """
 
 import json
+import threading
+import time
 from unittest.mock import patch, mock_open
 import mock
 import pytest
@@ -200,6 +202,71 @@ def test_simple_credentials():
     assert password == "password"
 
 
+@mock.patch(
+    'shared.globals.get_sd_credentials',
+    return_value=["name", "password"],
+    autospec=True
+)
+def test_sd_auth_cached(mock_sd_auth_credentials):
+    """ The credentials are only fetched again when they expire or change. """
+    shared.globals.CONFIGURATION = {
+        "bot_name": "name",
+        "ssm_bot_name": "bot_name",
+        "sd_credential_refresh": 100
+    }
+    shared.globals.initialise_sd_auth()
+    shared.globals.initialise_sd_auth()
+    assert mock_sd_auth_credentials.call_count == 1
+    assert shared.globals.SD_AUTH == "bmFtZTpwYXNzd29yZA=="
+    # Nearly expired, so refreshed in the background.
+    shared.globals.SD_CREDENTIALS["fetched"] -= 90
+    with mock.patch("shared.globals.start_sd_auth_refresh") as mock_refresh:
+        shared.globals.initialise_sd_auth()
+    mock_refresh.assert_called_once()
+    assert mock_sd_auth_credentials.call_count == 1
+    # Expired, so fetched straight away.
+    shared.globals.SD_CREDENTIALS["fetched"] -= 10
+    shared.globals.initialise_sd_auth()
+    assert mock_sd_auth_credentials.call_count == 2
+    # A different bot is configured.
+    shared.globals.CONFIGURATION["bot_name"] = "other"
+    shared.globals.initialise_sd_auth()
+    assert mock_sd_auth_credentials.call_count == 3
+
+
+def test_sd_auth_refresh_does_not_block():
+    """ Webhooks keep using the cached credentials while they are refreshed. """
+    shared.globals.CONFIGURATION = {"bot_name": "name", "sd_credential_refresh": 100}
+    source = shared.globals.sd_credential_source()
+    shared.globals.SD_CREDENTIALS = {
+        "source": source, "auth": "old", "fetched": time.time() - 90}
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def slow_fetch():
+        fetching.set()
+        release.wait(5)
+        return "new"
+
+    with mock.patch("shared.globals.build_sd_auth", side_effect=slow_fetch):
+        assert shared.globals.get_sd_auth() == "old"
+        assert fetching.wait(5)
+        start = time.time()
+        assert shared.globals.get_sd_auth() == "old"
+        assert time.time() - start < 1
+        release.set()
+        shared.globals.SD_REFRESH_THREAD.join(5)
+    assert shared.globals.SD_CREDENTIALS["auth"] == "new"
+
+
+def test_sd_auth_refresh_failure():
+    """ A failed background refresh keeps the old credentials. """
+    shared.globals.SD_CREDENTIALS = {"source": [], "auth": "old", "fetched": 0}
+    with mock.patch("shared.globals.get_sd_credentials", side_effect=Exception("SSM")):
+        shared.globals.refresh_sd_auth([])
+    assert shared.globals.SD_CREDENTIALS["auth"] == "old"
+
+
 @mock.patch(
     'shared.globals.vault_auth.get_secret',
     return_value={
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+""" Test the import-time benchmark. """
+
+import benchmarks.import_benchmark as import_benchmark
+
+SAMPLE = """import time: self [us] | cumulative | imported package
+import time:       405 |        405 |     boto3
+import time:      1000 |       2000 |   shared.globals
+import time:      7340 |    1500000 | app
+"""
+
+
+def test_parse_importtime():
+    """ The header line is skipped and the timings are parsed. """
+    assert import_benchmark.parse_importtime(SAMPLE) == [
+        ("boto3", 405, 405),
+        ("shared.globals", 1000, 2000),
+        ("app", 7340, 1500000)
+    ]
+
+
+def test_check():
+    """ Eager imports of optional integrations and slow imports are reported. """
+    results = import_benchmark.parse_importtime(SAMPLE)
+    assert import_benchmark.check(results, "app", 2000) == [
+        "boto3 is imported when app is"]
+    assert import_benchmark.check(results[1:], "app", 1000) == [
+        "Importing app took 1500ms, over the 1000ms budget"]
+
+
+def test_app_imports_lazily():
+    """ Importing the app doesn't pull in any of the optional integrations. """
+    results = import_benchmark.profile("app")
+    imported = {name for name, _, _ in results}
+    assert "app" in imported
+    assert imported.isdisjoint(import_benchmark.LAZY_MODULES)
+
+
+def test_vault_imports_lazily():
+    """ boto3 and hvac are only imported when logging into Vault. """
+    results = import_benchmark.profile("shared.shared_vault")
+    imported = {name for name, _, _ in results}
+    assert "shared.shared_vault" in imported
+    assert imported.isdisjoint(import_benchmark.LAZY_MODULES)
@@ -1,11 +1,17 @@
 #!/usr/bin/python3
 """ Test the shared LDAP library. """
 
+import datetime
+import json
+import threading
+
 import mock
 import pytest
 
-from ldap3 import MODIFY_ADD
+from ldap3 import MODIFY_ADD, MODIFY_DELETE
+from ldap3.core.exceptions import LDAPCommunicationError
 import shared.shared_ldap as shared_ldap
+import shared.cache
 import shared.globals
 
 @mock.patch(
@@ -20,7 +26,7 @@ import shared.globals
 )
 def test_get_ldap_connection(mi1, mi2):
     """ Test get_ldap_connection. """
-    shared_ldap.CONNECTION = None
+    shared_ldap.POOL = None
     shared.globals.CONFIGURATION = {}
     with pytest.raises(shared_ldap.NotEnabledError):
         shared_ldap.get_ldap_connection()
@@ -33,12 +39,62 @@ def test_get_ldap_connection(mi1, mi2):
         "ldap_enabled": True,
         "ldap_server": "foo"
     }
-    result = shared_ldap.get_ldap_connection()
-    assert result == 123
+    with shared_ldap.get_ldap_connection() as result:
+        assert result == 123
     assert mi1.called is True
     assert mi2.called is True
 
 
+def test_pool_exclusive_and_reentrant():
+    """ Each thread gets its own connection and can nest borrows. """
+    created = []
+
+    def factory():
+        created.append(MockLDAP3Connection())
+        return created[-1]
+
+    pool = shared_ldap.LdapConnectionPool(factory, size=2, timeout=0.1)
+    with pool.connection() as conn1:
+        with pool.connection() as conn2:
+            assert conn1 is conn2
+        borrowed = []
+        thread = threading.Thread(
+            target=lambda: borrowed.append(pool.acquire()))
+        thread.start()
+        thread.join()
+        assert borrowed[0] is not conn1
+        # Both connections are now in use so the pool is exhausted.
+        with pytest.raises(shared_ldap.PoolExhaustedError):
+            pool.acquire()
+        pool.release(borrowed[0])
+    assert len(created) == 2
+    assert len(pool.idle) == 2
+
+
+def test_pool_rebinds_broken_connections():
+    """ A connection that fails, or is found unbound, is replaced. """
+    created = []
+
+    def factory():
+        conn = mock.Mock(closed=False, bound=True)
+        created.append(conn)
+        return conn
+
+    pool = shared_ldap.LdapConnectionPool(factory, size=1)
+    with pytest.raises(LDAPCommunicationError):
+        with pool.connection():
+            raise LDAPCommunicationError("Connection reset")
+    assert len(created) == 2
+    assert created[0].unbind.called is True
+    # Simulate the server dropping the idle connection.
+    created[1].bound = False
+    pool.idle[0] = (0, created[1])
+    with pool.connection() as conn:
+        assert conn is created[2]
+    pool.close()
+    assert created[2].unbind.called is True
+
+
 def test_cleanup_if_gmail():
     """ Test cleanup_if_gmail. """
     assert shared_ldap.cleanup_if_gmail(
@@ -53,6 +109,10 @@ class MockLDAP3Entry: # pylint: disable=too-few-public-methods
     """ Mock up the Entry class. """
     entry_dn = None
     uidNumber = MockLDAP3Value()
+    entry_attributes_as_dict = {}
+
+    def __getitem__(self, item):
+        return getattr(self, item)
 
 class MockLDAP3Info: # pylint: disable=too-few-public-methods
     """ Mock up the Info class. """
@@ -98,13 +158,15 @@ class MockLDAP3Connection: # pylint: disable=too-few-public-methods
                search_filter,
                search_scope=None,
                attributes=None,
-               paged_cookie=None):
+               paged_cookie=None,
+               paged_size=None):
         """ Fake Connection.search """
         _ = search_base
         _ = search_filter
         _ = search_scope
         _ = attributes
         _ = paged_cookie
+        _ = paged_size
         result = self.fake_search_result
         if self.flip_search_result:
             # Switch the search result so that we don't
@@ -126,6 +188,12 @@ class MockLDAP3Connection: # pylint: disable=too-few-public-methods
         assert attributes["uidNumber"] == "10002"
         return self.add_result
 
+    def delete(self, ldap_dn):
+        """ Mock the delete function. """
+        _ = self
+        _ = ldap_dn
+        return True
+
     def modify(self, ldap_dn, change):
         """
         Mock the modify function. Return the change so that the test code can
@@ -142,6 +210,13 @@ class MockLDAP3Connection: # pylint: disable=too-few-public-methods
         pass
 
 
+def use_mock_connection():
+    """ Install a connection pool that always hands out one mock connection. """
+    conn = MockLDAP3Connection()
+    shared_ldap.POOL = shared_ldap.LdapConnectionPool(lambda: conn, size=1)
+    return conn
+
+
 def test_base_dn():
     """ Test base_dn. """
     shared_ldap.BASE_DN = None
@@ -151,7 +226,7 @@ def test_base_dn():
     assert shared_ldap.base_dn() == "Test"
 
     shared_ldap.BASE_DN = None
-    shared_ldap.CONNECTION = MockLDAP3Connection()
+    conn = use_mock_connection()
     shared.globals.CONFIGURATION = {}
     assert shared_ldap.base_dn() == "naming_context_1"
 
@@ -178,39 +253,90 @@ def test_search_filter():
 def test_find_from_email():
     """ Test find_from_email. """
     shared_ldap.BASE_DN = "base_dn"
-    shared_ldap.CONNECTION = MockLDAP3Connection()
-    shared_ldap.CONNECTION.fake_search_result = True
+    conn = use_mock_connection()
+    conn.fake_search_result = True
+    assert shared_ldap.find_from_email("foo") == "entry_dn_1"
+    # Successful lookups are cached ...
+    conn.fake_search_result = False
     assert shared_ldap.find_from_email("foo") == "entry_dn_1"
-    shared_ldap.CONNECTION.fake_search_result = False
+    # ... until the object is changed, which only forgets the lookups
+    # keyed by its values.
+    shared.cache.put("ldap", "group:other", {"mail": "other", "dns": []})
+    conn.search = mock.Mock(return_value=True)
+    conn.entries = [MockDictEntry("entry_dn_1", {"mail": ["foo"]})]
+    shared_ldap.delete_object("entry_dn_1")
+    conn.search = mock.Mock(return_value=False)
     assert shared_ldap.find_from_email("foo") is None
+    assert shared.cache.get("ldap", "group:other") == {"mail": "other", "dns": []}
+
+
+class MockUidEntry: # pylint: disable=too-few-public-methods
+    """ Mock up an entry that only has the uid attribute. """
+    def __init__(self, uid):
+        self.uid = MockLDAP3Value()
+        self.uid.values = [uid]
 
 
 def test_get_best_uid():
     """ Test get_best_uid. """
     shared_ldap.BASE_DN = "base_dn"
     conn = MockLDAP3Connection()
-    conn.fake_search_result = True
-    conn.flip_search_result = True
-    # By setting the initial search result to True and
-    # flip to True, the first call to connection.search
-    # will return True then will return False. So, we
-    # should end up with a uid of "blah1".
+    conn.search = mock.Mock(return_value=True)
+    conn.entries = [
+        MockUidEntry("blah"), MockUidEntry("blah2"), MockUidEntry("blahblah")]
+    # One search is made, for every uid starting with "blah", and the
+    # lowest free suffix is worked out from the results.
     assert shared_ldap.get_best_uid(conn, "blah") == "blah1"
-    # Now, if we set the initial search result to False,
-    # the first call to connection.search will return
-    # False and so we should get the same uid back that we
-    # pass in.
-    conn.fake_search_result = False
-    conn.flip_search_result = False
+    assert conn.search.call_count == 1
+    assert conn.search.call_args[1]["search_filter"] == "(uid=blah*)"
+    assert conn.search.call_args[1]["attributes"] == ["uid"]
+    conn.entries = [MockUidEntry("Blah"), MockUidEntry("blah1")]
+    assert shared_ldap.get_best_uid(conn, "blah") == "blah2"
+    # Nothing found means the uid can be used as is.
+    conn.search = mock.Mock(return_value=False)
+    conn.entries = []
     assert shared_ldap.get_best_uid(conn, "blah") == "blah"
 
 
+def test_get_best_uid_paged():
+    """ The prefix search is paged so that a size limit can't hide a taken uid. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {"ldap_page_size": 2}
+    conn = MockLDAP3Connection()
+    pages = [
+        ([MockUidEntry("li"), MockUidEntry("li1")], "cookie"),
+        ([MockUidEntry("li2")], None)
+    ]
+
+    def mock_search(**kwargs):
+        conn.entries, cookie = pages[conn.search.call_count - 1]
+        conn.result = {"controls": {shared_ldap.PAGED_RESULTS_OID: {"value": {"cookie": cookie}}}}
+        return True
+
+    conn.search = mock.Mock(side_effect=mock_search)
+    assert shared_ldap.get_best_uid(conn, "li") == "li3"
+    assert conn.search.call_count == 2
+    assert conn.search.call_args_list[0][1]["paged_size"] == 2
+    assert conn.search.call_args_list[1][1]["paged_cookie"] == "cookie"
+
+
+def test_get_best_uid_escapes_filter():
+    """ Characters special to LDAP filters are escaped. """
+    conn = MockLDAP3Connection()
+    conn.search = mock.Mock(return_value=False)
+    conn.entries = []
+    shared_ldap.BASE_DN = "base_dn"
+    shared_ldap.get_best_uid(conn, "fred*(x)")
+    assert conn.search.call_args[1]["search_filter"] == "(uid=fred\\2a\\28x\\29*)"
+
+
 def test_calculate_uid():
     """ Test calculate_uid. """
     shared_ldap.BASE_DN = "base_dn"
-    shared_ldap.CONNECTION = MockLDAP3Connection()
-    shared_ldap.CONNECTION.fake_search_result = False
-    shared_ldap.CONNECTION.flip_search_result = False
+    conn = use_mock_connection()
+    conn.fake_search_result = False
+    conn.flip_search_result = False
+    conn.entries = []
     assert shared_ldap.calculate_uid("Fred", "Flintstone") == "fred.flintstone"
     assert shared_ldap.calculate_uid(None, "Enya") == "enya"
 
@@ -218,13 +344,13 @@ def test_calculate_uid():
 def test_find_best_ou():
     """ Test find_best_ou_for_email. """
     shared_ldap.BASE_DN = "base_dn"
-    shared_ldap.CONNECTION = MockLDAP3Connection()
-    shared_ldap.CONNECTION.fake_search_result = False
-    shared_ldap.CONNECTION.flip_search_result = False
+    conn = use_mock_connection()
+    conn.fake_search_result = False
+    conn.flip_search_result = False
     shared.globals.CONFIGURATION = {}
     assert shared_ldap.find_best_ou_for_email("fred@flintstone") == \
         "base_dn"
-    shared_ldap.CONNECTION.fake_search_result = True
+    conn.fake_search_result = True
     assert shared_ldap.find_best_ou_for_email("fred@flintstone") == \
         "entry_dn_1"
 
@@ -270,14 +396,98 @@ def mock_get_result_cookie(result):
 def test_get_next_uid_number(mi1):
     """ Test get_next_uid_number. """
     shared_ldap.BASE_DN = "base_dn"
-    shared_ldap.CONNECTION = MockLDAP3Connection()
+    conn = use_mock_connection()
     # We use a cookie counter to ensure that:
     # a) all of the code in get_next_uid_number gets tested
     # b) we don't get stuck in the while True loop
     global COOKIE_COUNT  # pylint: disable=global-statement
     COOKIE_COUNT = 0
+    shared_ldap.ID_HIGH_WATER = {}
+    shared.globals.CONFIGURATION = {}
     assert shared_ldap.get_next_uid_number() == 10002
     assert mi1.called is True
+    # The next reservation uses the cached high-water mark rather than
+    # scanning again.
+    mi1.reset_mock()
+    assert shared_ldap.get_next_uid_number() == 10003
+    assert mi1.called is False
+
+
+def test_reserve_id_numbers_unlocked_search():
+    """ ID_LOCK isn't held while searching, and threads still get distinct IDs. """
+    shared.globals.CONFIGURATION = {}
+    shared_ldap.ID_HIGH_WATER = {"uidNumber": 10000}
+    locked = []
+
+    def mock_find(*_):
+        locked.append(shared_ldap.ID_LOCK.locked())
+        return [10001]
+
+    ids = []
+    with mock.patch("shared.shared_ldap.find_ids_in_use", side_effect=mock_find):
+        threads = [
+            threading.Thread(
+                target=lambda: ids.append(
+                    shared_ldap.reserve_id_numbers("posixAccount", "uidNumber")))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert locked == [False] * 5
+    assert sorted(ids) == [10002, 10003, 10004, 10005, 10006]
+
+
+def test_reserve_id_numbers_counter():
+    """ Test reserving IDs from a counter entry with compare-and-swap. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared_ldap.ID_HIGH_WATER = {}
+    shared.globals.CONFIGURATION = {
+        "ldap_id_counters": {"uidNumber": "cn=uidNext,base_dn"}
+    }
+    counter = mock.Mock()
+    counter.uidNumber.value = "20000"
+    conn = mock.Mock()
+    conn.entries = [{"uidNumber": counter.uidNumber}]
+    # The first search reads the counter, the second checks for clashes.
+    conn.search.side_effect = [True, True, False]
+    # Another process wins the first compare-and-swap.
+    conn.modify.side_effect = [False, True]
+    shared_ldap.POOL = shared_ldap.LdapConnectionPool(lambda: conn, size=1)
+    assert shared_ldap.reserve_id_numbers("posixAccount", "uidNumber", 5) == 20000
+    assert conn.modify.call_args[0][1] == {
+        "uidNumber": [(MODIFY_DELETE, ["20000"]), (MODIFY_ADD, ["20005"])]
+    }
+    assert conn.search.call_args[1]["search_filter"] == \
+        "(&(objectclass=posixAccount)(&(uidNumber>=20000)(uidNumber<=20004)))"
+
+
+def test_settle_id_number():
+    """ Without a counter, an ID handed out twice is moved off the later DN. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {}
+    conn = use_mock_connection()
+    conn.modify = mock.Mock(return_value=True)
+    barney = "uid=barney,ou=accounts,base_dn"
+    with mock.patch(
+            "shared.shared_ldap.find_id_holders",
+            side_effect=[[FRED, barney], [FRED, barney], [FRED]]) as holders, \
+            mock.patch(
+                "shared.shared_ldap.reserve_id_numbers", return_value=20001) as reserve:
+        # Barney keeps the ID ...
+        assert shared_ldap.settle_id_number(barney, "posixAccount", "uidNumber", 20000) == 20000
+        # ... so Fred moves.
+        assert shared_ldap.settle_id_number(FRED, "posixAccount", "uidNumber", 20000) == 20001
+        assert holders.call_args_list[2][0] == ("posixAccount", "uidNumber", 20001)
+    reserve.assert_called_once_with("posixAccount", "uidNumber")
+    conn.modify.assert_called_once_with(
+        FRED, {"uidNumber": [(shared_ldap.MODIFY_REPLACE, ["20001"])]})
+    # Nothing is checked when the IDs come from a counter.
+    shared.globals.CONFIGURATION = {"ldap_id_counters": {"uidNumber": "cn=uidNext,base_dn"}}
+    with mock.patch("shared.shared_ldap.find_id_holders") as holders:
+        assert shared_ldap.settle_id_number(FRED, "posixAccount", "uidNumber", 20000) == 20000
+    holders.assert_not_called()
 
 
 def mock_get_best_uid(connection, uid):
@@ -302,41 +512,142 @@ def mock_get_best_uid(connection, uid):
 def test_create_account(mi1, mi2):
     """ Test create_account. """
     shared_ldap.BASE_DN = "base_dn"
-    shared_ldap.CONNECTION = MockLDAP3Connection()
-    shared_ldap.CONNECTION.fake_search_result = False
+    conn = use_mock_connection()
+    conn.fake_search_result = False
     global COOKIE_COUNT  # pylint: disable=global-statement
     COOKIE_COUNT = 0
     # Intially, we want a successful result ...
     shared.globals.CONFIGURATION = {}
-    shared_ldap.CONNECTION.add_result = True
+    shared_ldap.ID_HIGH_WATER = {}
+    conn.add_result = True
     shared_ldap.create_account("Fred", "Flintstone", "fred.flintstone@widget.org")
     # Fake a failure to create the account to ensure that all of the
-    # create_account code is tested.
-    shared_ldap.CONNECTION.add_result = False
+    # create_account code is tested. Forget the uidNumber reserved by the
+    # first call so that the mock sees the same value again.
+    conn.add_result = False
+    shared_ldap.ID_HIGH_WATER = {}
     shared_ldap.create_account("Fred", "Flintstone", "fred.flintstone@widget.org")
     assert mi1.called is True
     assert mi2.called is True
 
 
+@mock.patch(
+    'shared.shared_ldap.find_best_ou_for_email',
+    return_value="ou=accounts,base_dn",
+    autospec=True
+)
+@mock.patch(
+    'shared.shared_ldap.get_next_uid_number',
+    return_value=10001,
+    autospec=True
+)
+@mock.patch(
+    'shared.shared_ldap.calculate_uid',
+    side_effect=["fred.flintstone", "fred.flintstone1"],
+    autospec=True
+)
+def test_create_account_uid_taken(mi1, mi2, mi3):
+    """ A uid taken between searching and adding is recalculated. """
+    conn = use_mock_connection()
+    conn.add = mock.Mock(side_effect=[False, True])
+    conn.result = {"result": shared_ldap.ENTRY_ALREADY_EXISTS}
+    assert shared_ldap.create_account(
+        "Fred", "Flintstone", "fred.flintstone@widget.org") == \
+        "uid=fred.flintstone1,ou=accounts,base_dn"
+    assert mi1.call_count == 2
+    # The uidNumber is only reserved once.
+    assert mi2.call_count == 1
+    assert mi3.called is True
+
+
 def test_parameterised_add_to_group():
     """ Test parameterised_add_to_group. """
     shared_ldap.BASE_DN = "base_dn"
-    shared_ldap.CONNECTION = MockLDAP3Connection()
-    shared_ldap.CONNECTION.fake_search_result = True
+    shared.globals.CONFIGURATION = {"ldap_security_groups": "ou=security"}
+    conn = use_mock_connection()
+    conn.search = mock.Mock(return_value=True)
+    conn.modify = mock.Mock(return_value=True)
     assert shared_ldap.parameterised_add_to_group(
         "fake-group",
         "ldap_security_groups",
         "memberUid",
         "fred.flintstone") is True
-    shared_ldap.CONNECTION.fake_search_result = False
-    expected_results = {
-        "memberUid": [(MODIFY_ADD, ["fred.flintstone"])]
-    }
+    # There is no search to check for membership first.
+    assert conn.search.called is False
+    assert conn.modify.call_args[0] == (
+        "cn=fake-group,ou=security,base_dn",
+        {"memberUid": [(MODIFY_ADD, ["fred.flintstone"])]})
+    # Already being a member counts as success ...
+    conn.modify.return_value = False
+    conn.result = {"result": shared_ldap.ATTRIBUTE_OR_VALUE_EXISTS}
+    assert shared_ldap.parameterised_add_to_group(
+        "fake-group",
+        "ldap_security_groups",
+        "memberUid",
+        "fred.flintstone") is True
+    # ... but other failures don't.
+    conn.result = {"result": 50}
     assert shared_ldap.parameterised_add_to_group(
         "fake-group",
         "ldap_security_groups",
         "memberUid",
-        "fred.flintstone") == expected_results
+        "fred.flintstone") is False
+    conn.result = {"result": shared_ldap.NO_SUCH_ATTRIBUTE}
+    assert shared_ldap.parameterised_remove_from_group(
+        "fake-group",
+        "ldap_security_groups",
+        "memberUid",
+        "fred.flintstone") is True
+    assert conn.modify.call_args[0][1] == {
+        "memberUid": [(MODIFY_DELETE, ["fred.flintstone"])]}
+    assert conn.search.called is False
+
+
+def test_add_members_to_group():
+    """ A whole list is applied with one modify per group. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {
+        "ldap_security_groups": "ou=security",
+        "ldap_mailing_groups": "ou=mailing"
+    }
+    conn = use_mock_connection()
+    conn.search = mock.Mock(return_value=True)
+    conn.modify = mock.Mock(return_value=True)
+    barney = "uid=barney,ou=accounts,base_dn"
+    team = "cn=team,ou=mailing,base_dn"
+    assert shared_ldap.add_members_to_group("group", [FRED, barney, team]) == {
+        FRED: shared_ldap.MEMBER_ADDED,
+        barney: shared_ldap.MEMBER_ADDED,
+        team: shared_ldap.MEMBER_ADDED
+    }
+    assert conn.modify.call_args_list == [
+        mock.call("cn=group,ou=security,base_dn",
+                  {"memberUid": [(MODIFY_ADD, ["fred.flintstone", "barney"])]}),
+        mock.call("cn=group,ou=mailing,base_dn",
+                  {"uniqueMember": [(MODIFY_ADD, [FRED, barney, team])]})
+    ]
+    assert conn.search.called is False
+    # When some members are there already, the group is read once and only
+    # the missing ones are added.
+    conn.modify = mock.Mock(side_effect=[False, True, True])
+    conn.result = {"result": shared_ldap.ATTRIBUTE_OR_VALUE_EXISTS}
+    conn.entries = [MockDictEntry(
+        "cn=group,ou=security,base_dn", {"memberUid": ["Fred.Flintstone"]})]
+    assert shared_ldap.add_members_to_group("group", [FRED, barney]) == {
+        FRED: shared_ldap.MEMBER_ADDED,
+        barney: shared_ldap.MEMBER_ADDED
+    }
+    assert conn.modify.call_args_list[1] == mock.call(
+        "cn=group,ou=security,base_dn",
+        {"memberUid": [(MODIFY_ADD, ["barney"])]})
+    assert conn.search.call_count == 1
+    # A failure to change the security group is reported.
+    conn.modify = mock.Mock(side_effect=[False, True])
+    conn.result = {"result": 50}
+    assert shared_ldap.remove_members_from_group("group", [FRED, team]) == {
+        FRED: shared_ldap.MEMBER_FAILED,
+        team: shared_ldap.MEMBER_REMOVED
+    }
 
 
 def mock_parameterised_add_to_group_sec_test(
@@ -438,3 +749,548 @@ def test_is_dn_in_group(mi1):
     result = shared_ldap.is_dn_in_group("mock_test_group_name", "uid=fred.flintstone,ou=accounts,base_dn")
     assert result is True
     assert mi1.called is True
+
+
+class MockAttribute: # pylint: disable=too-few-public-methods
+    """ Mock up an attribute with values. """
+    def __init__(self, values):
+        self.values = values
+        self.value = values[0] if values != [] else None
+
+
+class MockGroupEntry: # pylint: disable=too-few-public-methods
+    """ Mock up a mailing group entry. """
+    def __init__(self, name, members, stamp):
+        self.entry_dn = f"cn={name},ou=mailing,base_dn"
+        self.cn = MockAttribute([name])
+        self.uniqueMember = MockAttribute(members)
+        self.modifyTimestamp = MockAttribute([stamp])
+
+
+FRED = "uid=fred.flintstone,ou=accounts,base_dn"
+
+
+@mock.patch(
+    "shared.shared_ldap.parameterised_member_of_group",
+    return_value=False,
+    autospec=True
+)
+def test_group_graph(mi1):
+    """ Nested membership is resolved from the graph, safely with cycles. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {"ldap_mailing_groups": "ou=mailing"}
+    groups = [
+        MockGroupEntry("outer", ["cn=inner,ou=mailing,base_dn"], "20230101000000Z"),
+        MockGroupEntry(
+            "inner", ["cn=Outer,ou=mailing,base_dn", "", FRED], "20230102000000Z"),
+        MockGroupEntry("other", ["uid=barney,ou=accounts,base_dn"], "20230103000000Z"),
+    ]
+    with mock.patch(
+            "shared.shared_ldap.paged_search",
+            return_value=groups) as fetch:
+        assert shared_ldap.is_dn_in_group("outer", FRED, True) is True
+        assert shared_ldap.is_dn_in_group("other", FRED, True) is False
+        assert shared_ldap.is_dn_in_group("missing", FRED, True) is False
+        assert shared_ldap.is_dn_in_group("inner", FRED, True) is True
+        assert shared_ldap.is_dn_in_group("outer", FRED, False) is False
+        # Everything is loaded by one search and only the non-recursive
+        # check searches LDAP for the group itself.
+        assert fetch.call_count == 1
+        assert mi1.call_count == 1
+        assert fetch.call_args[0][2] == "ou=mailing,base_dn"
+        graph = shared_ldap.GROUP_GRAPH
+        assert graph.high_water == "20230103000000Z"
+        assert graph.closure("outer") == {
+            "cn=inner,ou=mailing,base_dn", "cn=outer,ou=mailing,base_dn",
+            FRED.lower()}
+        # Our own changes are applied without going back to LDAP.
+        shared_ldap.note_group_change(
+            "cn=other,ou=mailing,base_dn", added=["cn=inner,ou=mailing,base_dn"])
+        assert shared_ldap.is_dn_in_group("other", FRED, True) is True
+        shared_ldap.note_group_change("cn=inner,ou=mailing,base_dn", removed=[FRED])
+        assert shared_ldap.is_dn_in_group("outer", FRED, True) is False
+        assert fetch.call_count == 1
+        # Once the refresh interval has passed, only the groups changed
+        # since the newest timestamp seen are fetched.
+        fetch.return_value = [
+            MockGroupEntry("other", [], "20230104000000Z")]
+        graph.loaded_at -= shared_ldap.DEFAULT_GROUP_REFRESH
+        assert shared_ldap.is_dn_in_group("other", FRED, True) is False
+        assert fetch.call_count == 2
+        assert "(modifyTimestamp>=20230103000000Z)" in fetch.call_args[0][0]
+        assert graph.high_water == "20230104000000Z"
+        # A failed move or delete leaves the group in the graph.
+        conn = use_mock_connection()
+        conn.modify_dn = mock.Mock(return_value=False)
+        conn.delete = mock.Mock(return_value=False)
+        assert shared_ldap.move_object(
+            "cn=inner,ou=mailing,base_dn", "ou=other,base_dn") is not None
+        shared_ldap.delete_object("cn=inner,ou=mailing,base_dn")
+        assert "cn=inner,ou=mailing,base_dn" in graph.members
+        conn.delete.return_value = True
+        shared_ldap.delete_object("cn=inner,ou=mailing,base_dn")
+        assert "cn=inner,ou=mailing,base_dn" not in graph.members
+    assert mi1.called is True
+
+
+def test_generalized_time():
+    """ Timestamps are converted to GeneralizedTime in UTC. """
+    stamp = datetime.datetime(
+        2023, 1, 2, 4, 5, 6,
+        tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    assert shared_ldap.generalized_time(stamp) == "20230102020506Z"
+    assert shared_ldap.generalized_time("20230102020506Z") == "20230102020506Z"
+
+
+def test_flatten_list():
+    """ Groups are expanded in place, once each, without duplicates. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {
+        "ldap_enabled": True,
+        "ldap_mailing_groups": "ou=mailing"
+    }
+    barney = "uid=barney,ou=accounts,base_dn"
+    wilma = "uid=wilma,ou=accounts,base_dn"
+    groups = [
+        MockGroupEntry(
+            "outer",
+            [barney, "cn=inner,ou=mailing,base_dn", FRED.upper()],
+            "20230101000000Z"),
+        MockGroupEntry(
+            "inner", [FRED, "cn=outer,ou=mailing,base_dn", wilma], "20230101000000Z"),
+    ]
+    with mock.patch(
+            "shared.shared_ldap.paged_search",
+            return_value=groups) as fetch:
+        assert shared_ldap.flatten_list(
+            [wilma, "", "cn=outer,ou=mailing,base_dn", "cn=inner,ou=mailing,base_dn"]) == \
+            [wilma, barney, FRED]
+        assert shared_ldap.get_group_membership("inner") == [FRED, barney, wilma]
+        assert shared_ldap.get_group_membership(
+            "cn=outer,ou=mailing,base_dn") == [barney, FRED, wilma]
+        assert shared_ldap.get_group_membership("missing") == []
+        assert fetch.call_count == 1
+    shared.globals.CONFIGURATION = {}
+    assert shared_ldap.flatten_list(["a", "a"]) == ["a", "a"]
+
+
+class MockDictEntry: # pylint: disable=too-few-public-methods
+    """ Mock up an entry that is read through entry_attributes_as_dict. """
+    def __init__(self, entry_dn, attributes):
+        self.entry_dn = entry_dn
+        self.entry_attributes_as_dict = attributes
+
+
+def test_find_single_object_from_email():
+    """ One search is made and the precedence rules applied locally. """
+    group = MockDictEntry(
+        "cn=team,ou=mailing,base_dn",
+        {"objectClass": ["groupOfUniqueNames"], "mail": ["team@widget.org"]})
+    alias = MockDictEntry(
+        "uid=fred,ou=accounts,base_dn",
+        {"objectClass": ["posixAccount"], "mail": ["fred@widget.org"],
+         "aRecord": ["team@widget.org"]})
+    uncleaned = MockDictEntry(
+        "uid=barney,ou=accounts,base_dn",
+        {"objectClass": ["posixAccount"], "mail": ["bar.ney@gmail.com"]})
+    cleaned = MockDictEntry(
+        "uid=barney2,ou=accounts,base_dn",
+        {"objectClass": ["posixAccount"], "mail": ["barney@gmail.com"]})
+    shared.globals.CONFIGURATION = {}
+    with mock.patch(
+            "shared.shared_ldap.find_matching_objects",
+            return_value=[alias, group]) as fetch:
+        # The group wins over the account using the address as an alias.
+        assert shared_ldap.find_single_object_from_email("Team@widget.org") == \
+            "cn=team,ou=mailing,base_dn"
+        assert fetch.call_count == 1
+        assert "(aRecord=Team@widget.org)" in fetch.call_args[0][0]
+        fetch.return_value = [alias]
+        assert shared_ldap.find_single_object_from_email("team@widget.org") == \
+            "cn=team,ou=mailing,base_dn"
+        # The answer was cached.
+        assert fetch.call_count == 1
+        fetch.return_value = [uncleaned, cleaned]
+        assert shared_ldap.find_single_object_from_email("bar.ney@gmail.com") == \
+            "uid=barney2,ou=accounts,base_dn"
+        fetch.return_value = [uncleaned]
+        assert shared_ldap.find_single_object_from_email("bar.n.ey@gmail.com") is None
+        fetch.return_value = None
+        assert shared_ldap.find_single_object_from_email("nobody@widget.org") is None
+        assert shared_ldap.find_single_object_from_email("nobody@widget.org") is None
+        assert fetch.call_count == 4
+
+
+def test_get_object_cache():
+    """ Entries are cached by DN and attribute sets are merged. """
+    shared.globals.CONFIGURATION = {}
+    conn = use_mock_connection()
+    conn.search = mock.Mock(return_value=True)
+    conn.entries = [MockDictEntry(FRED, {"mail": ["fred@widget.org"]})]
+    entry = shared_ldap.get_object(FRED, ["mail"])
+    assert entry.mail.value == "fred@widget.org"
+    assert entry["mail"].values == ["fred@widget.org"]
+    assert shared_ldap.get_email_address(FRED.upper()) == "fred@widget.org"
+    assert conn.search.call_count == 1
+    # Asking for another attribute fetches both and caches the result.
+    conn.entries = [MockDictEntry(
+        FRED, {"mail": ["fred@widget.org"], "manager": ["uid=boss,base_dn"]})]
+    entry = shared_ldap.get_object(FRED, ["manager"])
+    assert conn.search.call_args[1]["attributes"] == ["mail", "manager"]
+    assert entry.manager.value == "uid=boss,base_dn"
+    entry = shared_ldap.get_object(FRED, ["mail", "manager", "cn"])
+    assert entry.cn.value is None
+    assert entry.cn.values == []
+    assert conn.search.call_count == 3
+    shared_ldap.get_object(FRED, ["cn"])
+    assert conn.search.call_count == 3
+    # Changing the object forgets the cached copy.
+    conn.modify = mock.Mock(return_value=True)
+    shared_ldap.replace_attribute_value(FRED, "cn", "Fred")
+    shared_ldap.get_object(FRED, ["cn"])
+    assert conn.search.call_count == 4
+    # Objects that can't be found aren't cached.
+    conn.search = mock.Mock(return_value=False)
+    assert shared_ldap.get_object("uid=nobody,base_dn", ["mail"]) is None
+    assert shared_ldap.get_object("uid=nobody,base_dn", ["mail"]) is None
+    assert conn.search.call_count == 2
+
+
+def test_cached_entry():
+    """ Cached entries behave like ldap3 entries. """
+    entry = shared_ldap.CachedEntry(
+        FRED, {"cn": ["Fred"], "owner": ["cn=a,base_dn", "cn=b,base_dn"]})
+    assert str(entry.cn) == "Fred"
+    assert entry.cn == "Fred"
+    assert str(entry.owner) == "['cn=a,base_dn', 'cn=b,base_dn']"
+    assert list(entry.owner) == ["cn=a,base_dn", "cn=b,base_dn"]
+    assert len(entry.owner) == 2
+    assert entry.owner[1] == "cn=b,base_dn"
+    assert "CN" in entry
+    assert "mail" not in entry
+    assert entry.entry_attributes == ["cn", "owner"]
+    assert json.loads(entry.entry_to_json()) == {
+        "dn": FRED, "attributes": {"cn": ["Fred"], "owner": ["cn=a,base_dn", "cn=b,base_dn"]}}
+
+
+def test_move_object_clears_cache_afterwards():
+    """ A lookup made while the object is moving can't leave the old DN cached. """
+    shared.globals.CONFIGURATION = {}
+    conn = use_mock_connection()
+    conn.search = mock.Mock(return_value=True)
+    conn.entries = [MockDictEntry(FRED, {"mail": ["fred@widget.org"]})]
+    shared.cache.put("ldap", "group:team", {"mail": "team@widget.org", "dns": []})
+
+    def modify_dn(*_, **__):
+        shared.cache.put("ldap", "mail=fred@widget.org", FRED)
+        return True
+
+    conn.modify_dn = mock.Mock(side_effect=modify_dn)
+    assert shared_ldap.move_object(FRED, "ou=former,base_dn") is None
+    assert shared.cache.get("ldap", "mail=fred@widget.org") is None
+    assert shared.cache.get("ldap", shared_ldap.entry_cache_key(FRED)) is None
+    # Lookups unrelated to the object are kept.
+    assert shared.cache.get("ldap", "group:team") is not None
+
+
+def test_batch_lookups():
+    """ Batches are run concurrently, one pooled connection per worker. """
+    shared.globals.CONFIGURATION = {}
+    shared_ldap.BASE_DN = "base_dn"
+    shared_ldap.EXECUTOR = None
+    threads = set()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def factory():
+        conn = MockLDAP3Connection()
+        conn.search = mock.Mock(side_effect=search)
+        return conn
+
+    def search(object_dn, **_):
+        threads.add(threading.current_thread().name)
+        # Both searches must be in progress at the same time.
+        barrier.wait()
+        shared_ldap.get_ldap_pool().local.conn.entries = [
+            MockDictEntry(object_dn, {"mail": [f"{object_dn[4:]}@widget.org"]})]
+        return True
+
+    shared_ldap.POOL = shared_ldap.LdapConnectionPool(factory, size=2)
+    result = shared_ldap.get_objects(["uid=a", "uid=b", "uid=a"], ["mail"])
+    assert list(result) == ["uid=a", "uid=b"]
+    assert result["uid=b"].mail.value == "b@widget.org"
+    assert len(threads) == 2
+    with mock.patch(
+            "shared.shared_ldap.is_dn_in_group",
+            side_effect=lambda name, dn, recurse: name == "yes"):
+        assert shared_ldap.is_dn_in_groups(["yes", "no"], FRED) == \
+            {"yes": True, "no": False}
+    with mock.patch(
+            "shared.shared_ldap.find_from_email",
+            side_effect=lambda address: None):
+        assert shared_ldap.find_from_emails(["x@y.org"]) == {"x@y.org": None}
+    shared_ldap.EXECUTOR.shutdown()
+    shared_ldap.EXECUTOR = None
+
+
+def test_paged_search():
+    """ Pages are fetched until the server stops sending a cookie. """
+    shared.globals.CONFIGURATION = {}
+    conn = use_mock_connection()
+    pages = [["a", "b"], ["c"]]
+    cookies = [b"next", b""]
+
+    def search(**kwargs):
+        conn.entries = pages.pop(0)
+        conn.result = {"controls": {shared_ldap.PAGED_RESULTS_OID: {
+            "value": {"cookie": cookies.pop(0)}}}}
+        return kwargs["paged_size"] == shared_ldap.DEFAULT_PAGE_SIZE
+
+    conn.search = mock.Mock(side_effect=search)
+    assert shared_ldap.paged_search("(cn=*)", ["cn"], "base_dn") == ["a", "b", "c"]
+    assert conn.search.call_args[1]["paged_cookie"] == b"next"
+
+
+def test_iter_matching_objects():
+    """ Entries are yielded a page at a time and early exits abandon the search. """
+    shared.globals.CONFIGURATION = {"ldap_page_size": 2}
+    shared_ldap.BASE_DN = "base_dn"
+    conn = use_mock_connection()
+    pages = [["a", "b"], ["c"]]
+
+    def search(**kwargs):
+        if kwargs["paged_size"] == 0:
+            conn.entries = []
+            conn.result = {}
+            return False
+        conn.entries = pages[0 if "paged_cookie" not in kwargs else 1]
+        cookie = b"next" if "paged_cookie" not in kwargs else b""
+        conn.result = {"controls": {shared_ldap.PAGED_RESULTS_OID: {
+            "value": {"cookie": cookie}}}}
+        return True
+
+    conn.search = mock.Mock(side_effect=search)
+    results = shared_ldap.iter_matching_objects("(cn=*)", ["cn"])
+    assert conn.search.called is False
+    assert next(results) == "a"
+    assert conn.search.call_count == 1
+    assert conn.search.call_args[1]["paged_size"] == 2
+    results.close()
+    # Stopping early sends a zero-sized page with the cookie.
+    assert conn.search.call_count == 2
+    assert conn.search.call_args[1]["paged_size"] == 0
+    assert conn.search.call_args[1]["paged_cookie"] == b"next"
+    # The connection went back to the pool.
+    assert len(shared_ldap.POOL.idle) == 1
+    conn.search.reset_mock()
+    assert list(shared_ldap.iter_matching_objects("(cn=*)", ["cn"])) == ["a", "b", "c"]
+    assert conn.search.call_count == 2
+
+
+def test_find_group_cache():
+    """ Group resolution is cached, including Google aliases and misses. """
+    shared.globals.CONFIGURATION = {"google_enabled": True}
+    group = MockDictEntry(
+        "cn=team,ou=mailing,base_dn",
+        {"cn": ["team"], "mail": ["team@widget.org"], "owner": [FRED]})
+    with mock.patch(
+            "shared.shared_ldap.find_matching_objects",
+            side_effect=[[], [group]]) as fetch, \
+            mock.patch(
+                "shared.shared_google.lookup_group_alias",
+                return_value="team@widget.org") as alias:
+        name, result = shared_ldap.find_group("old-team@widget.org", ["owner"])
+        assert name == "team@widget.org"
+        assert result[0].owner.values == [FRED]
+        assert fetch.call_count == 2
+        # The entry was cached by the search so reading it is free, and
+        # both the alias and the canonical address are now known.
+        name, result = shared_ldap.find_group("Old-Team@widget.org", ["owner", "cn"])
+        assert result[0].cn.value == "team"
+        _, result = shared_ldap.find_group("team@widget.org", ["owner"])
+        assert result[0].entry_dn == "cn=team,ou=mailing,base_dn"
+        assert fetch.call_count == 2
+        assert alias.call_count == 1
+    with mock.patch(
+            "shared.shared_ldap.find_matching_objects",
+            return_value=None) as fetch, \
+            mock.patch(
+                "shared.shared_google.lookup_group_alias",
+                return_value=None) as alias:
+        assert shared_ldap.find_group("nobody", ["owner"]) == ("nobody", [])
+        assert shared_ldap.find_group("nobody", ["owner"]) == ("nobody", [])
+        assert fetch.call_count == 1
+        assert alias.called is False
+
+
+def test_prefetch_groups():
+    """ Every group is resolved by one paged search plus Google's aliases. """
+    shared.globals.CONFIGURATION = {"google_enabled": True}
+    group = MockGroupEntry("team", [], "20230101000000Z")
+    group.mail = MockAttribute(["team@widget.org"])
+    with mock.patch(
+            "shared.shared_ldap.iter_matching_objects",
+            return_value=iter([group])), \
+            mock.patch(
+                "shared.shared_google.list_group_aliases",
+                return_value={"crew@widget.org": "team@widget.org"}):
+        assert shared_ldap.prefetch_groups() == 3
+    with mock.patch("shared.shared_ldap.find_matching_objects") as fetch:
+        assert shared_ldap.resolve_group("crew@widget.org") == {
+            "mail": "team@widget.org", "dns": ["cn=team,ou=mailing,base_dn"]}
+        assert shared_ldap.resolve_group("TEAM")["mail"] == "team@widget.org"
+        assert fetch.called is False
+
+
+def test_find_owner_path():
+    """ The owner list is checked in one pass and the granting path returned. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {"ldap_mailing_groups": "ou=mailing"}
+    barney = "uid=barney,ou=accounts,base_dn"
+    groups = [
+        MockGroupEntry("admins", ["cn=Staff,ou=mailing,base_dn"], "20230101000000Z"),
+        MockGroupEntry("staff", ["cn=admins,ou=mailing,base_dn", FRED], "20230101000000Z"),
+        MockGroupEntry("empty", [], "20230101000000Z"),
+    ]
+    owners = [
+        "cn=empty,ou=mailing,base_dn",
+        barney,
+        "cn=admins,ou=mailing,base_dn"
+    ]
+    with mock.patch(
+            "shared.shared_ldap.paged_search",
+            return_value=groups) as fetch:
+        assert shared_ldap.find_owner_path(FRED, owners) == [
+            "cn=admins,ou=mailing,base_dn", "cn=staff,ou=mailing,base_dn", FRED]
+        assert shared_ldap.find_owner_path(barney.upper(), owners) == [barney]
+        assert shared_ldap.find_owner_path(
+            "uid=wilma,ou=accounts,base_dn", owners) is None
+        assert fetch.call_count == 1
+        shared.globals.REPORTER = "fred@widget.org"
+        with mock.patch(
+                "shared.shared_ldap.find_from_email",
+                return_value=FRED):
+            assert shared_ldap.reporter_is_group_owner(owners) is True
+            assert shared_ldap.reporter_is_group_owner([barney]) is False
+
+
+class MockAccountEntry: # pylint: disable=too-few-public-methods
+    """ Mock up an account entry with a manager. """
+    def __init__(self, uid, manager, stamp="20230101000000Z"):
+        self.entry_dn = f"uid={uid},ou=accounts,base_dn"
+        self.manager = MockAttribute(
+            [] if manager is None else [f"uid={manager},ou=accounts,base_dn"])
+        self.mail = MockAttribute([f"{uid}@widget.org"])
+        self.modifyTimestamp = MockAttribute([stamp])
+
+
+def test_manager_chain():
+    """ Management chains are followed from the graph, stopping at loops. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {}
+    accounts = [
+        MockAccountEntry("fred", "mr.slate"),
+        MockAccountEntry("mr.slate", "ceo"),
+        MockAccountEntry("ceo", None),
+        MockAccountEntry("loop1", "loop2"),
+        MockAccountEntry("loop2", "loop1"),
+    ]
+    with mock.patch(
+            "shared.shared_ldap.paged_search",
+            return_value=accounts) as fetch:
+        assert shared_ldap.get_manager_chain("uid=FRED,ou=accounts,base_dn") == [
+            ("uid=mr.slate,ou=accounts,base_dn", "mr.slate@widget.org"),
+            ("uid=ceo,ou=accounts,base_dn", "ceo@widget.org")
+        ]
+        assert shared_ldap.find_manager(
+            "uid=fred,ou=accounts,base_dn",
+            lambda dn, mail: mail.startswith("ceo")) == \
+            ("uid=ceo,ou=accounts,base_dn", "ceo@widget.org")
+        assert shared_ldap.find_manager(
+            "uid=fred,ou=accounts,base_dn", lambda dn, mail: False) is None
+        assert shared_ldap.get_manager_chain("uid=loop1,ou=accounts,base_dn") == [
+            ("uid=loop2,ou=accounts,base_dn", "loop2@widget.org")]
+        assert fetch.call_count == 1
+        assert fetch.call_args[0][0] == "(&(objectClass=posixAccount))"
+        # The direct manager is also answered from the graph ...
+        conn = use_mock_connection()
+        conn.search = mock.Mock(return_value=False)
+        assert shared_ldap.get_manager_from_dn(
+            "uid=fred,ou=accounts,base_dn") == "mr.slate@widget.org"
+        assert shared_ldap.get_manager_from_dn("uid=ceo,ou=accounts,base_dn") is None
+        conn.search.assert_not_called()
+        # ... with LDAP only searched for accounts that aren't in it.
+        assert shared_ldap.get_manager_from_dn("uid=nobody,ou=accounts,base_dn") is None
+        assert conn.search.call_count == 1
+        # Our own changes are applied without going back to LDAP.
+        conn.modify = mock.Mock(return_value=True)
+        shared_ldap.replace_attribute_value(
+            "uid=fred,ou=accounts,base_dn", "manager", "uid=ceo,ou=accounts,base_dn")
+        assert [dn for dn, _ in shared_ldap.get_manager_chain(
+            "uid=fred,ou=accounts,base_dn")] == ["uid=ceo,ou=accounts,base_dn"]
+        assert fetch.call_count == 1
+        # Later, only the accounts that have changed are fetched.
+        fetch.return_value = [MockAccountEntry("ceo", "fred", "20230102000000Z")]
+        shared_ldap.MANAGER_GRAPH.loaded_at -= shared_ldap.DEFAULT_GROUP_REFRESH
+        assert [dn for dn, _ in shared_ldap.get_manager_chain(
+            "uid=mr.slate,ou=accounts,base_dn")] == [
+                "uid=ceo,ou=accounts,base_dn", "uid=fred,ou=accounts,base_dn"]
+        assert "(modifyTimestamp>=20230101000000Z)" in fetch.call_args[0][0]
+        # Failed changes leave the graph alone.
+        conn.modify.return_value = False
+        conn.modify_dn = mock.Mock(return_value=False)
+        conn.delete = mock.Mock(return_value=False)
+        shared_ldap.replace_attribute_value("uid=fred,ou=accounts,base_dn", "manager", None)
+        shared_ldap.move_object("uid=ceo,ou=accounts,base_dn", "ou=former,base_dn")
+        shared_ldap.delete_object("uid=ceo,ou=accounts,base_dn")
+        assert [dn for dn, _ in shared_ldap.get_manager_chain(
+            "uid=fred,ou=accounts,base_dn")] == ["uid=ceo,ou=accounts,base_dn"]
+
+
+def test_create_accounts():
+    """ A batch is created with one search each for OUs and uids. """
+    shared_ldap.BASE_DN = "base_dn"
+    # With a counter, the uidNumbers don't need checking after the adds.
+    shared.globals.CONFIGURATION = {
+        "ldap_default_account_ou": "ou=accounts",
+        "ldap_id_counters": {"uidNumber": "cn=uidNext,base_dn"}
+    }
+    shared_ldap.EXECUTOR = None
+    conn = use_mock_connection()
+
+    def search(search_base, search_filter, **_):
+        if search_filter.startswith("(|(mail="):
+            conn.entries = [MockDictEntry(
+                "ou=staff,ou=accounts,base_dn", {"mail": ["widget.org"]})]
+            conn.entries[0].mail = MockAttribute(["widget.org"])
+        else:
+            conn.entries = [MockUidEntry("fred.flintstone")]
+        return True
+
+    conn.search = mock.Mock(side_effect=search)
+    conn.add = mock.Mock(return_value=True)
+    with mock.patch(
+            "shared.shared_ldap.reserve_id_numbers",
+            return_value=20000) as reserve:
+        results = shared_ldap.create_accounts([
+            ("Fred", "Flintstone", "fred@widget.org"),
+            ("Fred", "Flintstone", "fred@quarry.org", "secret"),
+            (None, "Enya", "enya@widget.org")
+        ])
+    reserve.assert_called_once_with("posixAccount", "uidNumber", 3)
+    assert conn.search.call_count == 2
+    assert conn.search.call_args_list[1][1]["search_filter"] == \
+        "(|(uid=fred.flintstone*)(uid=enya*))"
+    assert results == [
+        {"email": "fred@widget.org", "uid": "fred.flintstone1",
+         "uidNumber": 20000, "dn": "uid=fred.flintstone1,ou=staff,ou=accounts,base_dn"},
+        {"email": "fred@quarry.org", "uid": "fred.flintstone2",
+         "uidNumber": 20001, "dn": "uid=fred.flintstone2,ou=accounts,base_dn"},
+        {"email": "enya@widget.org", "uid": "enya",
+         "uidNumber": 20002, "dn": "uid=enya,ou=staff,ou=accounts,base_dn"}
+    ]
+    added = {call[0][0]: call[1]["attributes"] for call in conn.add.call_args_list}
+    assert added["uid=fred.flintstone2,ou=accounts,base_dn"]["userPassword"] == "secret"
+    assert added["uid=enya,ou=staff,ou=accounts,base_dn"]["uidNumber"] == "20002"
+    if shared_ldap.EXECUTOR is not None:
+        shared_ldap.EXECUTOR.shutdown()
+        shared_ldap.EXECUTOR = None
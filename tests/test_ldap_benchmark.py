@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+""" Test the LDAP benchmark harness at a small scale. """
+
+import pytest
+
+import benchmarks.ldap_benchmark as ldap_benchmark
+import shared.globals
+import shared.shared_ldap as shared_ldap
+
+
+@pytest.fixture(autouse=True)
+def restore_ldap_setup(monkeypatch):
+    """
+    Put back the configuration and connection pool that install() replaces,
+    so that later tests don't run against the mock directory.
+    """
+    monkeypatch.setattr(shared.globals, "CONFIGURATION", shared.globals.CONFIGURATION)
+    monkeypatch.setattr(shared_ldap, "POOL", shared_ldap.POOL)
+    monkeypatch.setattr(shared_ldap, "BASE_DN", shared_ldap.BASE_DN)
+    monkeypatch.setattr(shared_ldap, "EXECUTOR", shared_ldap.EXECUTOR)
+    monkeypatch.setattr(shared_ldap, "ID_HIGH_WATER", shared_ldap.ID_HIGH_WATER)
+
+
+def test_benchmark_directory():
+    """ The synthetic directory answers the framework's lookups. """
+    conn = ldap_benchmark.CountingConnection(
+        ldap_benchmark.build_directory(100, 3, 5))
+    ldap_benchmark.install(conn)
+    assert shared_ldap.find_single_object_from_email("alias7@example.org") == \
+        ldap_benchmark.account_dn(7)
+    assert shared_ldap.is_dn_in_group("group0", ldap_benchmark.account_dn(10), True)
+    assert len(shared_ldap.flatten_list([ldap_benchmark.group_dn(0)])) == 15
+    assert shared_ldap.calculate_uid("Fred", "Flintstone") == \
+        f"fred.flintstone{ldap_benchmark.NAMESAKES}"
+    assert shared_ldap.get_manager_from_dn(ldap_benchmark.account_dn(42)) == \
+        "user4@example.org"
+    assert conn.count > 0
+
+
+def test_benchmark_state_restored():
+    """ The previous test's mock directory is no longer installed. """
+    assert shared_ldap.BASE_DN != ldap_benchmark.BASE_DN
+    assert shared.globals.config("ldap_base_dn") != ldap_benchmark.BASE_DN
+
+
+def test_benchmark_run():
+    """ Every operation is measured cold and warm. """
+    results = ldap_benchmark.run(100, 3, 5)
+    assert [name for name, _, _ in results] == \
+        [name for name, _ in ldap_benchmark.operations(100, 3, 5)]
+    for _, cold, warm in results:
+        assert cold[1] >= warm[1]
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+""" Test the LDAP replica. """
+
+import mock
+
+import shared.globals
+import shared.ldap_replica as ldap_replica
+import shared.shared_ldap as shared_ldap
+
+
+class MockEntry: # pylint: disable=too-few-public-methods
+    """ Mock up an ldap3 entry. """
+    def __init__(self, entry_dn, attributes):
+        self.entry_dn = entry_dn
+        self.entry_attributes_as_dict = attributes
+
+
+FRED = "uid=fred,ou=accounts,base_dn"
+TEAM = "cn=team,ou=mailing,base_dn"
+
+
+def fred(stamp="20230101000000Z", mail="fred@widget.org"):
+    """ Return an entry for Fred. """
+    return MockEntry(FRED, {
+        "objectClass": ["posixAccount"],
+        "uid": ["fred"],
+        "mail": [mail],
+        "aRecord": ["fred.flintstone@widget.org"],
+        "modifyTimestamp": [stamp]
+    })
+
+
+def team():
+    """ Return an entry for a mailing group. """
+    return MockEntry(TEAM, {
+        "objectClass": ["groupOfUniqueNames"],
+        "cn": ["team"],
+        "mail": ["team@widget.org"],
+        "uniqueMember": [FRED],
+        "modifyTimestamp": ["20230102000000Z"]
+    })
+
+
+@mock.patch("shared.shared_ldap.paged_search", autospec=True)
+def test_replica_answers_reads(mi1):
+    """ Reads are answered from the replica without searching LDAP. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {"ldap_replica_enabled": True}
+    mi1.return_value = [fred(), team()]
+    with mock.patch("shared.shared_ldap.get_ldap_connection") as mi2:
+        assert shared_ldap.find_from_email("FRED@widget.org") == FRED
+        assert shared_ldap.find_single_object_from_email(
+            "fred.flintstone@widget.org") == FRED
+        assert shared_ldap.find_single_object_from_email("team@widget.org") == TEAM
+        assert shared_ldap.get_object(TEAM, ["uniqueMember"]).uniqueMember.values == [FRED]
+        assert shared_ldap.get_object(FRED, ["cn"]).cn.values == []
+        assert mi2.called is False
+    assert mi1.call_count == 1
+    assert "(objectClass=posixAccount)" in mi1.call_args[0][0]
+    metrics = shared_ldap.REPLICA.get_metrics()
+    assert metrics["entries"] == 2
+    assert metrics["full_loads"] == 1
+    assert metrics["high_water"] == "20230102000000Z"
+    assert metrics["usable"] is True
+
+
+@mock.patch("shared.shared_ldap.paged_search", autospec=True)
+def test_replica_sync(mi1):
+    """ Changes are fetched by modifyTimestamp and failures are tolerated. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {}
+    mi1.return_value = [fred(), team()]
+    replica = ldap_replica.create_replica()
+    mi1.return_value = [fred("20230103000000Z", "fred@example.org")]
+    assert replica.sync() is True
+    assert "(modifyTimestamp>=20230102000000Z)" in mi1.call_args[0][0]
+    assert replica.find("mail", "fred@widget.org") == []
+    assert replica.find("mail", "fred@example.org")[0].entry_dn == FRED
+    assert replica.high_water == "20230103000000Z"
+    # The framework's own changes are applied straight away.
+    replica.apply_change(TEAM, "uniqueMember", removed=[FRED.upper()])
+    assert replica.get(TEAM, ["uniqueMember"]).uniqueMember.values == []
+    assert replica.is_due() is True
+    replica.forget(FRED)
+    assert replica.get(FRED, ["mail"]) is None
+    assert replica.find("mail", "fred@example.org") == []
+    # Attributes the replica doesn't hold aren't answered from it.
+    assert replica.get(TEAM, ["jpegPhoto"]) is None
+    mi1.side_effect = Exception("Server down")
+    assert replica.sync() is False
+    assert replica.get_metrics()["sync_failures"] == 1
+    assert replica.is_usable() is True
+    replica.synced_at -= ldap_replica.DEFAULT_MAX_STALENESS + 1
+    assert replica.is_usable() is False
+
+
+@mock.patch("shared.shared_ldap.paged_search", autospec=True)
+def test_replica_failed_changes(mi1):
+    """ The replica is only changed once LDAP has accepted the change. """
+    shared_ldap.BASE_DN = "base_dn"
+    shared.globals.CONFIGURATION = {}
+    mi1.return_value = [fred(), team()]
+    shared_ldap.REPLICA = ldap_replica.create_replica()
+    conn = mock.MagicMock()
+    conn.modify.return_value = False
+    conn.modify_dn.return_value = False
+    conn.delete.return_value = False
+    with mock.patch("shared.shared_ldap.get_ldap_connection") as mi2:
+        mi2.return_value.__enter__.return_value = conn
+        shared_ldap.replace_attribute_value(FRED, "mail", "fred@example.org")
+        shared_ldap.move_object(FRED, "ou=former,base_dn")
+        shared_ldap.delete_object(TEAM)
+    assert shared_ldap.REPLICA.get(FRED, ["mail"]).mail.values == ["fred@widget.org"]
+    assert shared_ldap.REPLICA.get(TEAM, ["cn"]) is not None
+
+
+def test_replica_disabled():
+    """ Nothing is loaded unless the replica is enabled. """
+    shared.globals.CONFIGURATION = {}
+    assert shared_ldap.get_replica() is None
+    assert shared_ldap.REPLICA is None
@@ -0,0 +1,36 @@
+#!/usr/bin/python3
+""" Test shared/shared_google. """
+
+import googleapiclient.errors
+import httplib2
+import mock
+
+import shared.cache
+import shared.globals
+import shared.shared_google as shared_google
+
+
+def http_error(status):
+    """ Build the error the Google client raises for an HTTP status. """
+    return googleapiclient.errors.HttpError(httplib2.Response({"status": status}), b"")
+
+
+def test_check_group_alias():
+    """ Only "not found" is cached, and only for the negative TTL. """
+    shared.globals.CONFIGURATION = {"google_enabled": True, "ldap_negative_ttl": 30}
+    service = mock.MagicMock()
+    groups_get = service.groups.return_value.get.return_value.execute
+    groups_get.side_effect = http_error(429)
+    with mock.patch("shared.shared_google.get_directory_service", return_value=service), \
+            mock.patch("shared.cache.put", wraps=shared.cache.put) as put:
+        assert shared_google.check_group_alias("team@widget.org") is None
+        put.assert_not_called()
+        groups_get.side_effect = http_error(404)
+        assert shared_google.check_group_alias("team@widget.org") is None
+        put.assert_called_once_with("google_aliases", "team@widget.org", None, 30)
+        assert shared_google.check_group_alias("team@widget.org") is None
+        groups_get.side_effect = None
+        groups_get.return_value = {"email": "team@widget.org", "aliases": ["old@widget.org"]}
+        assert shared_google.check_group_alias("Old@widget.org") == "team@widget.org"
+        assert shared_google.check_group_alias("old@widget.org") == "team@widget.org"
+    assert groups_get.call_count == 3
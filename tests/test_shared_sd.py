@@ -31,6 +31,10 @@ def test_get_servicedesk_id_1():
     )
     result = shared_sd.get_servicedesk_id("ITS")
     assert result == 3
+    # The project list is cached so a second lookup doesn't query the server.
+    result = shared_sd.get_servicedesk_id("ITS")
+    assert result == 3
+    assert len(responses.calls) == 1
 
 
 @responses.activate
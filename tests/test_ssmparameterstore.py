@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+""" Test shared/shared_ssmparameterstore functionality """
+
+import datetime
+import json
+import sys
+
+import mock
+from botocore.exceptions import ClientError
+import pytest
+
+import shared.globals
+import shared.shared_ssmparameterstore as shared_ssm
+
+
+@pytest.fixture(autouse=True)
+def reset_ssm():
+    """ Start every test without a client or any fetched parameters. """
+    shared.globals.CONFIGURATION = {
+        "ssm_secret_iam_role": "role",
+        "ssm_region_name": "region"
+    }
+    shared_ssm.CREDENTIALS = None
+    shared_ssm.SSM_CLIENT = None
+    shared_ssm.PARAMETERS = {}
+    yield
+    shared_ssm.CREDENTIALS = None
+    shared_ssm.SSM_CLIENT = None
+    shared_ssm.PARAMETERS = {}
+
+
+def credentials(seconds):
+    """ Credentials that expire after the given number of seconds. """
+    return {
+        "AccessKeyId": "id",
+        "SecretAccessKey": "key",
+        "SessionToken": "token",
+        "Expiration": datetime.datetime.now(datetime.timezone.utc) +
+                      datetime.timedelta(seconds=seconds)
+    }
+
+
+def parameter(name, value):
+    """ A parameter as returned by SSM. """
+    return {"Name": name, "Value": json.dumps(value)}
+
+
+@mock.patch.dict("sys.modules", {"boto3": mock.Mock()})
+def test_client_reused():
+    """ The role is only assumed again when its credentials are about to expire. """
+    mock_boto3 = sys.modules["boto3"]
+    sts = mock_boto3.client.return_value
+    sts.assume_role.return_value = {"Credentials": credentials(3600)}
+    sts.get_parameter.return_value = {"Parameter": parameter("bot", {"pw": "secret"})}
+    assert shared_ssm.get_secret("bot") == "secret"
+    assert shared_ssm.get_secret("bot", "api-token") is None
+    shared_ssm.PARAMETERS = {}
+    assert shared_ssm.get_secret("bot") == "secret"
+    assert sts.assume_role.call_count == 1
+    assert sts.get_parameter.call_count == 2
+    # Nearly expired
+    shared_ssm.CREDENTIALS = credentials(60)
+    shared_ssm.PARAMETERS = {}
+    shared_ssm.get_secret("bot")
+    assert sts.assume_role.call_count == 2
+
+
+@mock.patch.dict("sys.modules", {"boto3": mock.Mock()})
+def test_get_secrets():
+    """ Parameters are fetched ten at a time, skipping those already fetched. """
+    mock_boto3 = sys.modules["boto3"]
+    client = mock_boto3.client.return_value
+    client.assume_role.return_value = {"Credentials": credentials(3600)}
+
+    def get_parameters(Names, WithDecryption):  # pylint: disable=invalid-name
+        assert WithDecryption is True
+        return {
+            "Parameters": [
+                parameter(name, {"pw": f"{name}-pw"}) for name in Names if name != "missing"],
+            "InvalidParameters": [name for name in Names if name == "missing"]
+        }
+
+    client.get_parameters.side_effect = get_parameters
+    shared_ssm.PARAMETERS["p0"] = (shared_ssm.time.time(), {"pw": "cached"})
+    names = [f"p{index}" for index in range(12)] + ["missing"]
+    secrets = shared_ssm.get_secrets(names)
+    assert secrets["p0"] == "cached"
+    assert secrets["p11"] == "p11-pw"
+    assert "missing" not in secrets
+    assert [len(call[1]["Names"]) for call in client.get_parameters.call_args_list] == [10, 2]
+    assert shared_ssm.get_secret("p5") == "p5-pw"
+    client.get_parameter.assert_not_called()
+
+
+@mock.patch("shared.globals.shared_ssm.get_parameters")
+def test_prefetch_secrets(mock_get_parameters):
+    """ The bot's credentials are fetched along with the other secrets. """
+    shared.globals.CONFIGURATION = {
+        "bot_name": "name",
+        "ssm_bot_name": "bot",
+        "ssm_ldap_name": "ldap",
+        "ssm_google_name": "google"
+    }
+    with mock.patch("shared.globals.shared_ssm.get_secret", return_value="token"):
+        assert shared.globals.get_sd_credentials() == ("name", "token")
+    mock_get_parameters.assert_called_once_with(["bot", "ldap", "google"])
+
+
+def test_prefetch_secrets_failure():
+    """ A failed prefetch falls back to fetching the bot's secret on its own. """
+    shared.globals.CONFIGURATION = {
+        "bot_name": "name",
+        "ssm_bot_name": "bot",
+        "ssm_mail_name": "mail"
+    }
+    denied = ClientError(
+        {"Error": {"Code": "AccessDeniedException", "Message": "denied"}}, "GetParameters")
+    for error in (denied, ValueError("not JSON")):
+        with mock.patch("shared.globals.shared_ssm.get_parameters", side_effect=error), \
+                mock.patch(
+                    "shared.globals.shared_ssm.get_secret", return_value="token") as get_secret:
+            assert shared.globals.get_sd_credentials() == ("name", "token")
+        get_secret.assert_called_once_with("bot", "api-token")
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+""" Test shared/shared_vault functionality """
+
+import mock
+import pytest
+
+import shared.globals
+import shared.shared_vault as shared_vault
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    """ Start every test without any Vault clients. """
+    shared.globals.CONFIGURATION = {
+        "vault_iam_role": "role",
+        "vault_server_url": "https://vault"
+    }
+    shared_vault.CLIENTS = {}
+    yield
+    shared_vault.CLIENTS = {}
+
+
+@pytest.fixture(name="modules")
+def fixture_modules():
+    """ Stand-ins for boto3 and hvac, which are only imported when logging in. """
+    modules = {"boto3": mock.MagicMock(), "hvac": mock.MagicMock()}
+    with mock.patch.dict("sys.modules", modules):
+        yield modules
+
+
+def response(json, ok=True):
+    """ A mock requests response. """
+    result = mock.Mock(ok=ok)
+    result.json.return_value = json
+    return result
+
+
+def auth(token, ttl=3600):
+    """ The auth block of a Vault login or renewal. """
+    return {"auth": {"client_token": token, "lease_duration": ttl, "renewable": True}}
+
+
+@mock.patch("shared.shared_vault.atexit")
+def test_token_reused(mock_atexit, modules):
+    """ One login is used for every read and revoked at exit. """
+    mock_boto3, mock_hvac = modules["boto3"], modules["hvac"]
+    mock_hvac.Client.return_value.auth.aws.iam_login.return_value = auth("token")
+    client = shared_vault.configured_client()
+    client.session = mock.Mock()
+    client.session.get.side_effect = lambda url, **_: response(
+        {"data": {"pw": url.rsplit("/", 1)[1]}, "lease_duration": 0})
+    assert shared_vault.get_secret("secret/bot") == "bot"
+    assert shared_vault.get_secret("secret/bot", "api-token") is None
+    assert shared_vault.get_secrets(["secret/ldap", "secret/mail", "secret/bot"]) == {
+        "secret/ldap": "ldap", "secret/mail": "mail", "secret/bot": "bot"}
+    assert mock_boto3.client.return_value.assume_role.call_count == 1
+    # secret/bot came from memory the second and third times.
+    assert client.session.get.call_count == 3
+    mock_atexit.register.assert_called_once_with(client.revoke)
+    client.revoke()
+    client.session.post.assert_called_once_with(
+        "https://vault/v1/auth/token/revoke-self",
+        headers={"X-Vault-Token": "token"}, timeout=60)
+
+
+@mock.patch("shared.shared_vault.atexit")
+def test_token_renewed(_, modules):
+    """ The token is renewed near the end of its TTL, or replaced if that fails. """
+    mock_boto3, mock_hvac = modules["boto3"], modules["hvac"]
+    mock_hvac.Client.return_value.auth.aws.iam_login.return_value = auth("token")
+    client = shared_vault.configured_client()
+    client.session = mock.Mock()
+    assert client.headers() == {"X-Vault-Token": "token"}
+    client.obtained -= 3000
+    client.session.post.return_value = response(auth("renewed"))
+    assert client.headers() == {"X-Vault-Token": "renewed"}
+    client.obtained -= 3000
+    client.session.post.return_value = response({}, ok=False)
+    mock_hvac.Client.return_value.auth.aws.iam_login.return_value = auth("new")
+    assert client.headers() == {"X-Vault-Token": "new"}
+    assert mock_boto3.client.return_value.assume_role.call_count == 2
+
+
+@mock.patch("shared.shared_vault.atexit")
+def test_rejected_token(_, modules):
+    """ A token Vault rejects is replaced, and long leases are capped. """
+    mock_hvac = modules["hvac"]
+    shared.globals.CONFIGURATION["vault_max_secret_ttl"] = 600
+    login = mock_hvac.Client.return_value.auth.aws.iam_login
+    login.return_value = auth("revoked")
+    client = shared_vault.configured_client()
+    client.session = mock.Mock()
+
+    def get(_, headers, **__):
+        if headers["X-Vault-Token"] == "revoked":
+            return mock.Mock(status_code=403)
+        return mock.Mock(status_code=200, json=mock.Mock(return_value={
+            "data": {"pw": "secret"}, "lease_duration": 2764800}))
+
+    client.session.get.side_effect = get
+    client.headers()
+    login.return_value = auth("token")
+    assert shared_vault.get_secret("secret/bot") == "secret"
+    assert login.call_count == 2
+    assert client.session.get.call_count == 2
+    expires = client.secrets["secret/bot"][0]
+    assert expires - shared_vault.time.time() <= 600
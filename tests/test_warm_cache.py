@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+""" Test the cache warming script. """
+
+import mock
+import responses
+
+import shared.cache
+import shared.custom_fields as custom_fields
+import shared.globals
+import shared.shared_sd as shared_sd
+import warm_cache
+
+
+def add_mock_responses():
+    """ Mock up the Jira responses needed to warm the cache. """
+    responses.add(
+        responses.GET,
+        "https://mock-server/rest/api/3/field",
+        json=[{"id": "customfield_10100", "name": "Customer Request Type"}],
+        status=200
+    )
+    responses.add(
+        responses.GET,
+        "https://mock-server/rest/servicedeskapi/servicedesk",
+        json={"values": [{"projectKey": "ITS", "id": 3}]},
+        status=200
+    )
+    responses.add(
+        responses.GET,
+        "https://mock-server/rest/servicedeskapi/servicedesk/3/requesttype",
+        json={"values": [{"id": "265", "name": "New account"}]},
+        status=200
+    )
+    responses.add(
+        responses.GET,
+        "https://mock-server/rest/servicedeskapi/servicedesk/3/organization",
+        json={"values": [{"id": "7", "name": "Linaro"}]},
+        status=200
+    )
+
+
+@mock.patch(
+    'shared.globals.initialise_sd_auth',
+    autospec=True
+)
+@mock.patch(
+    'shared.custom_fields.save_cf_cache',
+    autospec=True
+)
+@responses.activate
+def test_warm_and_load_snapshot(mi1, mi2, tmp_path):
+    """ A snapshot written by the warmer makes later lookups free. """
+    shared.globals.CONFIGURATION = {
+        "cf_use_server_api": False,
+        "cf_use_cloud_api": True,
+        "cf_cachefile": str(tmp_path / "cf_cachefile"),
+        "cache_snapshot_file": str(tmp_path / "snapshot.json"),
+        "handlers": {"265": "rt_new_account", "999": "rt_missing"}
+    }
+    custom_fields.CF_CACHE = None
+    add_mock_responses()
+    shared.cache.start_recording()
+    assert warm_cache.warm("https://mock-server/") is True
+    snapshot = shared.cache.stop_recording()
+    shared.cache.write_snapshot(snapshot, str(tmp_path / "snapshot.json"))
+    assert mi1.called is True
+    assert mi2.called is True
+    calls = len(responses.calls)
+
+    # Simulate a freshly started process.
+    shared.cache.BACKEND = None
+    shared.cache.SNAPSHOT_LOADED = False
+    custom_fields.CF_CACHE = {}
+    shared.cache.load_configured_snapshot()
+    shared.globals.PROJECT = "ITS"
+    assert shared_sd.get_servicedesk_id("ITS") == 3
+    assert shared_sd.get_request_type_id("New account", 3) == "265"
+    assert shared_sd.sd_orgs() == {"Linaro": 7}
+    assert custom_fields.get("Customer Request Type") == "customfield_10100"
+    assert len(responses.calls) == calls
+
+
+def test_old_snapshot(tmp_path):
+    """ Entries get their full TTL from when the snapshot is loaded. """
+    shared.globals.CONFIGURATION = {"cache_ttls": {"accounts": 10}}
+    snapshot = {
+        "created": shared.cache.time.time() - 20,
+        "namespaces": {
+            "accounts": {"fred": "123"},
+            "project_metadata": {"projects": [1]}
+        }
+    }
+    shared.cache.write_snapshot(snapshot, str(tmp_path / "snapshot.json"))
+    assert shared.cache.load_snapshot(str(tmp_path / "snapshot.json")) == 2
+    assert shared.cache.get("accounts", "fred") == "123"
+    assert shared.cache.get("project_metadata", "projects") == [1]
+
+
+def test_snapshot_max_age(tmp_path):
+    """ A snapshot older than cache_snapshot_max_age is not loaded. """
+    shared.globals.CONFIGURATION = {
+        "cache_snapshot_file": str(tmp_path / "snapshot.json"),
+        "cache_snapshot_max_age": 10
+    }
+    snapshot = {
+        "created": shared.cache.time.time() - 20,
+        "namespaces": {"accounts": {"fred": "123"}}
+    }
+    shared.cache.write_snapshot(snapshot, str(tmp_path / "snapshot.json"))
+    shared.cache.SNAPSHOT_LOADED = False
+    shared.cache.load_configured_snapshot()
+    assert shared.cache.get("accounts", "fred") is None
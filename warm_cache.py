@@ -0,0 +1,97 @@
+"""
+Pre-resolve the Jira lookups that the first webhook after a deploy would
+otherwise have to make and save them as a cache snapshot. When
+"cache_snapshot_file" is configured, the framework loads the snapshot on
+its first request so that a fresh container or Lambda cold start begins
+with a warm cache.
+
+The following are resolved:
+
+* every custom field
+* the Service Desk projects and their IDs
+* the request types for every Service Desk project
+* the organisations for every Service Desk project
+* every mailing group, by name, email address and Google alias, if LDAP
+  is enabled
+
+Transitions are not included because Jira only reports them for a specific
+issue.
+
+Usage: python3 warm_cache.py <Jira URL> [snapshot file]
+"""
+
+import sys
+
+import shared.cache
+import shared.custom_fields as custom_fields
+import shared.globals
+import shared.shared_ldap as shared_ldap
+import shared.shared_sd as shared_sd
+
+
+def warm_project(project):
+    """ Resolve the request types and organisations for one project. """
+    request_types = shared_sd.get_servicedesk_request_types(project["id"])
+    orgs = shared_sd.get_servicedesk_orgs(project["id"])
+    values = [] if request_types is None else request_types["values"]
+    print(f"{project['projectKey']}: {len(values)} request types, "
+          f"{len(orgs)} organisations")
+    return [str(value["id"]) for value in values]
+
+
+def check_handlers(request_type_ids):
+    """ Report any configured handlers whose request type wasn't found. """
+    handlers = shared.globals.config("handlers")
+    if handlers is None:
+        return
+    for reqtype, handler in handlers.items():
+        if reqtype != "*" and reqtype not in request_type_ids:
+            print(f"WARNING! No project has request type {reqtype} (handled by {handler})")
+
+
+def warm(root_url):
+    """ Resolve everything against the specified Jira instance. """
+    shared.globals.ROOT_URL = root_url.rstrip("/")
+    shared.globals.initialise_sd_auth()
+    if custom_fields.load_cf_catalogue():
+        print(f"{len(custom_fields.CF_CATALOGUE)} custom fields")
+    if shared.globals.config("ldap_enabled"):
+        print(f"{shared_ldap.prefetch_groups()} group names")
+    projects = shared_sd.get_servicedesk_projects()
+    if projects is None:
+        print("Unable to retrieve the Service Desk projects")
+        return False
+    request_type_ids = []
+    for project in projects["values"]:
+        request_type_ids += warm_project(project)
+    check_handlers(request_type_ids)
+    return True
+
+
+def main():
+    """ Warm the cache and write out the snapshot. """
+    if len(sys.argv) not in (2, 3):
+        print(__doc__)
+        return 1
+    try:
+        shared.globals.initialise_config()
+    except Exception as exc:  # pylint: disable=broad-except
+        print(str(exc))
+        return 1
+    filename = sys.argv[2] if len(sys.argv) == 3 else \
+        shared.globals.config("cache_snapshot_file")
+    if filename is None:
+        print("No snapshot file given and 'cache_snapshot_file' isn't configured")
+        return 1
+    shared.cache.start_recording()
+    if not warm(sys.argv[1]):
+        return 1
+    snapshot = shared.cache.stop_recording()
+    shared.cache.write_snapshot(snapshot, filename)
+    count = sum(len(mapping) for mapping in snapshot["namespaces"].values())
+    print(f"Wrote {count} cache entries to {filename}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())